@@ -1,4 +1,10 @@
 import sys
+import time
 
 if "pytest" not in sys.modules:
+    _start = time.perf_counter()
+
     from . import main
+    from .log import logger
+
+    logger.info("Add-on loaded in %.1f ms", (time.perf_counter() - _start) * 1000)
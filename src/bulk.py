@@ -0,0 +1,367 @@
+from __future__ import annotations
+
+import dataclasses
+from typing import Callable, Dict, Iterator, Optional, Sequence, Tuple, TypeVar
+
+from anki.cards import CardId
+from anki.collection import Collection, OpChanges
+from anki.utils import ids2str
+
+from .custom_data import (
+    CUSTOM_DATA_KEY,
+    MAX_MULTI_FLAGS,
+    apply_card_custom_flag,
+    apply_card_custom_flag_mask,
+    card_has_flag_mask,
+    custom_flag_from_card_data,
+    custom_flag_mask_from_card_data,
+    fetch_custom_flag_masks,
+    fetch_custom_flags,
+    flag_bit,
+    flag_change,
+    flag_mask_change,
+    flags_in_mask,
+    get_card_custom_flag_mask,
+    notify_custom_flags_changed,
+)
+from .profiling import measure
+
+CHUNK_SIZE = 1000
+
+T = TypeVar("T")
+
+# Called with (processed, total) after each chunk. Returning False cancels the operation.
+ProgressCallback = Callable[[int, int], bool]
+
+
+def chunked(seq: Sequence[T], size: int = CHUNK_SIZE) -> Iterator[Sequence[T]]:
+    for i in range(0, len(seq), size):
+        yield seq[i : i + size]
+
+
+@dataclasses.dataclass
+class BulkFlagResult:
+    changes: OpChanges
+    # Number of cards that were actually modified
+    count: int
+    # Number of card ids that were examined
+    processed: int
+    elapsed: float
+    # Peak traced memory in bytes; only available when tracemalloc is tracing
+    peak_memory: Optional[int] = None
+    cancelled: bool = False
+
+    @property
+    def cards_per_second(self) -> float:
+        return self.processed / self.elapsed if self.elapsed else 0.0
+
+
+def _cards_needing_change(
+    col: Collection, cids: Sequence[CardId], flag: int
+) -> list[CardId]:
+    changed = []
+    for cid, flags, data in col.db.execute(
+        f"select id, flags, data from cards where id in {ids2str(cids)}"
+    ):
+        # Setting a custom flag also clears the built-in one
+        if custom_flag_from_card_data(data) != flag or (flag and flags & 0b111):
+            changed.append(CardId(cid))
+    return changed
+
+
+def set_custom_flag_for_cards(
+    col: Collection,
+    cids: Sequence[CardId],
+    flag: int,
+    on_progress: Optional[ProgressCallback] = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> BulkFlagResult:
+    """Set (or clear if `flag` is 0) the custom flag of the given cards.
+
+    Cards are processed in chunks so that only `chunk_size` cards are held in memory
+    at a time, and cards that already have the desired flag are not written.
+    All changes are merged into a single undo entry.
+    """
+    with measure() as measurement:
+        target = col.add_custom_undo_entry(col.tr.actions_set_flag())
+        processed = updated = 0
+        cancelled = False
+        for chunk in chunked(cids, chunk_size):
+            cards = [
+                col.get_card(cid) for cid in _cards_needing_change(col, chunk, flag)
+            ]
+            changes = []
+            for card in cards:
+                changes.append(flag_change(card, flag))
+                apply_card_custom_flag(card, flag)
+            if cards:
+                col.update_cards(cards)
+                notify_custom_flags_changed(changes)
+            processed += len(chunk)
+            updated += len(cards)
+            if on_progress and not on_progress(processed, len(cids)):
+                cancelled = True
+                break
+        changes = col.merge_undo_entries(target)
+        changes.study_queues = False
+        # Refresh flag counts in the sidebar
+        changes.browser_sidebar = True
+
+    return BulkFlagResult(
+        changes=changes,
+        count=updated,
+        processed=processed,
+        elapsed=measurement.elapsed,
+        peak_memory=measurement.peak_memory,
+        cancelled=cancelled,
+    )
+
+
+def cards_with_custom_flag(col: Collection, cids: Sequence[CardId]) -> list[CardId]:
+    """Narrow down the given cards to the ones that have a custom flag using a single query."""
+    return list(fetch_custom_flags(col, cids))
+
+
+def clear_custom_flags(
+    col: Collection, cids: Sequence[CardId], chunk_size: int = CHUNK_SIZE
+) -> None:
+    """Remove the custom flag of the given cards in chunks.
+
+    The cards are expected to be already narrowed down with `cards_with_custom_flag()`.
+    No undo entry is added, so this should be merged into the caller's undo entry.
+    """
+    for chunk in chunked(cids, chunk_size):
+        cards = [col.get_card(cid) for cid in chunk]
+        changes = []
+        for card in cards:
+            changes.append(flag_change(card, 0))
+            apply_card_custom_flag(card, 0)
+        col.update_cards(cards)
+        notify_custom_flags_changed(changes)
+
+
+def write_custom_flags(
+    col: Collection, flags: Dict[CardId, int], skip_undo_entry: bool = False
+) -> int:
+    """Set the custom flags of the given cards, skipping ones that already have them.
+
+    Returns the number of modified cards. No undo entry is added, so this should be
+    merged into the caller's undo entry. With `skip_undo_entry`, the cards are written
+    without undo information, which clears the undo queue.
+    """
+    cards = []
+    changes = []
+    for cid, flag in flags.items():
+        card = col.get_card(cid)
+        change = flag_change(card, flag)
+        if change.old == flag and not (flag and change.old_user_flag):
+            continue
+        changes.append(change)
+        apply_card_custom_flag(card, flag)
+        cards.append(card)
+    if cards:
+        col.update_cards(cards, skip_undo_entry=skip_undo_entry)
+        notify_custom_flags_changed(changes)
+    return len(cards)
+
+
+def write_custom_flag_masks(
+    col: Collection, masks: Dict[CardId, int], skip_undo_entry: bool = False
+) -> int:
+    """Set the custom flags bitmask of the given cards, skipping ones that already have it.
+
+    Returns the number of modified cards. No undo entry is added, so this should be
+    merged into the caller's undo entry. With `skip_undo_entry`, the cards are written
+    without undo information, which clears the undo queue.
+    """
+    cards = []
+    changes = []
+    for cid, mask in masks.items():
+        card = col.get_card(cid)
+        if get_card_custom_flag_mask(card) == mask and (
+            not mask or card_has_flag_mask(card)
+        ):
+            continue
+        changes.append(flag_mask_change(card, mask))
+        apply_card_custom_flag_mask(card, mask)
+        cards.append(card)
+    if cards:
+        col.update_cards(cards, skip_undo_entry=skip_undo_entry)
+        notify_custom_flags_changed(changes)
+    return len(cards)
+
+
+def remap_flag_mask(mask: int, mapping: Dict[int, int]) -> int:
+    new_mask = 0
+    for flag in flags_in_mask(mask):
+        new_flag = mapping.get(flag, flag)
+        if new_flag:
+            new_mask |= flag_bit(new_flag)
+    return new_mask
+
+
+def cards_to_remap(
+    col: Collection, mapping: Dict[int, int]
+) -> Tuple[Dict[CardId, int], Dict[CardId, int]]:
+    """Find the cards whose custom flags are changed by `mapping` using a single query.
+
+    Returns mappings of card ids to their new flags, and of card ids to their new
+    bitmasks for cards with multiple flags.
+    """
+    mapping = {old: new for old, new in mapping.items() if old != new}
+    remapped: Dict[CardId, int] = {}
+    remapped_masks: Dict[CardId, int] = {}
+    if not mapping:
+        return remapped, remapped_masks
+    for cid, data in col.db.execute(
+        "select id, data from cards where data like ?", f"%{CUSTOM_DATA_KEY}%"
+    ):
+        mask = custom_flag_mask_from_card_data(data)
+        if mask is not None:
+            new_mask = remap_flag_mask(mask, mapping)
+            if new_mask != mask:
+                remapped_masks[CardId(cid)] = new_mask
+            continue
+        flag = custom_flag_from_card_data(data)
+        if flag in mapping:
+            remapped[CardId(cid)] = mapping[flag]
+    return remapped, remapped_masks
+
+
+def _non_undoable_changes(updated: int) -> OpChanges:
+    # Cards written without an undo entry don't give the changes of the whole operation
+    return OpChanges(
+        card=bool(updated), browser_table=bool(updated), browser_sidebar=True
+    )
+
+
+def remap_custom_flags(
+    col: Collection,
+    mapping: Dict[int, int],
+    on_progress: Optional[ProgressCallback] = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> BulkFlagResult:
+    """Change custom flags of all cards in the collection after flags were reordered or deleted.
+
+    `mapping` maps old flag indices to new ones, or to 0 to remove the flag. Flags
+    not in `mapping` are left as is. Undo would only revert the cards and leave them
+    pointing at the wrong flags of the saved config, so no undo entry is added and
+    the undo queue is cleared instead. The operation can't be cancelled for the same
+    reason, so the return value of `on_progress` is ignored.
+    """
+    with measure() as measurement:
+        remapped, remapped_masks = cards_to_remap(col, mapping)
+        cids = list(remapped)
+        mask_cids = list(remapped_masks)
+        total = len(cids) + len(mask_cids)
+        processed = updated = 0
+        for chunk in chunked(cids, chunk_size):
+            updated += write_custom_flags(
+                col, {cid: remapped[cid] for cid in chunk}, skip_undo_entry=True
+            )
+            processed += len(chunk)
+            if on_progress:
+                on_progress(processed, total)
+        for chunk in chunked(mask_cids, chunk_size):
+            updated += write_custom_flag_masks(
+                col, {cid: remapped_masks[cid] for cid in chunk}, skip_undo_entry=True
+            )
+            processed += len(chunk)
+            if on_progress:
+                on_progress(processed, total)
+
+    return BulkFlagResult(
+        changes=_non_undoable_changes(updated),
+        count=updated,
+        processed=processed,
+        elapsed=measurement.elapsed,
+        peak_memory=measurement.peak_memory,
+    )
+
+
+def toggle_custom_flag_bit_for_cards(
+    col: Collection,
+    cids: Sequence[CardId],
+    flag: int,
+    enable: bool,
+    on_progress: Optional[ProgressCallback] = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> BulkFlagResult:
+    """Add `flag` to (or remove it from) the custom flags of the given cards in multi-flag mode.
+
+    Other custom flags and built-in flags of the cards are kept. Cards are processed
+    in chunks, and all changes are merged into a single undo entry.
+    """
+    with measure() as measurement:
+        bit = flag_bit(flag)
+        target = col.add_custom_undo_entry(col.tr.actions_set_flag())
+        processed = updated = 0
+        cancelled = False
+        for chunk in chunked(cids, chunk_size):
+            masks = fetch_custom_flag_masks(col, chunk)
+            updated += write_custom_flag_masks(
+                col,
+                {
+                    cid: (masks.get(cid, 0) | bit) if enable else (masks[cid] & ~bit)
+                    for cid in chunk
+                    if enable or cid in masks
+                },
+            )
+            processed += len(chunk)
+            if on_progress and not on_progress(processed, len(cids)):
+                cancelled = True
+                break
+        changes = col.merge_undo_entries(target)
+        changes.study_queues = False
+        changes.browser_sidebar = True
+
+    return BulkFlagResult(
+        changes=changes,
+        count=updated,
+        processed=processed,
+        elapsed=measurement.elapsed,
+        peak_memory=measurement.peak_memory,
+        cancelled=cancelled,
+    )
+
+
+def migrate_to_flag_masks(
+    col: Collection,
+    on_progress: Optional[ProgressCallback] = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> BulkFlagResult:
+    """Store the custom flags of cards flagged in single-flag mode as bitmasks.
+
+    This is needed before switching to multi-flag mode, as bitmask searches don't
+    match cards that only have a single-value flag. As it comes with a config change,
+    it clears the undo queue like `remap_custom_flags()` instead of adding an undo
+    entry. It can't be cancelled, so the return value of `on_progress` is ignored.
+    """
+    with measure() as measurement:
+        cids = [
+            CardId(cid)
+            for cid, data in col.db.execute(
+                "select id, data from cards where data like ?", f"%{CUSTOM_DATA_KEY}%"
+            )
+            if custom_flag_mask_from_card_data(data) is None
+            # Flags that don't fit in a bitmask are left as is
+            and 0 < custom_flag_from_card_data(data) <= MAX_MULTI_FLAGS
+        ]
+        processed = updated = 0
+        for chunk in chunked(cids, chunk_size):
+            updated += write_custom_flag_masks(
+                col,
+                {cid: get_card_custom_flag_mask(col.get_card(cid)) for cid in chunk},
+                skip_undo_entry=True,
+            )
+            processed += len(chunk)
+            if on_progress:
+                on_progress(processed, len(cids))
+
+    return BulkFlagResult(
+        changes=_non_undoable_changes(updated),
+        count=updated,
+        processed=processed,
+        elapsed=measurement.elapsed,
+        peak_memory=measurement.peak_memory,
+    )
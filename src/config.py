@@ -1,22 +1,77 @@
 from __future__ import annotations
 
 import dataclasses
+from typing import Any, Iterable
 
 from ankiutils.config import Config as AddonConfig
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True)
 class CustomFlag:
     label: str
     color_light: str
     color_dark: str
     shortcut: str | None = None
+    # Flags of the same group are shown in a submenu
+    group: str | None = None
+
+
+class FlagRegistry:
+    """Immutable lookup tables of the configured custom flags.
+
+    Flag indices are 1-based, matching the values stored in the cards' custom data.
+    """
+
+    __slots__ = ("flags", "index_by_shortcut", "index_by_label", "groups")
+
+    def __init__(self, flags: Iterable[CustomFlag]) -> None:
+        self.flags: tuple[CustomFlag, ...] = tuple(flags)
+        self.index_by_shortcut: dict[str, int] = {
+            flag.shortcut: i
+            for i, flag in enumerate(self.flags, start=1)
+            if flag.shortcut
+        }
+        self.index_by_label: dict[str, int] = {
+            flag.label: i for i, flag in enumerate(self.flags, start=1)
+        }
+        # Group name -> indices of the group's flags, in order of first appearance
+        groups: dict[str, list[int]] = {}
+        for i, flag in enumerate(self.flags, start=1):
+            if flag.group:
+                groups.setdefault(flag.group, []).append(i)
+        self.groups: dict[str, tuple[int, ...]] = {
+            group: tuple(indices) for group, indices in groups.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.flags)
+
+    def get(self, index: int) -> CustomFlag | None:
+        if 0 < index <= len(self.flags):
+            return self.flags[index - 1]
+        return None
 
 
 class Config(AddonConfig):
+    # Incremented on every write so that caches derived from the config can be invalidated
+    version = 0
+    _registry: FlagRegistry | None = None
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        super().__setitem__(key, value)
+        self.version += 1
+        self._registry = None
+
+    @property
+    def registry(self) -> FlagRegistry:
+        """The custom flags registry, built once per config version."""
+        if self._registry is None:
+            self._registry = FlagRegistry(CustomFlag(**flag) for flag in self["flags"])
+        return self._registry
+
     @property
     def flags(self) -> list[CustomFlag]:
-        return [CustomFlag(**flag) for flag in self["flags"]]
+        return list(self.registry.flags)
 
     @flags.setter
     def flags(self, flags: list[CustomFlag]) -> None:
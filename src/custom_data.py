@@ -0,0 +1,297 @@
+from __future__ import annotations
+
+import json
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence
+
+from anki.cards import Card, CardId
+from anki.collection import Collection
+from anki.decks import DeckId
+from anki.notes import NoteId
+from anki.utils import ids2str, pointVersion
+
+CUSTOM_DATA_KEY = "cf"
+# In multi-flag mode, all custom flags of a card are stored as a bitmask under this key,
+# and CUSTOM_DATA_KEY holds the lowest of them so that single-flag features keep working
+CUSTOM_DATA_MASK_KEY = "cfm"
+# Custom data values are JSON numbers, which SQLite extracts as doubles, so masks are
+# only exact up to 53 bits. This also keeps a mask within 16 digits, well under the
+# 100 bytes Anki allows for a card's custom data.
+MAX_MULTI_FLAGS = 53
+
+
+class FlagChange(NamedTuple):
+    cid: CardId
+    did: DeckId
+    old: int
+    new: int
+    # The built-in flag the card had before the change; setting a custom flag clears it
+    old_user_flag: int
+    # Bitmasks of the card's custom flags before and after the change, for multi-flag mode
+    old_mask: int
+    new_mask: int
+
+
+# Called after the add-on writes custom flags to the collection.
+# Callbacks may be called from a background thread.
+custom_flags_did_change: List[Callable[[Sequence[FlagChange]], None]] = []
+
+
+def notify_custom_flags_changed(changes: Sequence[FlagChange]) -> None:
+    if not changes:
+        return
+    for callback in custom_flags_did_change:
+        callback(changes)
+
+
+def supports_custom_data_prop_search() -> bool:
+    return pointVersion() >= 64
+
+
+def _data_prop_name(card: Card) -> str:
+    return "data" if hasattr(card, "data") else "custom_data"
+
+
+def get_card_custom_flag(card: Card) -> int:
+    raw_data = getattr(card, _data_prop_name(card))
+    card_data = json.loads(raw_data) if raw_data else {}
+    return int(card_data.get(CUSTOM_DATA_KEY, 0))
+
+
+def apply_card_custom_flag(card: Card, flag: int) -> None:
+    """Set the custom flag of the card in memory without saving it."""
+    data_prop_name = _data_prop_name(card)
+    raw_data = getattr(card, data_prop_name)
+    card_data = json.loads(raw_data) if raw_data else {}
+    if flag:
+        card_data[CUSTOM_DATA_KEY] = flag
+        card.flags = 0
+    elif CUSTOM_DATA_KEY in card_data:
+        del card_data[CUSTOM_DATA_KEY]
+    # The card now has at most one custom flag
+    card_data.pop(CUSTOM_DATA_MASK_KEY, None)
+    setattr(card, data_prop_name, json.dumps(card_data))
+
+
+def flag_bit(flag: int) -> int:
+    return 1 << (flag - 1)
+
+
+def flags_in_mask(mask: int) -> List[int]:
+    return [flag for flag in range(1, mask.bit_length() + 1) if mask & flag_bit(flag)]
+
+
+def lowest_flag_in_mask(mask: int) -> int:
+    return (mask & -mask).bit_length()
+
+
+def get_card_custom_flag_mask(card: Card) -> int:
+    """Return the bitmask of the card's custom flags, including a flag set in single-flag mode."""
+    raw_data = getattr(card, _data_prop_name(card))
+    card_data = json.loads(raw_data) if raw_data else {}
+    return _mask_from_custom_data(card_data)
+
+
+def card_has_flag_mask(card: Card) -> bool:
+    """Whether the card's custom flags were set in multi-flag mode."""
+    raw_data = getattr(card, _data_prop_name(card))
+    return bool(raw_data) and CUSTOM_DATA_MASK_KEY in json.loads(raw_data)
+
+
+def _mask_from_custom_data(card_data: Dict) -> int:
+    if CUSTOM_DATA_MASK_KEY in card_data:
+        return int(card_data[CUSTOM_DATA_MASK_KEY])
+    flag = int(card_data.get(CUSTOM_DATA_KEY, 0))
+    return flag_bit(flag) if flag else 0
+
+
+def apply_card_custom_flag_mask(card: Card, mask: int) -> None:
+    """Set the custom flags of the card to the ones in `mask` in memory without saving it.
+
+    Unlike `apply_card_custom_flag()`, the card's built-in flag is kept.
+    Raises ValueError if `mask` has flags above `MAX_MULTI_FLAGS`.
+    """
+    if mask.bit_length() > MAX_MULTI_FLAGS:
+        raise ValueError(f"only {MAX_MULTI_FLAGS} custom flags fit in a bitmask")
+    data_prop_name = _data_prop_name(card)
+    raw_data = getattr(card, data_prop_name)
+    card_data = json.loads(raw_data) if raw_data else {}
+    if mask:
+        card_data[CUSTOM_DATA_KEY] = lowest_flag_in_mask(mask)
+        card_data[CUSTOM_DATA_MASK_KEY] = mask
+    else:
+        card_data.pop(CUSTOM_DATA_KEY, None)
+        card_data.pop(CUSTOM_DATA_MASK_KEY, None)
+    setattr(card, data_prop_name, json.dumps(card_data))
+
+
+def flag_change(card: Card, flag: int) -> FlagChange:
+    """Describe setting the custom flag of the card. Must be called before the flag is applied."""
+    return FlagChange(
+        card.id,
+        card.did,
+        get_card_custom_flag(card),
+        flag,
+        card.user_flag(),
+        get_card_custom_flag_mask(card),
+        flag_bit(flag) if flag else 0,
+    )
+
+
+def flag_mask_change(card: Card, mask: int) -> FlagChange:
+    """Describe setting the custom flags of the card to `mask`. Must be called before the mask is applied.
+
+    `old` and `new` are the card's lowest custom flag, as stored for single-flag mode.
+    """
+    return FlagChange(
+        card.id,
+        card.did,
+        get_card_custom_flag(card),
+        lowest_flag_in_mask(mask),
+        0,
+        get_card_custom_flag_mask(card),
+        mask,
+    )
+
+
+def _custom_data_from_card_data(data: str) -> Dict:
+    card_data = json.loads(data)
+    # Since 2.1.55, custom data is stored as a JSON string under the "cd" key
+    custom_data = card_data.get("cd")
+    if isinstance(custom_data, str):
+        card_data = json.loads(custom_data)
+    return card_data
+
+
+def custom_flag_from_card_data(data: str) -> int:
+    """Extract the custom flag from the raw value of the cards table's data column."""
+    if CUSTOM_DATA_KEY not in data:
+        return 0
+    return int(_custom_data_from_card_data(data).get(CUSTOM_DATA_KEY, 0))
+
+
+def custom_flag_mask_from_card_data(data: str) -> Optional[int]:
+    """Extract the custom flags bitmask from the raw value of the cards table's data column.
+
+    Returns None if the card has no bitmask, i.e. its flag was last set in single-flag mode.
+    """
+    if CUSTOM_DATA_MASK_KEY not in data:
+        return None
+    mask = _custom_data_from_card_data(data).get(CUSTOM_DATA_MASK_KEY)
+    return None if mask is None else int(mask)
+
+
+def custom_flags_from_card_data(data: str, multi: bool) -> List[int]:
+    """Extract all custom flags from the raw value of the cards table's data column.
+
+    Outside multi-flag mode, this is at most the card's single custom flag.
+    """
+    mask = custom_flag_mask_from_card_data(data) if multi else None
+    if mask is None:
+        # Single-flag mode, or flagged before switching to multi-flag mode
+        flag = custom_flag_from_card_data(data)
+        return [flag] if flag else []
+    return flags_in_mask(mask)
+
+
+def fetch_custom_flags(col: Collection, cids: Sequence[CardId]) -> Dict[CardId, int]:
+    """Return the custom flags of the given cards using a single query.
+
+    Cards without a custom flag are not included in the result.
+    """
+    flags: Dict[CardId, int] = {}
+    for cid, data in col.db.execute(
+        f"select id, data from cards where id in {ids2str(cids)} and data like ?",
+        f"%{CUSTOM_DATA_KEY}%",
+    ):
+        flag = custom_flag_from_card_data(data)
+        if flag:
+            flags[CardId(cid)] = flag
+    return flags
+
+
+def fetch_note_custom_flags(
+    col: Collection, nids: Sequence[NoteId]
+) -> Dict[NoteId, int]:
+    """Return the custom flag of each of the given notes using a single query.
+
+    A note's flag is the lowest custom flag among its cards. Notes without a custom
+    flag are not included in the result.
+    """
+    flags: Dict[NoteId, int] = {}
+    if supports_custom_data_prop_search():
+        for nid, flag in col.db.execute(
+            f"select nid, min(extract_custom_data(data, '{CUSTOM_DATA_KEY}')) from cards "
+            f"where nid in {ids2str(nids)} and data like ? group by nid",
+            f"%{CUSTOM_DATA_KEY}%",
+        ):
+            if flag:
+                flags[NoteId(nid)] = int(flag)
+        return flags
+    for nid, data in col.db.execute(
+        f"select nid, data from cards where nid in {ids2str(nids)} and data like ?",
+        f"%{CUSTOM_DATA_KEY}%",
+    ):
+        flag = custom_flag_from_card_data(data)
+        if flag:
+            flags[NoteId(nid)] = min(flags.get(NoteId(nid), flag), flag)
+    return flags
+
+
+def fetch_custom_flag_masks(
+    col: Collection, cids: Sequence[CardId]
+) -> Dict[CardId, int]:
+    """Return the custom flags bitmask of the given cards using a single query.
+
+    Cards without custom flags are not included in the result.
+    """
+    masks: Dict[CardId, int] = {}
+    for cid, data in col.db.execute(
+        f"select id, data from cards where id in {ids2str(cids)} and data like ?",
+        f"%{CUSTOM_DATA_KEY}%",
+    ):
+        if not data:
+            continue
+        mask = _mask_from_custom_data(_custom_data_from_card_data(data))
+        if mask:
+            masks[CardId(cid)] = mask
+    return masks
+
+
+def cards_with_flag_bit(col: Collection, flag: int) -> List[CardId]:
+    """Return the ids of cards that have `flag` among their custom flags."""
+    bit = flag_bit(flag)
+    return [
+        CardId(cid)
+        for cid, data in col.db.execute(
+            "select id, data from cards where data like ?", f"%{CUSTOM_DATA_KEY}%"
+        )
+        if _mask_from_custom_data(_custom_data_from_card_data(data)) & bit
+    ]
+
+
+# Bit searches are expanded into value ranges, which gets too long with many flags
+MAX_FLAG_BIT_SEARCH_RANGES = 64
+# The backend parses search values as 32-bit floats, so range bounds are only exact
+# below 2^24
+MAX_FLAG_BIT_SEARCH_BITS = 24
+
+
+def flag_bit_search(flag: int, flags_count: int) -> Optional[str]:
+    """Return a `prop:cdn` search matching cards whose bitmask includes `flag`.
+
+    Searches can only compare custom data values, so this matches the value ranges
+    in which the flag's bit is set. Returns None if that needs too many ranges, or
+    if the range bounds can't be compared exactly.
+    """
+    if max(flags_count, flag) > MAX_FLAG_BIT_SEARCH_BITS:
+        return None
+    bit = flag_bit(flag)
+    count = 1 << max(flags_count - flag, 0)
+    if count > MAX_FLAG_BIT_SEARCH_RANGES:
+        return None
+    ranges = [
+        f"(prop:cdn:{CUSTOM_DATA_MASK_KEY}>={start + bit} "
+        f"prop:cdn:{CUSTOM_DATA_MASK_KEY}<={start + 2 * bit - 1})"
+        for start in range(0, count * 2 * bit, 2 * bit)
+    ]
+    return f"({' OR '.join(ranges)})"
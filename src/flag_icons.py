@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+from typing import Dict, Optional, Tuple
+
+from anki.utils import pointVersion
+from aqt import colors
+from aqt.theme import ColoredIcon
+
+
+class FlagIconCache:
+    """Icons of custom flags, created when first rendered and shared by flags of the same colors."""
+
+    def __init__(self) -> None:
+        self._base_icon: Optional[ColoredIcon] = None
+        self._icons: Dict[Tuple[str, str], ColoredIcon] = {}
+
+    def _get_base_icon(self) -> ColoredIcon:
+        if self._base_icon is None:
+            path = (
+                ":/icons/flag.svg" if pointVersion() < 55 else "icons:flag-variant.svg"
+            )
+            if hasattr(colors, "FG_DISABLED"):
+                color = colors.FG_DISABLED
+            else:
+                color = colors.DISABLED  # type: ignore[attr-defined] # pylint: disable=no-member
+            self._base_icon = ColoredIcon(
+                path=path,
+                color=color,
+            )
+        return self._base_icon
+
+    def get(self, color_light: str, color_dark: str) -> ColoredIcon:
+        key = (color_light, color_dark)
+        icon = self._icons.get(key)
+        if icon is None:
+            # NOTE: Format changed to dict in 2.1.55: https://github.com/ankitects/anki/commit/0c340c4f741c89bcc80f987ee236d506de6a1ad2
+            color = (
+                key
+                if pointVersion() < 55
+                else {"light": color_light, "dark": color_dark}
+            )
+            icon = self._icons[key] = self._get_base_icon().with_color(color)  # type: ignore[arg-type]
+        return icon
+
+    def clear(self) -> None:
+        self._icons.clear()
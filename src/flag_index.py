@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional, Sequence
+
+from anki.cards import CardId
+from anki.collection import Collection
+from anki.utils import ids2str
+
+from .custom_data import (
+    CUSTOM_DATA_KEY,
+    FlagChange,
+    custom_flags_from_card_data,
+    flags_in_mask,
+)
+
+SCHEMA = """
+-- Replaced by card_flags, which can hold multiple flags per card
+drop table if exists flags;
+create table if not exists card_flags (
+    flag integer not null,
+    cid integer not null,
+    primary key (flag, cid)
+) without rowid;
+create index if not exists ix_card_flags_cid on card_flags (cid);
+create table if not exists meta (
+    key text primary key,
+    value integer not null
+);
+"""
+
+
+class FlagIndex:
+    """A sidecar SQLite database mapping card ids to custom flags.
+
+    In multi-flag mode, a card has a row for each of its flags. It's used to resolve custom flag searches on Anki versions that can't search
+    custom data, and to build filtered decks from custom flags. The index is updated
+    by the add-on's write paths, and rebuilt from the collection when it may have
+    diverged from it (after undo, sync, or when the collection was modified while
+    the index was closed).
+    """
+
+    def __init__(self, is_multi: Callable[[], bool]) -> None:
+        self.path: Optional[Path] = None
+        self._db: Optional[sqlite3.Connection] = None
+        self._stale = True
+        self._is_multi = is_multi
+        # The mode the index was built in
+        self._multi = False
+        # Write paths may notify us from a background thread
+        self._lock = threading.Lock()
+
+    def open(self, path: Path) -> None:
+        self.close()
+        self.path = path
+
+    def close(self, col: Optional[Collection] = None) -> None:
+        """Close the index, recording the collection's modification time if given.
+
+        If the collection is unchanged when the index is opened again, it won't need
+        a rebuild.
+        """
+        with self._lock:
+            if not self._db:
+                return
+            if col and not self._stale:
+                self._db.executemany(
+                    "insert or replace into meta values (?, ?)",
+                    (("col_mod", col.mod), ("multi", int(self._multi))),
+                )
+                self._db.commit()
+            self._db.close()
+            self._db = None
+            self._stale = True
+
+    def mark_stale(self) -> None:
+        self._stale = True
+
+    def _connect(self, col: Collection) -> sqlite3.Connection:
+        assert self.path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.executescript(SCHEMA)
+        meta = dict(db.execute("select key, value from meta"))
+        self._stale = meta.get("col_mod") != col.mod
+        self._multi = bool(meta.get("multi"))
+        # Invalidate the stored time until the index is closed cleanly again
+        db.execute("delete from meta where key = 'col_mod'")
+        db.commit()
+        return db
+
+    def _rebuild(self, db: sqlite3.Connection, col: Collection, multi: bool) -> None:
+        db.execute("delete from card_flags")
+        db.executemany(
+            "insert into card_flags values (?, ?)",
+            (
+                (flag, cid)
+                for cid, data in col.db.execute(
+                    "select id, data from cards where data like ?",
+                    f"%{CUSTOM_DATA_KEY}%",
+                )
+                for flag in custom_flags_from_card_data(data, multi)
+            ),
+        )
+        db.commit()
+
+    def ensure_fresh(self, col: Collection) -> None:
+        with self._lock:
+            if not self._db:
+                self._db = self._connect(col)
+            multi = self._is_multi()
+            if self._stale or multi != self._multi:
+                self._rebuild(self._db, col, multi)
+                self._stale = False
+                self._multi = multi
+
+    def _changed_flags(self, change: FlagChange) -> List[int]:
+        if self._multi:
+            return flags_in_mask(change.new_mask)
+        return [change.new] if change.new else []
+
+    def apply_changes(self, changes: Sequence[FlagChange]) -> None:
+        with self._lock:
+            # A stale or unopened index will be rebuilt before use anyway
+            if not self._db or self._stale:
+                return
+            self._db.execute(
+                "delete from card_flags where cid in "
+                + ids2str(change.cid for change in changes)
+            )
+            self._db.executemany(
+                "insert or replace into card_flags values (?, ?)",
+                (
+                    (flag, change.cid)
+                    for change in changes
+                    for flag in self._changed_flags(change)
+                ),
+            )
+            self._db.commit()
+
+    def card_ids(self, col: Collection, flags: Iterable[int]) -> List[CardId]:
+        """Return the ids of cards that have any of the given custom flags."""
+        self.ensure_fresh(col)
+        with self._lock:
+            assert self._db
+            return [
+                CardId(row[0])
+                for row in self._db.execute(
+                    "select distinct cid from card_flags where flag in "
+                    f"{ids2str(flags)} order by cid"
+                )
+            ]
@@ -1,19 +1,27 @@
-from typing import Optional, cast
+import dataclasses
+import functools
+from typing import Any, Callable, Dict, List, Optional, cast
 
 import webcolors
+from aqt import mw
 from aqt.qt import *
-from aqt.utils import askUser, showInfo
+from aqt.utils import askUser, showWarning
 
 from ..config import CustomFlag, config
 from ..consts import consts
+from ..custom_data import MAX_MULTI_FLAGS
 from ..forms.config import Ui_Dialog
 from ..gui.dialog import Dialog
+from ..gui.operations import migrate_to_flag_masks_op, remap_custom_flags_op
+from ..gui.profiling import ProfilingDialog
+from ..profiling import profiler
 
 
 def qcolor_to_hex(color: QColor) -> str:
     return color.name(QColor.NameFormat.HexRgb)
 
 
+@functools.lru_cache(maxsize=None)
 def color_string_to_qcolor(color: str) -> QColor:
     c = webcolors.html5_parse_legacy_color(color)
     qcolor = QColor(c.red, c.green, c.blue)
@@ -21,32 +29,14 @@ def color_string_to_qcolor(color: str) -> QColor:
     return qcolor
 
 
-class FlagColorButton(QPushButton):
-    color_changed = pyqtSignal()
-
-    def __init__(self, parent: QWidget, color: str = ""):
-        super().__init__(parent)
-        self.color = color_string_to_qcolor(color)
-        self.setFlat(True)
-        qconnect(self.clicked, self.on_clicked)
-        self.update_color()
-
-    def update_color(self) -> None:
-        self.setStyleSheet(
-            "FlagColorButton { background-color: %s }" % qcolor_to_hex(self.color)
-        )
-
-    def on_clicked(self) -> None:
-        new_color = QColorDialog.getColor(
-            self.color, self, f"{consts.name} - Select Color"
-        )
-        if new_color.isValid():
-            self.color = new_color
-            self.color_changed.emit()
-        self.update_color()
+@functools.lru_cache(maxsize=None)
+def clear_icon() -> QIcon:
+    return QIcon(str(consts.dir / "icons" / "x.svg"))
 
 
 class FlagShortcutWidget(QWidget):
+    """Shortcut editor used by `ShortcutDelegate` while a shortcut cell is being edited."""
+
     keySequenceChanged = pyqtSignal()
 
     def __init__(self, parent: QWidget, shortcut: Optional[str] = None) -> None:
@@ -64,27 +54,203 @@ class FlagShortcutWidget(QWidget):
         )
         hbox.addWidget(sequence_edit)
         clear_button = QPushButton(self)
-        clear_button.setIcon(QIcon(str(consts.dir / "icons" / "x.svg")))
+        clear_button.setIcon(clear_icon())
         clear_button.setMaximumSize(16, 16)
         qconnect(clear_button.clicked, sequence_edit.clear)
         hbox.addWidget(clear_button)
         hbox.setContentsMargins(2, 0, 2, 0)
         self.setLayout(hbox)
+        self.setFocusProxy(sequence_edit)
 
     def keySequence(self) -> QKeySequence:
         return self.sequence_edit.keySequence()
 
 
-class FlagListWidget(QTableWidget):
-    HEADER_LABELS = ["Label", "Light Color", "Dark Color", "Shortcut"]
+@dataclasses.dataclass
+class FlagRow:
+    flag: CustomFlag
+    # The index the flag had when the dialog was opened, or None if it's new.
+    # Used to update cards' flags when flags are deleted or reordered.
+    original_index: Optional[int]
+
+
+class FlagListModel(QAbstractTableModel):
+    """The custom flags being edited in the config dialog.
+
+    Flags are kept as plain data and painted by delegates, so opening the dialog
+    doesn't create any widgets per flag; an editor widget only exists while a cell
+    is being edited.
+    """
+
+    HEADER_LABELS = ["Label", "Light Color", "Dark Color", "Shortcut", "Group"]
+    (
+        LABEL_COLUMN,
+        LIGHT_COLOR_COLUMN,
+        DARK_COLOR_COLUMN,
+        SHORTCUT_COLUMN,
+        GROUP_COLUMN,
+    ) = range(5)
+    COLOR_COLUMNS = (LIGHT_COLOR_COLUMN, DARK_COLOR_COLUMN)
+    FIELDS = ["label", "color_light", "color_dark", "shortcut", "group"]
+
+    def __init__(self, parent: QObject, flags: List[CustomFlag]) -> None:
+        super().__init__(parent)
+        self.rows = [FlagRow(flag, i) for i, flag in enumerate(flags, start=1)]
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.HEADER_LABELS)
+
+    def headerData(
+        self,
+        section: int,
+        orientation: Qt.Orientation,
+        role: int = Qt.ItemDataRole.DisplayRole,
+    ) -> Any:
+        if (
+            orientation == Qt.Orientation.Horizontal
+            and role == Qt.ItemDataRole.DisplayRole
+        ):
+            return self.HEADER_LABELS[section]
+        return None
+
+    def flags(self, index: QModelIndex) -> Qt.ItemFlag:
+        flags = super().flags(index)
+        if index.column() not in self.COLOR_COLUMNS:
+            flags |= Qt.ItemFlag.ItemIsEditable
+        return flags
+
+    def data(self, index: QModelIndex, role: int = Qt.ItemDataRole.DisplayRole) -> Any:
+        if not index.isValid():
+            return None
+        value = getattr(self.rows[index.row()].flag, self.FIELDS[index.column()])
+        if role in (Qt.ItemDataRole.DisplayRole, Qt.ItemDataRole.EditRole):
+            return value or ""
+        return None
+
+    def setData(
+        self, index: QModelIndex, value: Any, role: int = Qt.ItemDataRole.EditRole
+    ) -> bool:
+        if not index.isValid() or role != Qt.ItemDataRole.EditRole:
+            return False
+        row = self.rows[index.row()]
+        field = self.FIELDS[index.column()]
+        if index.column() in (self.SHORTCUT_COLUMN, self.GROUP_COLUMN):
+            value = value.strip() or None
+        if getattr(row.flag, field) == value:
+            return False
+        row.flag = dataclasses.replace(row.flag, **{field: value})
+        self.dataChanged.emit(index, index)
+        return True
+
+    def flag_at(self, i: int) -> CustomFlag:
+        flag = self.rows[i].flag
+        return dataclasses.replace(
+            flag,
+            color_light=qcolor_to_hex(color_string_to_qcolor(flag.color_light)),
+            color_dark=qcolor_to_hex(color_string_to_qcolor(flag.color_dark)),
+        )
+
+    def original_index(self, i: int) -> Optional[int]:
+        """The index the flag in row `i` had when the dialog was opened, or None if it's new."""
+        return self.rows[i].original_index
+
+    def add_flag(self, flag: CustomFlag) -> None:
+        self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows))
+        self.rows.append(FlagRow(flag, None))
+        self.endInsertRows()
+
+    def remove_row(self, i: int) -> None:
+        self.beginRemoveRows(QModelIndex(), i, i)
+        del self.rows[i]
+        self.endRemoveRows()
+
+    def swap_rows(self, first: int, second: int) -> None:
+        self.rows[first], self.rows[second] = self.rows[second], self.rows[first]
+        for row in (first, second):
+            self.dataChanged.emit(
+                self.index(row, 0), self.index(row, self.columnCount() - 1)
+            )
+
+
+class ColorDelegate(QStyledItemDelegate):
+    """Paints color cells as swatches and opens a color dialog when one is clicked."""
+
+    def paint(
+        self, painter: QPainter, option: QStyleOptionViewItem, index: QModelIndex
+    ) -> None:
+        super().paint(painter, option, index)
+        color = color_string_to_qcolor(index.data())
+        painter.fillRect(option.rect.adjusted(3, 3, -3, -3), color)
+
+    def initStyleOption(self, option: QStyleOptionViewItem, index: QModelIndex) -> None:
+        super().initStyleOption(option, index)
+        option.text = ""
+
+    def editorEvent(
+        self,
+        event: QEvent,
+        model: QAbstractItemModel,
+        option: QStyleOptionViewItem,
+        index: QModelIndex,
+    ) -> bool:
+        if (
+            event.type() != QEvent.Type.MouseButtonRelease
+            or cast(QMouseEvent, event).button() != Qt.MouseButton.LeftButton
+        ):
+            return False
+        new_color = QColorDialog.getColor(
+            color_string_to_qcolor(index.data()),
+            cast(QWidget, self.parent()),
+            f"{consts.name} - Select Color",
+        )
+        if new_color.isValid():
+            model.setData(index, qcolor_to_hex(new_color))
+        return True
+
+
+class ShortcutDelegate(QStyledItemDelegate):
+    """Edits shortcut cells with a `FlagShortcutWidget`, created only while editing."""
+
+    def createEditor(
+        self, parent: QWidget, option: QStyleOptionViewItem, index: QModelIndex
+    ) -> QWidget:
+        return FlagShortcutWidget(parent)
+
+    def setEditorData(self, editor: QWidget, index: QModelIndex) -> None:
+        cast(FlagShortcutWidget, editor).sequence_edit.setKeySequence(
+            QKeySequence(index.data())
+        )
+
+    def setModelData(
+        self, editor: QWidget, model: QAbstractItemModel, index: QModelIndex
+    ) -> None:
+        model.setData(index, cast(FlagShortcutWidget, editor).keySequence().toString())
 
-    def __init__(self, parent: QWidget) -> None:
+
+class FlagListView(QTableView):
+    def __init__(self, parent: QWidget, model: FlagListModel) -> None:
         super().__init__(parent)
-        self.setColumnCount(len(self.HEADER_LABELS))
-        self.setHorizontalHeaderLabels(self.HEADER_LABELS)
-        self.setRowCount(len(config.flags))
+        self.setModel(model)
         self.verticalHeader().hide()
         self.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Stretch)
+        self.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection)
+        self.setEditTriggers(
+            QAbstractItemView.EditTrigger.DoubleClicked
+            | QAbstractItemView.EditTrigger.SelectedClicked
+            | QAbstractItemView.EditTrigger.EditKeyPressed
+        )
+        # Delegates are owned by the view, as it doesn't take ownership of them
+        self.color_delegate = ColorDelegate(self)
+        self.shortcut_delegate = ShortcutDelegate(self)
+        for column in FlagListModel.COLOR_COLUMNS:
+            self.setItemDelegateForColumn(column, self.color_delegate)
+        self.setItemDelegateForColumn(
+            FlagListModel.SHORTCUT_COLUMN, self.shortcut_delegate
+        )
         self.setStyleSheet(
             """
 QTableView {
@@ -98,50 +264,14 @@ QTableView::item {
 }
 """
         )
-        for i, flag in enumerate(config.flags):
-            self.new_flag(i, flag)
-
-    def new_flag(self, i: int, flag: CustomFlag) -> None:
-        label_item = QTableWidgetItem(flag.label)
-        self.setItem(i, 0, label_item)
-
-        light_color_widget = FlagColorButton(self, flag.color_light)
-        light_color_item = QTableWidgetItem()
-        light_color_item.setFlags(
-            light_color_item.flags() & ~Qt.ItemFlag.ItemIsEditable
-        )
-        self.setItem(i, 1, light_color_item)
-        qconnect(
-            light_color_widget.color_changed,
-            lambda: self.itemChanged.emit(None),
-        )
-        self.setCellWidget(i, 1, light_color_widget)
-
-        dark_color_widget = FlagColorButton(self, flag.color_dark)
-        dark_color_item = QTableWidgetItem()
-        dark_color_item.setFlags(dark_color_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
-        self.setItem(i, 2, dark_color_item)
-        qconnect(
-            dark_color_widget.color_changed,
-            lambda: self.itemChanged.emit(None),
-        )
-        self.setCellWidget(i, 2, dark_color_widget)
-
-        shortcut_widget = FlagShortcutWidget(self, flag.shortcut)
-        shortcut_item = QTableWidgetItem()
-        shortcut_item.setFlags(shortcut_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
-        self.setItem(i, 2, shortcut_item)
-        qconnect(
-            shortcut_widget.keySequenceChanged,
-            lambda: self.itemChanged.emit(None),
-        )
-        self.setCellWidget(i, 3, shortcut_widget)
-        self.setRowHeight(i, 40)
 
 
 class ConfigDialog(Dialog):
-    def __init__(self, parent: QWidget):
+    def __init__(
+        self, parent: QWidget, on_save: Optional[Callable[[], None]] = None
+    ) -> None:
         self.dirty = False
+        self.on_save_callback = on_save
         super().__init__(parent)
 
     def setup_ui(self) -> None:
@@ -150,54 +280,110 @@ class ConfigDialog(Dialog):
         self.setWindowTitle(f"{consts.name} - Config")
         self.setMinimumSize(600, 500)
         self.setContentsMargins(0, 0, 0, 0)
-        self.flag_list = FlagListWidget(self)
+        self.flag_model = FlagListModel(self, config.flags)
+        self.flag_list = FlagListView(self, self.flag_model)
         self.form.flag_list_container.addWidget(self.flag_list)
         self.form.show_flag_labels.setChecked(config["show_flag_labels"])
+        self.form.multi_flags.setChecked(config["multi_flags"])
+        self.form.profiling.setChecked(config["profiling"])
         qconnect(self.form.save_button.clicked, self.on_save)
         qconnect(self.form.new_button.clicked, self.on_new)
         qconnect(self.form.delete_button.clicked, self.on_delete)
-        qconnect(self.flag_list.itemChanged, self.on_item_changed)
+        qconnect(self.form.move_up_button.clicked, lambda: self.on_move(-1))
+        qconnect(self.form.move_down_button.clicked, lambda: self.on_move(1))
+        qconnect(self.form.profiling_button.clicked, self.on_profiling_stats)
+        qconnect(self.flag_model.dataChanged, self.on_changed)
         super().setup_ui()
 
-    def on_item_changed(self, item: Optional[QTableWidgetItem] = None) -> None:
+    def on_changed(self) -> None:
         self.dirty = True
 
-    def save(self) -> None:
-        new_flags = []
-        for i in range(self.flag_list.rowCount()):
-            label = self.flag_list.item(i, 0).text()
-            color_light_widget = cast(FlagColorButton, self.flag_list.cellWidget(i, 1))
-            color_light = qcolor_to_hex(color_light_widget.color)
-            color_dark_widget = cast(FlagColorButton, self.flag_list.cellWidget(i, 2))
-            color_dark = qcolor_to_hex(color_dark_widget.color)
-            shortcut_widget = cast(FlagShortcutWidget, self.flag_list.cellWidget(i, 3))
-            shortcut = shortcut_widget.keySequence().toString()
-
-            new_flags.append(CustomFlag(label, color_light, color_dark, shortcut))
-
-        config.flags = new_flags
-        config["show_flag_labels"] = self.form.show_flag_labels.isChecked()
-        showInfo(
-            "Changes will take effect when you restart Anki.", self, title=consts.name
+    def flag_remapping(self) -> Dict[int, int]:
+        """Map the original indices of moved or deleted flags to their new ones (0 if deleted)."""
+        mapping = {}
+        kept = set()
+        for i in range(self.flag_model.rowCount()):
+            original_index = self.flag_model.original_index(i)
+            if original_index is None:
+                continue
+            kept.add(original_index)
+            if original_index != i + 1:
+                mapping[original_index] = i + 1
+        for original_index in range(1, len(config.registry) + 1):
+            if original_index not in kept:
+                mapping[original_index] = 0
+        return mapping
+
+    def save(self) -> bool:
+        """Save the config, returning False if the user backed out of updating the cards."""
+        if (
+            self.form.multi_flags.isChecked()
+            and self.flag_model.rowCount() > MAX_MULTI_FLAGS
+        ):
+            showWarning(
+                f"Multi-flag mode supports up to {MAX_MULTI_FLAGS} custom flags.",
+                self,
+                title=consts.name,
+            )
+            return False
+        mapping = self.flag_remapping()
+        enable_multi_flags = (
+            self.form.multi_flags.isChecked() and not config["multi_flags"]
         )
+        if (
+            (mapping or enable_multi_flags)
+            and mw.col
+            and not askUser(
+                "Saving will update the flags of your cards. This can't be undone, "
+                "and will clear the undo history. Continue?",
+                self,
+                title=consts.name,
+            )
+        ):
+            return False
+        config.flags = [
+            self.flag_model.flag_at(i) for i in range(self.flag_model.rowCount())
+        ]
+        config["show_flag_labels"] = self.form.show_flag_labels.isChecked()
+        config["multi_flags"] = self.form.multi_flags.isChecked()
+        config["profiling"] = profiler.enabled = self.form.profiling.isChecked()
+        self.dirty = False
+        if mapping and mw.col:
+            remap_custom_flags_op(mw, mapping)
+        if enable_multi_flags and mw.col:
+            migrate_to_flag_masks_op(mw)
+        if self.on_save_callback:
+            self.on_save_callback()
+        return True
 
     def on_save(self) -> None:
-        self.save()
-        self.accept()
+        if self.save():
+            self.accept()
 
     def on_new(self) -> None:
-        self.flag_list.insertRow(self.flag_list.rowCount())
-        self.flag_list.new_flag(
-            self.flag_list.rowCount() - 1, CustomFlag("My Flag", "#ffd800", "#ffee75")
-        )
+        self.flag_model.add_flag(CustomFlag("My Flag", "#ffd800", "#ffee75"))
+        self.flag_list.scrollToBottom()
         self.dirty = True
 
     def on_delete(self) -> None:
         if self.flag_list.selectedIndexes():
             last_index = self.flag_list.selectedIndexes()[-1]
-            self.flag_list.removeRow(last_index.row())
+            self.flag_model.remove_row(last_index.row())
             self.dirty = True
 
+    def on_move(self, offset: int) -> None:
+        current = self.flag_list.currentIndex()
+        row = current.row() if current.isValid() else -1
+        new_row = row + offset
+        if row < 0 or not 0 <= new_row < self.flag_model.rowCount():
+            return
+        self.flag_model.swap_rows(row, new_row)
+        self.flag_list.setCurrentIndex(self.flag_model.index(new_row, current.column()))
+        self.dirty = True
+
+    def on_profiling_stats(self) -> None:
+        ProfilingDialog(self).show()
+
     def keyPressEvent(self, event: QKeyEvent) -> None:
         if event.key() == Qt.Key.Key_Escape:
             self.close()
@@ -206,6 +392,7 @@ class ConfigDialog(Dialog):
 
     def closeEvent(self, event: QCloseEvent) -> None:
         if self.dirty:
-            if askUser("Save changes?", self, title=consts.name):
-                self.save()
+            if askUser("Save changes?", self, title=consts.name) and not self.save():
+                event.ignore()
+                return None
         return super().closeEvent(event)
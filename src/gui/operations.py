@@ -0,0 +1,133 @@
+from pathlib import Path
+from typing import Dict, List, Mapping
+
+from aqt import mw
+from aqt.operations import CollectionOp, QueryOp
+from aqt.qt import QFileDialog, QWidget
+from aqt.utils import getFile, tooltip, tr
+
+from ..bulk import BulkFlagResult, migrate_to_flag_masks, remap_custom_flags
+from ..consts import consts
+from ..log import logger
+from ..transfer import export_custom_flags, import_custom_flags
+
+
+def update_bulk_progress(processed: int, total: int) -> bool:
+    """Progress callback for bulk operations running in the background.
+
+    Returns False if the user asked to cancel.
+    """
+    mw.taskman.run_on_main(
+        lambda: mw.progress.update(
+            label=f"Updating cards... {processed}/{total}",
+            value=processed,
+            max=total,
+        )
+    )
+    return not mw.progress.want_cancel()
+
+
+def log_bulk_result(action: str, result: BulkFlagResult) -> None:
+    logger.info(
+        "%s: updated %d of %d cards in %.2fs (%.0f cards/s, peak memory: %s)%s",
+        action,
+        result.count,
+        result.processed,
+        result.elapsed,
+        result.cards_per_second,
+        f"{result.peak_memory} bytes" if result.peak_memory is not None else "n/a",
+        " [cancelled]" if result.cancelled else "",
+    )
+
+
+def remap_custom_flags_op(parent: QWidget, mapping: Dict[int, int]) -> None:
+    """Update custom flags of cards in the background after flags were reordered or deleted."""
+
+    def on_success(result: BulkFlagResult) -> None:
+        log_bulk_result("Remap custom flags", result)
+        if result.count:
+            tooltip(tr.browsing_cards_updated(count=result.count), parent=parent)
+
+    CollectionOp(
+        parent,
+        lambda col: remap_custom_flags(col, mapping, on_progress=update_bulk_progress),
+    ).success(on_success).run_in_background()
+
+
+def migrate_to_flag_masks_op(parent: QWidget) -> None:
+    """Convert custom flags set in single-flag mode to bitmasks in the background."""
+
+    def on_success(result: BulkFlagResult) -> None:
+        log_bulk_result("Migrate custom flags", result)
+
+    CollectionOp(
+        parent,
+        lambda col: migrate_to_flag_masks(col, on_progress=update_bulk_progress),
+    ).success(on_success).run_in_background()
+
+
+def export_custom_flags_op(parent: QWidget, labels: List[str], multi: bool) -> None:
+    """Ask for a CSV or JSON Lines file and write the custom flags of all cards to it in the background."""
+    path, selected_filter = QFileDialog.getSaveFileName(
+        parent,
+        f"{consts.name} - Export Custom Flags",
+        "custom_flags.csv",
+        "CSV (*.csv);;JSON Lines (*.jsonl)",
+    )
+    if not path:
+        return
+    ext = ".jsonl" if "jsonl" in selected_filter else ".csv"
+    if Path(path).suffix.lower() not in (".csv", ".jsonl"):
+        path += ext
+
+    def on_progress(processed: int, total: int) -> bool:
+        mw.taskman.run_on_main(
+            lambda: mw.progress.update(
+                label=f"Exporting custom flags... {processed}/{total}",
+                value=processed,
+                max=total,
+            )
+        )
+        return not mw.progress.want_cancel()
+
+    def on_success(count: int) -> None:
+        if count >= 0:
+            tooltip(f"Exported custom flags of {count} cards", parent=parent)
+
+    QueryOp(
+        parent=parent,
+        op=lambda col: export_custom_flags(
+            col, Path(path), labels, on_progress=on_progress, multi=multi
+        ),
+        success=on_success,
+    ).with_progress("Exporting custom flags...").run_in_background()
+
+
+def import_custom_flags_op(
+    parent: QWidget, index_by_label: Mapping[str, int], multi: bool
+) -> None:
+    """Ask for a file written by the export and apply its custom flags in the background."""
+
+    def on_success(result: BulkFlagResult) -> None:
+        log_bulk_result("Import custom flags", result)
+        tooltip(tr.browsing_cards_updated(count=result.count), parent=parent)
+
+    def on_file(path: str) -> None:
+        CollectionOp(
+            parent,
+            lambda col: import_custom_flags(
+                col,
+                Path(path),
+                index_by_label,
+                on_progress=update_bulk_progress,
+                multi=multi,
+            ),
+        ).success(on_success).run_in_background()
+
+    getFile(
+        parent,
+        f"{consts.name} - Import Custom Flags",
+        on_file,  # type: ignore[arg-type]
+        filter="Custom Flags (*.csv *.jsonl)",
+        key="more_flags_transfer",
+    )
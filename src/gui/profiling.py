@@ -0,0 +1,90 @@
+from pathlib import Path
+
+from aqt.qt import *
+from aqt.utils import getSaveFile, tooltip
+
+from ..consts import consts
+from ..gui.dialog import Dialog
+from ..profiling import profiler
+
+
+class ProfilingDialog(Dialog):
+    """Shows the call counts and timings recorded by the profiler."""
+
+    COLUMNS = [
+        ("Function", "name"),
+        ("Calls", "count"),
+        ("Total (ms)", "total"),
+        ("p50 (ms)", "p50"),
+        ("p95 (ms)", "p95"),
+        ("Max (ms)", "max"),
+    ]
+
+    def setup_ui(self) -> None:
+        self.setWindowTitle(f"{consts.name} - Profiling Stats")
+        self.setMinimumSize(700, 400)
+        layout = QVBoxLayout(self)
+        if not profiler.enabled:
+            layout.addWidget(
+                QLabel(
+                    "Profiling is disabled. Enable it in the config to record stats."
+                )
+            )
+        self.table = QTableWidget(self)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table.setColumnCount(len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels([label for label, _ in self.COLUMNS])
+        self.table.verticalHeader().hide()
+        self.table.horizontalHeader().setSectionResizeMode(
+            QHeaderView.ResizeMode.ResizeToContents
+        )
+        layout.addWidget(self.table)
+        buttons = QDialogButtonBox(self)
+        refresh_button = buttons.addButton(
+            "Refresh", QDialogButtonBox.ButtonRole.ActionRole
+        )
+        qconnect(refresh_button.clicked, self.refresh)
+        reset_button = buttons.addButton("Reset", QDialogButtonBox.ButtonRole.ResetRole)
+        qconnect(reset_button.clicked, self.on_reset)
+        export_button = buttons.addButton(
+            "Export...", QDialogButtonBox.ButtonRole.ActionRole
+        )
+        qconnect(export_button.clicked, self.on_export)
+        close_button = buttons.addButton(QDialogButtonBox.StandardButton.Close)
+        qconnect(close_button.clicked, self.close)
+        layout.addWidget(buttons)
+        self.refresh()
+        super().setup_ui()
+
+    def refresh(self) -> None:
+        rows = profiler.summary()
+        self.table.setRowCount(len(rows))
+        for i, row in enumerate(rows):
+            for column, (_, key) in enumerate(self.COLUMNS):
+                value = row[key]
+                if isinstance(value, float):
+                    item = QTableWidgetItem(f"{value:.2f}")
+                else:
+                    item = QTableWidgetItem(str(value))
+                if column:
+                    item.setTextAlignment(
+                        Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter
+                    )
+                self.table.setItem(i, column, item)
+
+    def on_reset(self) -> None:
+        profiler.reset()
+        self.refresh()
+
+    def on_export(self) -> None:
+        path = getSaveFile(
+            self,
+            f"{consts.name} - Export Profiling Stats",
+            "more_flags_profiling",
+            "JSON",
+            ".json",
+            "more_flags_profiling.json",
+        )
+        if path:
+            profiler.export(Path(path))
+            tooltip("Exported profiling stats", parent=self)
@@ -0,0 +1,72 @@
+from typing import Dict, List, Tuple
+
+from anki.decks import DeckId
+from aqt import mw
+from aqt.flags import Flag
+from aqt.qt import *
+
+from ..consts import consts
+from ..gui.dialog import Dialog
+
+
+class FlagStatsDialog(Dialog):
+    """Shows the number of cards of each flag per deck."""
+
+    def __init__(
+        self,
+        parent: QWidget,
+        flags: List[Flag],
+        original_flags_count: int,
+        deck_counts: Dict[DeckId, Tuple[Dict[int, int], Dict[int, int]]],
+    ) -> None:
+        self.flags = flags
+        self.original_flags_count = original_flags_count
+        self.deck_counts = deck_counts
+        super().__init__(parent)
+
+    def setup_ui(self) -> None:
+        self.setWindowTitle(f"{consts.name} - Flag Statistics")
+        self.setMinimumSize(600, 400)
+        layout = QVBoxLayout(self)
+        self.table = QTableWidget(self)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table.setColumnCount(len(self.flags) + 1)
+        self.table.setHorizontalHeaderLabels(
+            ["Deck"] + [flag.label for flag in self.flags]
+        )
+        self.table.verticalHeader().hide()
+        self.table.horizontalHeader().setSectionResizeMode(
+            QHeaderView.ResizeMode.ResizeToContents
+        )
+        rows = sorted(
+            (
+                (mw.col.decks.name(did), counts)
+                for did, counts in self.deck_counts.items()
+            ),
+            key=lambda row: row[0],
+        )
+        totals: Tuple[Dict[int, int], Dict[int, int]] = ({}, {})
+        for _, deck_counts in rows:
+            for total, flag_counts in zip(totals, deck_counts):
+                for flag, count in flag_counts.items():
+                    total[flag] = total.get(flag, 0) + count
+        self.table.setRowCount(len(rows) + 1)
+        self.add_row(0, "All Decks", totals)
+        for i, (name, counts) in enumerate(rows, start=1):
+            self.add_row(i, name, counts)
+        layout.addWidget(self.table)
+        super().setup_ui()
+
+    def add_row(
+        self, row: int, name: str, counts: Tuple[Dict[int, int], Dict[int, int]]
+    ) -> None:
+        user_flags, custom_flags = counts
+        self.table.setItem(row, 0, QTableWidgetItem(name))
+        for column, flag in enumerate(self.flags, start=1):
+            if flag.index <= self.original_flags_count:
+                count = user_flags.get(flag.index, 0)
+            else:
+                count = custom_flags.get(flag.index - self.original_flags_count, 0)
+            item = QTableWidgetItem(str(count))
+            item.setTextAlignment(Qt.AlignmentFlag.AlignCenter)
+            self.table.setItem(row, column, item)
@@ -0,0 +1,55 @@
+from typing import Callable, List, Sequence
+
+from aqt.qt import *
+
+from ..config import CustomFlag
+from ..consts import consts
+from ..gui.dialog import Dialog
+
+
+class StudyCustomFlagsDialog(Dialog):
+    """Asks for the custom flags to build a filtered deck from."""
+
+    def __init__(
+        self,
+        parent: QWidget,
+        flags: Sequence[CustomFlag],
+        on_accept: Callable[[List[int]], None],
+    ) -> None:
+        self.flags = flags
+        self.on_accept = on_accept
+        super().__init__(parent)
+
+    def setup_ui(self) -> None:
+        self.setWindowTitle(f"{consts.name} - Study Custom Flags")
+        self.setMinimumSize(300, 300)
+        layout = QVBoxLayout(self)
+        layout.addWidget(QLabel("Create a filtered deck with cards of these flags:"))
+        self.flag_list = QListWidget(self)
+        for flag in self.flags:
+            item = QListWidgetItem(flag.label, self.flag_list)
+            item.setFlags(item.flags() | Qt.ItemFlag.ItemIsUserCheckable)
+            item.setCheckState(Qt.CheckState.Unchecked)
+        layout.addWidget(self.flag_list)
+        buttons = QDialogButtonBox(
+            QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel,
+            self,
+        )
+        qconnect(buttons.accepted, self.accept)
+        qconnect(buttons.rejected, self.reject)
+        layout.addWidget(buttons)
+        super().setup_ui()
+
+    def selected_flags(self) -> List[int]:
+        return [
+            i
+            for i in range(1, self.flag_list.count() + 1)
+            if self.flag_list.item(i - 1).checkState() == Qt.CheckState.Checked
+        ]
+
+    def accept(self) -> None:
+        flags = self.selected_flags()
+        if not flags:
+            return
+        super().accept()
+        self.on_accept(flags)
@@ -1,23 +1,49 @@
+import dataclasses
+import functools
 import json
 import os
+import re
 import sys
-from typing import Any, Dict, Optional, Sequence, Tuple, Union, cast
+from typing import (
+    Any,
+    Dict,
+    List,
+    Literal,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+    cast,
+)
 
 from anki.cards import Card, CardId
-from anki.collection import Collection, OpChanges, OpChangesWithCount, SearchNode
+from anki.collection import (
+    BrowserColumns,
+    Collection,
+    OpChanges,
+    OpChangesWithCount,
+    OpChangesWithId,
+    SearchNode,
+)
+from anki.decks import DeckId
 from anki.hooks import wrap
 from anki.utils import pointVersion
-from aqt import colors, gui_hooks, mw
+from aqt import dialogs, gui_hooks, mw
 from aqt.browser import (
     Browser,
     CellRow,
     ItemId,
+    SearchContext,
     SidebarItem,
     SidebarItemType,
+    SidebarModel,
     SidebarTreeView,
 )
 from aqt.flags import Flag, FlagManager
-from aqt.operations import CollectionOp
+from aqt.operations import CollectionOp, QueryOp
+from aqt.overview import Overview
 from aqt.qt import *
 from aqt.reviewer import Reviewer
 from aqt.theme import ColoredIcon
@@ -36,15 +62,47 @@ except ImportError:
         return color
 
 
+from .bulk import (
+    BulkFlagResult,
+    cards_with_custom_flag,
+    clear_custom_flags,
+    set_custom_flag_for_cards,
+    toggle_custom_flag_bit_for_cards,
+)
 from .config import CustomFlag, config
-from .gui.config import ConfigDialog
+from .consts import consts
+from .custom_data import (
+    CUSTOM_DATA_KEY,
+    MAX_MULTI_FLAGS,
+    apply_card_custom_flag,
+    apply_card_custom_flag_mask,
+    custom_flags_did_change,
+    fetch_note_custom_flags,
+    flag_bit,
+    flag_bit_search,
+    flags_in_mask,
+    get_card_custom_flag,
+    get_card_custom_flag_mask,
+    supports_custom_data_prop_search,
+)
+from .flag_icons import FlagIconCache
+from .flag_index import FlagIndex
+from .gui.operations import (
+    export_custom_flags_op,
+    import_custom_flags_op,
+    log_bulk_result,
+    update_bulk_progress,
+)
+from .log import logger
+from .profiling import profiler
+from .row_colors import RowColor, RowColorProvider
+from .stats import FlagCounts, user_flag_changes
+from .study import MAX_FILTERED_DECK_CARDS, build_filtered_deck, study_deck_flags
+from .stylesheet import CachedStylesheet
+from .transfer import IMPORT_CUSTOM_FLAGS_LABEL
+from .write_buffer import FlagWriteBuffer
 
 original_flags_count = 0
-CUSTOM_DATA_KEY = "cf"
-
-
-def supports_custom_data_prop_search() -> bool:
-    return pointVersion() >= 64
 
 
 def anki_color_for_custom_flag(flag: CustomFlag) -> Dict[str, str]:
@@ -60,31 +118,57 @@ def anki_color_for_custom_flag(flag: CustomFlag) -> Dict[str, str]:
 def load_custom_flags(self: FlagManager) -> None:
     global original_flags_count
     original_flags_count = len(self._flags)
-    path = ":/icons/flag.svg" if pointVersion() < 55 else "icons:flag-variant.svg"
-    if hasattr(colors, "FG_DISABLED"):
-        color = colors.FG_DISABLED
-    else:
-        color = colors.DISABLED  # type: ignore[attr-defined] # pylint: disable=no-member
-    icon = ColoredIcon(
-        path=path,
-        color=color,
-    )
+    append_custom_flags(self)
+
+
+class CustomFlagEntry(Flag):
+    """A custom flag whose icon is only created when it's first rendered."""
+
+    def __init__(
+        self,
+        index: int,
+        label: str,
+        flag: CustomFlag,
+        search_node: SearchNode,
+        action: str,
+    ) -> None:
+        self.colors = (flag.color_light, flag.color_dark)
+        super().__init__(index, label, None, search_node, action)
+
+    @property
+    def icon(self) -> ColoredIcon:
+        return flag_icons.get(*self.colors)
+
+    @icon.setter
+    def icon(self, icon: ColoredIcon) -> None:
+        pass
+
+
+flag_icons = FlagIconCache()
+
 
+def custom_flag_search_text(flag_idx: int) -> str:
+    """The search text of a custom flag, which is passed to the backend as is if possible."""
+    if not supports_custom_data_prop_search():
+        return f"custom-flag:{flag_idx}"
+    if config["multi_flags"]:
+        return flag_bit_search(flag_idx, len(config.registry)) or (
+            f"custom-flag:{flag_idx}"
+        )
+    return f"prop:cdn:{CUSTOM_DATA_KEY}={flag_idx}"
+
+
+def append_custom_flags(self: FlagManager) -> None:
     for i, flag in enumerate(
-        config.flags,
+        config.registry.flags,
         start=1,
     ):
-        color_obj = anki_color_for_custom_flag(flag)
-        search_node = (
-            SearchNode(parsable_text=f"prop:cdn:{CUSTOM_DATA_KEY}={i}")
-            if supports_custom_data_prop_search()
-            else None
-        )
+        search_node = SearchNode(parsable_text=custom_flag_search_text(i))
         self._flags.append(
-            Flag(
+            CustomFlagEntry(
                 original_flags_count + i,
                 flag.label,
-                icon.with_color(color_obj),
+                flag,
                 search_node,
                 f"custom_flag_action_{i}",
             )
@@ -96,42 +180,195 @@ def rename_flag(self: FlagManager, flag_index: int, new_name: str, _old: Any) ->
         _old(self, flag_index, new_name)
         return
     new_flags = config.flags
-    new_flags[flag_index - original_flags_count - 1].label = new_name
+    idx = flag_index - original_flags_count - 1
+    new_flags[idx] = dataclasses.replace(new_flags[idx], label=new_name)
     config.flags = new_flags
     self.get_flag(flag_index).label = new_name
     gui_hooks.flag_label_did_change()
 
 
+def new_browser_flag_action(browser: Browser, i: int, flag: CustomFlag) -> QAction:
+    action = QAction(browser)
+    action.setCheckable(True)
+    action.setShortcut(flag.shortcut or f"Ctrl+{i+original_flags_count}")
+    setattr(browser.form, f"custom_flag_action_{i}", action)
+    return action
+
+
+def fill_browser_flag_group_menu(
+    browser: Browser, menu: QMenu, indices: Sequence[int]
+) -> None:
+    if not menu.isEmpty():
+        return
+    for i in indices:
+        menu.addAction(getattr(browser.form, f"custom_flag_action_{i}"))
+    qtMenuShortcutWorkaround(menu)
+
+
+def add_browser_flag_actions(browser: Browser, connect: bool) -> None:
+    """Add the custom flag actions to the browser's Flag menu.
+
+    Grouped flags go into submenus that are only filled when first opened. Anki
+    connects the flag actions itself when setting up the browser, so `connect` is
+    only needed for actions added afterwards.
+    """
+    menu = browser.form.menuFlag
+    # None when setting up the browser, meaning actions are appended
+    before = getattr(browser.form, "custom_flags_separator", None)
+    registry = config.registry
+    group_menus = []
+    for i, flag in enumerate(registry.flags, start=1):
+        action = new_browser_flag_action(browser, i, flag)
+        if connect:
+            index = original_flags_count + i
+            qconnect(
+                action.triggered,
+                lambda _, index=index: browser.set_flag_of_selected_cards(index),
+            )
+        if not flag.group:
+            menu.insertAction(before, action)
+            continue
+        # Submenus are filled when first opened, so make the shortcut work before that
+        browser.addAction(action)
+        if registry.groups[flag.group][0] == i:
+            # Place the group's submenu where its first flag is
+            group_menu = QMenu(flag.group, menu)
+            qconnect(
+                group_menu.aboutToShow,
+                functools.partial(
+                    fill_browser_flag_group_menu,
+                    browser,
+                    group_menu,
+                    registry.groups[flag.group],
+                ),
+            )
+            menu.insertMenu(before, group_menu)
+            group_menus.append(group_menu)
+    setattr(browser.form, "custom_flag_group_menus", group_menus)
+
+
+def remove_browser_flag_actions(browser: Browser) -> None:
+    menu = browser.form.menuFlag
+    i = 1
+    while action := getattr(browser.form, f"custom_flag_action_{i}", None):
+        menu.removeAction(action)
+        # Deleted later, so make sure its shortcut doesn't clash with the new actions'
+        browser.removeAction(action)
+        action.deleteLater()
+        delattr(browser.form, f"custom_flag_action_{i}")
+        i += 1
+    for group_menu in getattr(browser.form, "custom_flag_group_menus", []):
+        menu.removeAction(group_menu.menuAction())
+        group_menu.deleteLater()
+
+
 def setup_browser_menus(self: Browser) -> None:
     # Make sure flags are loaded
     mw.flags.all()
-    for i, flag in enumerate(config.flags, start=1):
-        action = QAction(self)
-        action.setCheckable(True)
-        shortcut = flag.shortcut or f"Ctrl+{i+original_flags_count}"
-        action.setShortcut(shortcut)
-        setattr(self.form, f"custom_flag_action_{i}", action)
-        self.form.menuFlag.addAction(action)
+    add_browser_flag_actions(self, connect=False)
+    setattr(self.form, "custom_flags_separator", self.form.menuFlag.addSeparator())
+    stats_action = self.form.menuFlag.addAction("Flag Statistics...")
+    qconnect(stats_action.triggered, lambda: show_flag_stats(self))
+    export_action = self.form.menuFlag.addAction("Export Custom Flags...")
+    qconnect(
+        export_action.triggered,
+        lambda: export_custom_flags_op(
+            self,
+            [flag.label for flag in config.registry.flags],
+            config["multi_flags"],
+        ),
+    )
+    import_action = self.form.menuFlag.addAction("Import Custom Flags...")
+    qconnect(
+        import_action.triggered,
+        lambda: import_custom_flags_op(
+            self, config.registry.index_by_label, config["multi_flags"]
+        ),
+    )
+    qconnect(self.form.menuFlag.aboutToShow, lambda: sync_browser_flags_menu(self))
+
+
+def reload_browser_flag_actions(browser: Browser) -> None:
+    """Replace the custom flag actions of an open browser to match the config."""
+    remove_browser_flag_actions(browser)
+    add_browser_flag_actions(browser, connect=True)
+    browser._update_flag_labels()
+    browser.sidebar.refresh()
+    browser.table.redraw_cells()
+
+
+def check_multi_flag(flag: int) -> bool:
+    """Whether `flag` can be toggled in multi-flag mode, telling the user if not."""
+    if flag <= MAX_MULTI_FLAGS:
+        return True
+    tooltip(
+        f"Only the first {MAX_MULTI_FLAGS} custom flags can be used in multi-flag mode"
+    )
+    return False
 
 
 def set_flag_on_current_card(self: Reviewer, desired_flag: int, _old: Any) -> None:
     if desired_flag <= original_flags_count:
+        if not config["multi_flags"]:
+            # Writing a pending custom flag would remove the built-in flag
+            flag_write_buffer.discard(self.card.id)
         _old(self, desired_flag)
         return
+    if config["multi_flags"]:
+        if not check_multi_flag(desired_flag - original_flags_count):
+            return
+        mask = get_card_custom_flag_mask(self.card) ^ flag_bit(
+            desired_flag - original_flags_count
+        )
+        set_card_custom_flag_mask(self.card, mask)
+        self._update_flag_icon()
+        return
     # Set our custom flag
     if get_card_custom_flag(self.card) + original_flags_count == desired_flag:
         flag = 0
     else:
         flag = desired_flag - original_flags_count
     set_card_custom_flag(self.card, flag)
-
-
-def on_webview_will_set_content(
-    web_content: WebContent, context: Optional[Any]
-) -> None:
-    if not isinstance(context, Reviewer):
-        return
-    flags = config.flags
+    # The write is deferred, so update the icon right away
+    self._update_flag_icon()
+
+
+# Installed once per reviewer page load, so drawing the flag of a card takes a single short eval
+FLAG_DRAW_JS = """
+<script>
+globalThis._moreFlagsLabels = %s;
+function _moreFlagsDraw(idx) {
+    _drawFlag(idx);
+    if (!_moreFlagsLabels) {
+        return;
+    }
+    let flagLabel = document.getElementById("flag-label");
+    if (!flagLabel) {
+        flagLabel = document.createElement("span");
+        flagLabel.id = "flag-label";
+        document.getElementById("_flag").insertAdjacentElement("beforeend", flagLabel);
+    }
+    flagLabel.textContent = _moreFlagsLabels[idx - 1] || "";
+}
+</script>
+"""
+
+
+def flag_labels_json() -> str:
+    if not config["show_flag_labels"]:
+        return "null"
+    # Labels end up in an inline <script>, which a "</script>" in a label would close
+    return json.dumps([flag.label for flag in mw.flags.all()]).replace("</", "<\\/")
+
+
+def on_flag_label_did_change() -> None:
+    if mw.state == "review" and mw.reviewer.card:
+        mw.reviewer.web.eval(f"globalThis._moreFlagsLabels = {flag_labels_json()};")
+        mw.reviewer._update_flag_icon()
+
+
+def flag_css() -> str:
+    flags = config.registry.flags
     light_colors = [flag.color_light for flag in flags]
     dark_colors = [flag.color_dark for flag in flags]
 
@@ -141,8 +378,7 @@ def on_webview_will_set_content(
             for i, c in enumerate(colors, start=original_flags_count + 1)
         )
 
-    web_content.body += """
-<style>
+    return """
     :root {{
         {light_colors}
     }}
@@ -155,87 +391,122 @@ def on_webview_will_set_content(
         color: #666;
         -webkit-text-stroke: initial;
     }}
-</style>
 """.format(
         light_colors=color_list_to_defs(light_colors),
         dark_colors=color_list_to_defs(dark_colors),
     )
 
 
-def get_card_custom_flag(card: Card) -> int:
-    data_prop_name = "data" if hasattr(card, "data") else "custom_data"
-    raw_data = getattr(card, data_prop_name)
-    card_data = json.loads(raw_data) if raw_data else {}
-    return int(card_data.get(CUSTOM_DATA_KEY, 0))
+flag_stylesheet = CachedStylesheet(
+    consts.dir / "user_files" / "web",
+    f"/_addons/{mw.addonManager.addonFromModule(__name__)}/user_files/web",
+    flag_css,
+    lambda: config.version,
+)
+
+
+def on_webview_will_set_content(
+    web_content: WebContent, context: Optional[Any]
+) -> None:
+    if not isinstance(context, Reviewer):
+        return
+    web_content.css.append(flag_stylesheet.url())
+    web_content.body += FLAG_DRAW_JS % flag_labels_json()
+
+
+def reload_reviewer_flags() -> None:
+    if mw.state != "review" or not mw.reviewer.card:
+        return
+    selector = f'link[href^="{flag_stylesheet.url_prefix}/"]'
+    mw.reviewer.web.eval(
+        f"document.querySelectorAll({json.dumps(selector)}).forEach("
+        f"(link) => link.href = {json.dumps(flag_stylesheet.url())});"
+    )
+    on_flag_label_did_change()
+    mw.clearStateShortcuts()
+    mw.setStateShortcuts(mw.reviewer._shortcutKeys())  # type: ignore[arg-type]
+
+
+flag_write_buffer = FlagWriteBuffer()
 
 
 def set_card_custom_flag(card: Card, flag: int, update: bool = True) -> None:
-    data_prop_name = "data" if hasattr(card, "data") else "custom_data"
-    raw_data = getattr(card, data_prop_name)
-    card_data = json.loads(raw_data) if raw_data else {}
-    if flag:
-        card_data[CUSTOM_DATA_KEY] = flag
-        card.flags = 0
-    elif CUSTOM_DATA_KEY in card_data:
-        del card_data[CUSTOM_DATA_KEY]
-    setattr(card, data_prop_name, json.dumps(card_data))
+    apply_card_custom_flag(card, flag)
     if update:
+        flag_write_buffer.add(card.id, flag)
+
+
+def set_card_custom_flag_mask(card: Card, mask: int) -> None:
+    apply_card_custom_flag_mask(card, mask)
+    flag_write_buffer.add_mask(card.id, mask)
 
-        def op(col: Collection) -> OpChanges:
-            changes = col.update_card(card)
-            # Avoid resetting reviewer
-            # TODO: find a way to avoid a reset on undo too
-            changes.study_queues = False
-            return changes
 
-        CollectionOp(mw, op).run_in_background()
+def on_reviewer_will_answer_card(
+    ease_tuple: Tuple[bool, Literal[1, 2, 3, 4]], reviewer: Reviewer, card: Card
+) -> Tuple[bool, Literal[1, 2, 3, 4]]:
+    flag_write_buffer.flush()
+    # The answer carries the custom data the card had when the question was shown,
+    # so make sure it includes flag changes made since then
+    v3 = getattr(reviewer, "_v3", None)
+    if v3 and hasattr(card, "custom_data"):
+        v3.states.current.custom_data = card.custom_data
+    return ease_tuple
 
 
 def update_flag_icon(self: Reviewer, _old: Any) -> None:
     flag = self.card.user_flag()
     if not flag:
         custom_flag_idx = get_card_custom_flag(self.card)
-        if custom_flag_idx and custom_flag_idx <= len(config.flags):
+        if custom_flag_idx and custom_flag_idx <= len(config.registry):
             custom_flag_idx += original_flags_count
             flag = custom_flag_idx
-    self.web.eval(f"_drawFlag({flag});")
-
-    if config["show_flag_labels"] and flag <= len(mw.flags.all()):
-        label = mw.flags.all()[flag - 1].label
-        self.web.eval(
-            """
-            (() => {
-                const flag = document.getElementById('_flag');
-                let flagLabel = document.querySelector('#flag-label');
-                if(!flagLabel) {
-                    flagLabel = document.createElement('span');
-                    flag.insertAdjacentElement('beforeend', flagLabel);
-                }
-                flagLabel.id = 'flag-label';
-                flagLabel.textContent = %s;
-            })();
-            """
-            % json.dumps(label)
-        )
+    self.web.eval(f"_moreFlagsDraw({flag});")
+
+
+def fill_reviewer_flag_group_menu(
+    reviewer: Reviewer, menu: QMenu, flag_opts: List[Any]
+) -> None:
+    if not menu.isEmpty():
+        return
+    reviewer._addMenuItems(menu, flag_opts)
+    qtMenuShortcutWorkaround(menu)
 
 
 def show_reviewer_contextmenu(self: Reviewer, _old: Any) -> None:
     opts = self._contextMenu()
+    # Anki adds an option for each flag, with built-in flags checked as needed
     flag_opts = opts[0][1]
-    current_flag = self.card and self.card.user_flag()
-    if not current_flag:
-        current_flag = get_card_custom_flag(self.card)
-        if current_flag:
-            current_flag += original_flags_count
-    all_flags = self.mw.flags.all()
-    custom_flags = config.flags
-    for i, opt in enumerate(flag_opts):
-        if i >= original_flags_count:
-            opt[1] = custom_flags[i - original_flags_count].shortcut or f"Ctrl+{i+1}"
-        opt[-1] = {"checked": all_flags[i].index == current_flag}
+    registry = config.registry
+    if config["multi_flags"]:
+        current_flags = flags_in_mask(get_card_custom_flag_mask(self.card))
+    elif not self.card.user_flag():
+        current_flags = [get_card_custom_flag(self.card)]
+    else:
+        current_flags = []
+    for current_flag in current_flags:
+        if 0 < current_flag <= len(registry):
+            flag_opts[original_flags_count + current_flag - 1][-1] = {"checked": True}
+    for shortcut, i in registry.index_by_shortcut.items():
+        flag_opts[original_flags_count + i - 1][1] = shortcut
+    opts[0][1] = flag_opts[:original_flags_count] + [
+        flag_opts[original_flags_count + i - 1]
+        for i, flag in enumerate(registry.flags, start=1)
+        if not flag.group
+    ]
 
     m = QMenu(self.mw)
     self._addMenuItems(m, opts)
+    # Grouped flags are added to submenus that are filled when first opened
+    flag_menu = m.actions()[0].menu()
+    for group, indices in registry.groups.items():
+        group_menu = flag_menu.addMenu(group)
+        group_opts = [flag_opts[original_flags_count + i - 1] for i in indices]
+        qconnect(
+            group_menu.aboutToShow,
+            functools.partial(
+                fill_reviewer_flag_group_menu, self, group_menu, group_opts
+            ),
+        )
 
     gui_hooks.reviewer_will_show_context_menu(self, m)
     qtMenuShortcutWorkaround(m)
@@ -247,35 +518,44 @@ def reviewer_shortcut_keys(
     _old: Any,
 ) -> Sequence[Union[Tuple[str, Callable], Tuple[Qt.Key, Callable]]]:
     keys = _old(self)
-    first_custom_flag_idx = next(
-        (i for i, t in enumerate(keys) if t[0] == f"Ctrl+{original_flags_count+1}"),
-        None,
-    )
-    for i, flag in enumerate(config.flags):
-        if flag.shortcut:
-            key = list(keys[first_custom_flag_idx + i])
-            key[0] = flag.shortcut
-            keys[first_custom_flag_idx + i] = tuple(key)
+    # Anki binds Ctrl+n to each flag n, so map those to the configured shortcuts
+    overrides = {
+        f"Ctrl+{original_flags_count + i}": shortcut
+        for shortcut, i in config.registry.index_by_shortcut.items()
+    }
+    if not overrides:
+        return keys
+    for pos, key in enumerate(keys):
+        shortcut = overrides.get(key[0])
+        if shortcut:
+            keys[pos] = (shortcut, *key[1:])
     return keys
 
 
 def clear_custom_flag(self: Card, flag: int) -> None:
-    set_card_custom_flag(self, 0, update=False)
+    # Built-in and custom flags can be combined in multi-flag mode
+    if not config["multi_flags"]:
+        set_card_custom_flag(self, 0, update=False)
 
 
 def clear_custom_flags_for_cards(
     self: Collection, flag: int, cids: Sequence[CardId], _old: Any
 ) -> OpChangesWithCount:
-    cards = []
-    for cid in cids:
-        card = self.get_card(cid)
-        set_card_custom_flag(card, 0, update=False)
-        cards.append(card)
+    user_changes = user_flag_changes(self, cids, flag) if flag_counts.is_loaded else []
+    flagged_cids = [] if config["multi_flags"] else cards_with_custom_flag(self, cids)
+    if not flagged_cids:
+        changes = _old(self, flag, cids)
+        flag_counts.apply_user_flag_changes(user_changes)
+        # Refresh flag counts in the sidebar
+        changes.changes.browser_sidebar = True
+        return changes
     target = self.add_custom_undo_entry(self.tr.actions_set_flag())
-    self.update_cards(cards)
+    clear_custom_flags(self, flagged_cids)
     changes = _old(self, flag, cids)
+    flag_counts.apply_user_flag_changes(user_changes)
     merged_changes = self.merge_undo_entries(target)
     merged_changes.study_queues = False
+    merged_changes.browser_sidebar = True
 
     return OpChangesWithCount(count=changes.count, changes=merged_changes)
 
@@ -284,6 +564,9 @@ def set_flag_of_selected_cards(self: Browser, flag: int, _old: Any) -> None:
     if flag <= original_flags_count:
         _old(self, flag)
         return
+    if config["multi_flags"]:
+        toggle_flag_bit_of_selected_cards(self, flag - original_flags_count)
+        return
     if (
         get_card_custom_flag(getattr(self, "current_card", self.card))
         + original_flags_count
@@ -293,51 +576,356 @@ def set_flag_of_selected_cards(self: Browser, flag: int, _old: Any) -> None:
     else:
         flag = flag - original_flags_count
 
-    cards = []
-    for cid in self.selected_cards():
-        card = mw.col.get_card(cid)
-        set_card_custom_flag(card, flag, update=False)
-        cards.append(card)
+    cids = self.selected_cards()
+
+    def on_success(result: BulkFlagResult) -> None:
+        log_bulk_result("Set custom flag", result)
+        tooltip(tr.browsing_cards_updated(count=result.count), parent=self)
+
     CollectionOp(
         self,
-        lambda col: OpChangesWithCount(
-            changes=col.update_cards(cards), count=len(cards)
+        lambda col: set_custom_flag_for_cards(
+            col, cids, flag, on_progress=update_bulk_progress
         ),
-    ).success(
-        lambda out: tooltip(tr.browsing_cards_updated(count=out.count), parent=self)
-    ).run_in_background()
+    ).success(on_success).run_in_background()
+
+
+def toggle_flag_bit_of_selected_cards(browser: Browser, flag: int) -> None:
+    """Add a custom flag to the selected cards, or remove it if the current card has it."""
+    if not check_multi_flag(flag):
+        return
+    card = getattr(browser, "current_card", browser.card)
+    enable = not get_card_custom_flag_mask(card) & flag_bit(flag)
+    cids = browser.selected_cards()
+
+    def on_success(result: BulkFlagResult) -> None:
+        log_bulk_result("Toggle custom flag", result)
+        tooltip(tr.browsing_cards_updated(count=result.count), parent=browser)
+
+    CollectionOp(
+        browser,
+        lambda col: toggle_custom_flag_bit_for_cards(
+            col, cids, flag, enable, on_progress=update_bulk_progress
+        ),
+    ).success(on_success).run_in_background()
+
+
+def row_color_for_custom_flag(flag_idx: int) -> Optional[RowColor]:
+    flag = config.registry.get(flag_idx)
+    if not flag:
+        return None
+    return adjusted_bg_color(anki_color_for_custom_flag(flag))
+
+
+row_color_provider = RowColorProvider(row_color_for_custom_flag, lambda: config.version)
+note_row_color_provider = RowColorProvider(
+    row_color_for_custom_flag,
+    lambda: config.version,
+    fetch_flags=fetch_note_custom_flags,  # type: ignore[arg-type]
+)
+
+
+flag_index = FlagIndex(lambda: config["multi_flags"])
+
+CUSTOM_FLAG_SEARCH_RE = re.compile(r"\bcustom-flag:(\d+)\b")
+
+
+def custom_flag_card_ids(col: Collection, flags: Sequence[int]) -> List[CardId]:
+    """Return the ids of cards that have any of the given custom flags without searching custom data."""
+    return flag_index.card_ids(col, flags)
+
+
+def custom_flag_search(flag_idx: int) -> str:
+    if config["multi_flags"]:
+        search = custom_flag_search_text(flag_idx)
+        if not search.startswith("custom-flag:"):
+            return search
+    elif supports_custom_data_prop_search():
+        return f"prop:cdn:{CUSTOM_DATA_KEY}={flag_idx}"
+    # Custom data can't be searched (efficiently), so resolve the search to card ids
+    cids = custom_flag_card_ids(mw.col, [flag_idx])
+    return f"cid:{','.join(str(cid) for cid in cids) or 0}"
+
+
+CUSTOM_FLAG_COLUMN = "more_flags_custom_flag"
+
+
+def on_browser_did_fetch_columns(columns: Dict[str, BrowserColumns.Column]) -> None:
+    # Sorting is done in SQL, which requires extract_custom_data()
+    sorting = (
+        BrowserColumns.SORTING_ASCENDING
+        if supports_custom_data_prop_search()
+        else BrowserColumns.SORTING_NONE
+    )
+    fields = BrowserColumns.Column.DESCRIPTOR.fields_by_name
+    # Sorting was split into cards and notes modes in 2.1.50
+    sorting_kwargs: Dict[str, Any] = (
+        {"sorting_cards": sorting, "sorting_notes": sorting}
+        if "sorting_cards" in fields
+        else {"sorting": sorting}
+    )
+    columns[CUSTOM_FLAG_COLUMN] = BrowserColumns.Column(
+        key=CUSTOM_FLAG_COLUMN,
+        cards_mode_label="Custom Flag",
+        notes_mode_label="Custom Flag",
+        uses_cell_font=False,
+        alignment=BrowserColumns.ALIGNMENT_START,
+        **sorting_kwargs,
+    )
+
+
+def custom_flag_order(is_notes_mode: bool, reverse: bool) -> str:
+    if is_notes_mode:
+        # Sort notes by their lowest custom flag, matching fetch_note_custom_flags()
+        flag_expr = (
+            f"(select min(extract_custom_data(data, '{CUSTOM_DATA_KEY}')) "
+            "from cards where nid = n.id)"
+        )
+    else:
+        flag_expr = f"extract_custom_data(c.data, '{CUSTOM_DATA_KEY}')"
+    # Keep unflagged items last in both directions
+    return f"{flag_expr} is null asc, {flag_expr} {'desc' if reverse else 'asc'}"
+
+
+def on_browser_will_search(context: SearchContext) -> None:
+    if (
+        isinstance(context.order, BrowserColumns.Column)
+        and context.order.key == CUSTOM_FLAG_COLUMN
+    ):
+        if supports_custom_data_prop_search():
+            context.order = custom_flag_order(
+                context.browser.table.is_notes_mode(), context.reverse
+            )
+        else:
+            context.order = False
+    if "custom-flag:" not in context.search:
+        return
+    context.search = CUSTOM_FLAG_SEARCH_RE.sub(
+        lambda m: custom_flag_search(int(m.group(1))), context.search
+    )
+
+
+def on_browser_did_search(context: SearchContext) -> None:
+    if context.browser.table.is_notes_mode():
+        row_color_provider.set_search_ids([])
+        note_row_color_provider.set_search_ids(context.ids or [])
+        provider = note_row_color_provider
+    else:
+        row_color_provider.set_search_ids(context.ids or [])
+        note_row_color_provider.set_search_ids([])
+        provider = row_color_provider
+    if context.ids:
+        prefetch_row_flags(context.browser, provider, context.ids[0])
+
+
+def prefetch_row_flags(
+    browser: Browser, provider: RowColorProvider, item_id: ItemId
+) -> None:
+    """Fetch the custom flags of rows around the item in the background, then repaint them."""
+    ids = provider.missing_window(item_id)
+    if not ids:
+        return
+    generation = provider.generation
+
+    def on_success(flags: Mapping[int, int]) -> None:
+        if provider.store(generation, ids, flags):
+            repaint_flagged_rows(browser, provider, flags)
+
+    QueryOp(
+        parent=browser,
+        op=lambda col: provider.fetch(col, ids),
+        success=on_success,
+    ).failure(lambda exc: provider.cancel(ids)).run_in_background()
+
+
+def apply_row_flag(
+    row: CellRow,
+    columns: Sequence[str],
+    entry: Tuple[int, Optional[RowColor]],
+) -> None:
+    flag_idx, color = entry
+    if color:
+        row.color = color
+    if CUSTOM_FLAG_COLUMN in columns:
+        flag = config.registry.get(flag_idx)
+        row.cells[columns.index(CUSTOM_FLAG_COLUMN)].text = flag.label if flag else ""
+
+
+def repaint_flagged_rows(
+    browser: Browser, provider: RowColorProvider, flags: Mapping[int, int]
+) -> None:
+    """Apply fetched flags to the browser's cached rows and repaint the ones that are flagged.
+
+    Unflagged rows were already painted correctly without waiting for the fetch.
+    """
+    if sip.isdeleted(browser):
+        return
+    model = browser.table._model
+    columns = browser.table._state.active_columns
+    items = model._items
+    rows = []
+    for item_id in flags:
+        cached_row = model._rows.get(item_id)
+        entry = provider.peek(item_id)
+        if cached_row is None or entry is None:
+            continue
+        apply_row_flag(cached_row, columns, entry)
+        position = provider.position(item_id)
+        if position is None or position >= len(items):
+            continue
+        # Positions in the search match the model's rows, unless the rows were reversed since
+        if items[position] != item_id:
+            position = len(items) - 1 - position
+        rows.append(position)
+    if not rows:
+        return
+    model.dataChanged.emit(
+        model.index(min(rows), 0),
+        model.index(max(rows), model.len_columns() - 1),
+    )
 
 
 def on_browser_did_fetch_row(
     card_or_note_id: ItemId, is_note: bool, row: CellRow, columns: Sequence[str]
 ) -> None:
-    if not is_note:
-        card_or_note_id = cast(CardId, card_or_note_id)
-        card = mw.col.get_card(card_or_note_id)
-        flag_idx = get_card_custom_flag(card)
-        if flag_idx and flag_idx <= len(config.flags):
-            flag = config.flags[flag_idx - 1]
-            color = anki_color_for_custom_flag(flag)
-            color = adjusted_bg_color(color)
-            row.color = color
+    provider = note_row_color_provider if is_note else row_color_provider
+    entry = provider.peek(card_or_note_id)
+    if entry is None:
+        # Painted without a custom flag for now, and repainted once it's fetched
+        browser: Optional[Browser] = dialogs._dialogs["Browser"][1]
+        if browser:
+            prefetch_row_flags(browser, provider, card_or_note_id)
+        return
+    apply_row_flag(row, columns, entry)
+
+
+def on_operation_did_execute(changes: OpChanges, handler: Optional[object]) -> None:
+    if changes.card:
+        row_color_provider.clear()
+        # Cards of any note may have changed, so note flags need to be refetched too
+        note_row_color_provider.clear()
+    if changes.card and mw.col:
+        invalidate_flag_caches(mw.col, mw.col.undo_status().undo)
 
 
 def update_flags_menu(self: Browser, _old: Any) -> None:
-    flag = self.current_card and self.current_card.user_flag()
-    if not flag:
-        flag = self.current_card and get_card_custom_flag(self.current_card)
-        if flag:
-            flag += original_flags_count
+    # Called on every row change; checking hundreds of flag actions is deferred
+    # until the menu is actually shown
+    pass
+
+
+def sync_browser_flags_menu(browser: Browser) -> None:
+    card = browser.current_card
+    flags = set()
+    if card:
+        user_flag = card.user_flag()
+        if user_flag:
+            flags.add(user_flag)
+        if config["multi_flags"]:
+            custom_flags = flags_in_mask(get_card_custom_flag_mask(card))
+        elif not user_flag:
+            custom_flags = [get_card_custom_flag(card)]
+        else:
+            custom_flags = []
+        flags.update(original_flags_count + flag for flag in custom_flags if flag)
+
+    for f in mw.flags.all():
+        getattr(browser.form, f.action).setChecked(f.index in flags)
+
+    qtMenuShortcutWorkaround(browser.form.menuFlag)
+
+
+flag_counts = FlagCounts(lambda: config["multi_flags"])
+# Flag index -> the label of the flag's sidebar item without the card count
+sidebar_flag_labels: Dict[int, str] = {}
+
+
+def add_sidebar_flag_counts(flag_root: SidebarItem) -> None:
+    user_counts, custom_counts = flag_counts.totals(mw.col)
+    for item in flag_root.children:
+        if item.item_type != SidebarItemType.FLAG:
+            continue
+        if item.id <= original_flags_count:
+            count = user_counts.get(item.id, 0)
+        else:
+            count = custom_counts.get(item.id - original_flags_count, 0)
+        sidebar_flag_labels[item.id] = item.name
+        item.name += f" ({count})"
+
+
+def sidebar_item_data(
+    self: SidebarModel,
+    index: QModelIndex,
+    role: int = Qt.ItemDataRole.DisplayRole,
+    _old: Any = None,
+) -> Any:
+    # Rename flags starting from their label rather than the text with the card count
+    if role == Qt.ItemDataRole.EditRole and index.isValid():
+        item: SidebarItem = index.internalPointer()
+        if item.item_type == SidebarItemType.FLAG and item.id in sidebar_flag_labels:
+            return QVariant(sidebar_flag_labels[item.id])
+    return _old(self, index, role)
+
+
+def show_flag_stats(parent: QWidget) -> None:
+    # Imported lazily to keep the add-on's startup cost low
+    from .gui.stats import FlagStatsDialog
+
+    dialog = FlagStatsDialog(
+        parent, mw.flags.all(), original_flags_count, flag_counts.by_deck(mw.col)
+    )
+    dialog.show()
+
+
+def study_custom_flags(flags: List[int], name: Optional[str] = None) -> None:
+    """Build a filtered deck with the cards of the given custom flags and show it.
+
+    The deck is named after the flags' labels unless `name` is given.
+    """
+    if name is None:
+        registry = config.registry
+        labels = [flag.label for flag in map(registry.get, flags) if flag]
+        name = f"Custom Flag: {', '.join(labels)}"
+
+    def on_card_ids(cids: List[CardId]) -> None:
+        if not cids:
+            tooltip("No cards have the selected flags")
+            return
+        if len(cids) > MAX_FILTERED_DECK_CARDS:
+            tooltip(f"Only the first {MAX_FILTERED_DECK_CARDS} due cards will be added")
+        CollectionOp(
+            mw, lambda col: build_filtered_deck(col, name, cids, flags)
+        ).success(on_deck_built).run_in_background()
+
+    def on_deck_built(out: OpChangesWithId) -> None:
+        mw.col.decks.select(DeckId(out.id))
+        mw.moveToState("overview")
+
+    QueryOp(
+        parent=mw,
+        op=lambda col: custom_flag_card_ids(col, flags),
+        success=on_card_ids,
+    ).run_in_background()
+
+
+def rebuild_current_filtered_deck(self: Overview, _old: Any) -> None:
+    # The deck's search is a list of card ids, so look up the cards of its flags again
+    did = self.mw.col.decks.selected()
+    flags = study_deck_flags(self.mw.col, did)
+    if flags is None:
+        _old(self)
+        return
+    study_custom_flags(flags, self.mw.col.decks.name(did))
+
 
-    for f in self.mw.flags.all():
-        getattr(self.form, f.action).setChecked(flag == f.index)
+def on_study_custom_flags() -> None:
+    # Imported lazily to keep the add-on's startup cost low
+    from .gui.study import StudyCustomFlagsDialog
 
-    qtMenuShortcutWorkaround(self.form.menuFlag)
+    StudyCustomFlagsDialog(mw, config.registry.flags, study_custom_flags).show()
 
 
 def after_flag_tree_build(self: SidebarTreeView, root: SidebarItem) -> None:
-    if not supports_custom_data_prop_search():
-        return
     flag_root = next(
         (
             child
@@ -348,6 +936,9 @@ def after_flag_tree_build(self: SidebarTreeView, root: SidebarItem) -> None:
     )
     if not flag_root:
         return
+    add_sidebar_flag_counts(flag_root)
+    if not supports_custom_data_prop_search():
+        return
 
     node = flag_root.search_node
     custom_node = SearchNode(parsable_text=f"prop:cdn:{CUSTOM_DATA_KEY}!=0")
@@ -369,48 +960,206 @@ def after_flag_tree_build(self: SidebarTreeView, root: SidebarItem) -> None:
         )
 
 
+def on_profile_did_open() -> None:
+    flag_index.open(consts.dir / "user_files" / f"flag_index_{mw.pm.name}.db")
+
+
+def on_profile_will_close() -> None:
+    flag_index.close(mw.col)
+    if profiler.enabled:
+        profiler.log_summary(logger)
+
+
+# Undo entries of operations that delete cards or may add flagged ones, e.g. by
+# importing custom data
+CARD_DELETING_OPERATIONS = (
+    "studying_delete_note",
+    "browsing_delete_notes",
+    "decks_delete_deck",
+    "actions_import",
+)
+# Undo entries of operations that move cards to other decks; resetting cards takes
+# them out of filtered decks
+CARD_MOVING_OPERATIONS = (
+    "browsing_change_deck",
+    "actions_build_filtered_deck",
+    "studying_empty",
+    "actions_forget_card",
+)
+
+
+def _operation_labels(col: Collection, names: Sequence[str]) -> Set[str]:
+    # Older Anki versions may lack some of the strings
+    return {getattr(col.tr, name)() for name in names if hasattr(col.tr, name)}
+
+
+def invalidate_flag_caches(col: Collection, operation: str) -> None:
+    """Mark the flag counts and index as stale where the operation named `operation` may have changed them.
+
+    Flag changes are tracked incrementally, so this is only needed when cards were
+    deleted, added or moved to other decks.
+    """
+    if not operation or operation in _operation_labels(col, CARD_DELETING_OPERATIONS):
+        # Operations that can't be undone leave no name to go by
+        flag_counts.mark_stale()
+        flag_index.mark_stale()
+    elif operation in _operation_labels(col, CARD_MOVING_OPERATIONS):
+        flag_counts.mark_decks_stale()
+
+
+def is_custom_flag_operation(col: Collection, operation: str) -> bool:
+    """Whether the undo entry named `operation` only changes flags."""
+    return operation in (
+        col.tr.actions_set_flag(),
+        IMPORT_CUSTOM_FLAGS_LABEL,
+    )
+
+
+def on_undo_redo(self: Collection, _old: Any) -> Any:
+    # Otherwise undo would revert the operation before a flag change that's still
+    # pending, and the deferred write would then clear the redo stack
+    flag_write_buffer.flush_now()
+    try:
+        out = _old(self)
+    finally:
+        flag_index.mark_stale()
+    changes = getattr(out, "changes", None)
+    if not changes or is_custom_flag_operation(self, out.operation):
+        # Reverted flag changes aren't tracked
+        flag_counts.mark_stale()
+    elif changes.card:
+        invalidate_flag_caches(self, out.operation)
+    # The backend asks for a queue rebuild after undoing card changes, but flags
+    # don't affect the queues, so let the reviewer just redraw the flag icon
+    if (
+        changes
+        and is_custom_flag_operation(self, out.operation)
+        and not (changes.note_text or changes.deck or changes.deck_config)
+    ):
+        changes.study_queues = False
+    return out
+
+
+def reload_custom_flags() -> None:
+    """Apply config changes to the flag manager and open screens without restarting Anki."""
+    flag_icons.clear()
+    if mw.flags._flags:
+        del mw.flags._flags[original_flags_count:]
+        append_custom_flags(mw.flags)
+    browser: Optional[Browser] = dialogs._dialogs["Browser"][1]
+    if browser:
+        reload_browser_flag_actions(browser)
+    reload_reviewer_flags()
+
+
 def on_config() -> None:
-    dialog = ConfigDialog(None)
+    # Imported lazily, as the config dialog pulls in webcolors and the generated forms
+    from .gui.config import ConfigDialog
+
+    dialog = ConfigDialog(None, on_save=reload_custom_flags)
     dialog.exec()
 
 
 def patch() -> None:
-    FlagManager._load_flags = wrap(FlagManager._load_flags, load_custom_flags, "after")  # type: ignore[method-assign]
-    FlagManager.rename_flag = wrap(FlagManager.rename_flag, rename_flag, "around")  # type: ignore[method-assign]
-    Browser.setupMenus = wrap(Browser.setupMenus, setup_browser_menus, "before")  # type: ignore[method-assign]
+    FlagManager._load_flags = wrap(  # type: ignore[method-assign]
+        FlagManager._load_flags, profiler.profiled(load_custom_flags), "after"
+    )
+    FlagManager.rename_flag = wrap(  # type: ignore[method-assign]
+        FlagManager.rename_flag, profiler.profiled(rename_flag), "around"
+    )
+    Browser.setupMenus = wrap(  # type: ignore[method-assign]
+        Browser.setupMenus, profiler.profiled(setup_browser_menus), "before"
+    )
     Reviewer.set_flag_on_current_card = wrap(  # type: ignore[method-assign]
-        Reviewer.set_flag_on_current_card, set_flag_on_current_card, "around"
+        Reviewer.set_flag_on_current_card,
+        profiler.profiled(set_flag_on_current_card),
+        "around",
     )
     Reviewer._update_flag_icon = wrap(  # type: ignore[method-assign]
-        Reviewer._update_flag_icon, update_flag_icon, "around"
+        Reviewer._update_flag_icon, profiler.profiled(update_flag_icon), "around"
     )
     Reviewer.showContextMenu = wrap(  # type: ignore[method-assign]
-        Reviewer.showContextMenu, show_reviewer_contextmenu, "around"
+        Reviewer.showContextMenu,
+        profiler.profiled(show_reviewer_contextmenu),
+        "around",
     )
     Reviewer._shortcutKeys = wrap(  # type: ignore[method-assign]
-        Reviewer._shortcutKeys, reviewer_shortcut_keys, "around"
+        Reviewer._shortcutKeys, profiler.profiled(reviewer_shortcut_keys), "around"
+    )
+    Card.set_user_flag = wrap(  # type: ignore[method-assign]
+        Card.set_user_flag, profiler.profiled(clear_custom_flag), "after"
     )
-    Card.set_user_flag = wrap(Card.set_user_flag, clear_custom_flag, "after")  # type: ignore[method-assign]
     Collection.set_user_flag_for_cards = wrap(  # type: ignore[method-assign]
-        Collection.set_user_flag_for_cards, clear_custom_flags_for_cards, "around"
+        Collection.set_user_flag_for_cards,
+        profiler.profiled(clear_custom_flags_for_cards),
+        "around",
     )
     Browser.set_flag_of_selected_cards = wrap(  # type: ignore[method-assign]
-        Browser.set_flag_of_selected_cards, set_flag_of_selected_cards, "around"
+        Browser.set_flag_of_selected_cards,
+        profiler.profiled(set_flag_of_selected_cards),
+        "around",
     )
     Browser._update_flags_menu = wrap(  # type: ignore[method-assign]
-        Browser._update_flags_menu, update_flags_menu, "around"
+        Browser._update_flags_menu, profiler.profiled(update_flags_menu), "around"
     )
     SidebarTreeView._flags_tree = wrap(  # type: ignore[method-assign]
-        SidebarTreeView._flags_tree, after_flag_tree_build, "after"
+        SidebarTreeView._flags_tree, profiler.profiled(after_flag_tree_build), "after"
+    )
+    SidebarModel.data = wrap(  # type: ignore[method-assign]
+        SidebarModel.data, profiler.profiled(sidebar_item_data), "around"
+    )
+    Overview.rebuild_current_filtered_deck = wrap(  # type: ignore[method-assign]
+        Overview.rebuild_current_filtered_deck,
+        profiler.profiled(rebuild_current_filtered_deck),
+        "around",
+    )
+    Collection.undo = wrap(  # type: ignore[method-assign]
+        Collection.undo, profiler.profiled(on_undo_redo, "on_undo"), "around"
+    )
+    Collection.redo = wrap(  # type: ignore[method-assign]
+        Collection.redo, profiler.profiled(on_undo_redo, "on_redo"), "around"
     )
 
 
 def register_hooks() -> None:
-    gui_hooks.webview_will_set_content.append(on_webview_will_set_content)
-    gui_hooks.browser_did_fetch_row.append(on_browser_did_fetch_row)
+    gui_hooks.webview_will_set_content.append(
+        profiler.profiled(on_webview_will_set_content)
+    )
+    gui_hooks.flag_label_did_change.append(profiler.profiled(on_flag_label_did_change))
+    gui_hooks.browser_will_search.append(profiler.profiled(on_browser_will_search))
+    gui_hooks.browser_did_search.append(profiler.profiled(on_browser_did_search))
+    gui_hooks.browser_did_fetch_row.append(profiler.profiled(on_browser_did_fetch_row))
+    if hasattr(gui_hooks, "browser_did_fetch_columns"):
+        gui_hooks.browser_did_fetch_columns.append(
+            profiler.profiled(on_browser_did_fetch_columns)
+        )
+    gui_hooks.operation_did_execute.append(profiler.profiled(on_operation_did_execute))
+    gui_hooks.reviewer_will_answer_card.append(
+        profiler.profiled(on_reviewer_will_answer_card)
+    )
+    gui_hooks.reviewer_did_show_question.append(
+        profiler.profiled(
+            lambda card: flag_write_buffer.flush(), "on_reviewer_did_show_question"
+        )
+    )
+    gui_hooks.reviewer_will_end.append(profiler.profiled(flag_write_buffer.flush))
+    gui_hooks.profile_will_close.append(profiler.profiled(flag_write_buffer.flush_now))
+    gui_hooks.profile_did_open.append(on_profile_did_open)
+    gui_hooks.profile_will_close.append(on_profile_will_close)
+    gui_hooks.sync_did_finish.append(flag_index.mark_stale)
+    gui_hooks.sync_did_finish.append(flag_counts.mark_stale)
+    custom_flags_did_change.append(profiler.profiled(flag_index.apply_changes))
+    custom_flags_did_change.append(
+        profiler.profiled(flag_counts.apply_custom_flag_changes)
+    )
     mw.addonManager.setConfigAction(__name__, on_config)
+    mw.addonManager.setWebExports(__name__, r"user_files/web/.*\.css")
+    study_action = QAction("Study Custom Flags...", mw)
+    qconnect(study_action.triggered, on_study_custom_flags)
+    mw.form.menuTools.addAction(study_action)
 
 
+profiler.enabled = config["profiling"]
 setup_error_handler()
 patch()
 register_hooks()
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import contextlib
+import dataclasses
+import functools
+import json
+import logging
+import threading
+import time
+import tracemalloc
+from collections import deque
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, TypeVar
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+@dataclasses.dataclass
+class CallStats:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+    # Latencies of the most recent calls, used to estimate percentiles
+    samples: Deque[float] = dataclasses.field(
+        default_factory=lambda: deque(maxlen=Profiler.MAX_SAMPLES)
+    )
+
+    def add(self, elapsed: float) -> None:
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.samples.append(elapsed)
+
+    def percentile(self, percent: float) -> float:
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+class Profiler:
+    """Records call counts and latencies of the add-on's patched methods and hook callbacks.
+
+    Profiled functions only check the `enabled` flag when profiling is off, so the
+    wrappers can be installed unconditionally.
+    """
+
+    MAX_SAMPLES = 1000
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self._stats: Dict[str, CallStats] = {}
+        # Some callbacks run in background operations
+        self._lock = threading.Lock()
+
+    def profiled(self, func: F, name: Optional[str] = None) -> F:
+        """Return a wrapper of `func` that records its latency under `name` when profiling is enabled."""
+        name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not self.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - start)
+
+        return wrapper  # type: ignore[return-value]
+
+    def record(self, name: str, elapsed: float) -> None:
+        with self._lock:
+            self._stats.setdefault(name, CallStats()).add(elapsed)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """Return the stats of each profiled function in milliseconds, slowest in total first."""
+        with self._lock:
+            rows = [
+                {
+                    "name": name,
+                    "count": stats.count,
+                    "total": stats.total * 1000,
+                    "p50": stats.percentile(50) * 1000,
+                    "p95": stats.percentile(95) * 1000,
+                    "max": stats.max * 1000,
+                }
+                for name, stats in self._stats.items()
+            ]
+        return sorted(rows, key=lambda row: row["total"], reverse=True)
+
+    def log_summary(self, logger: logging.Logger) -> None:
+        for row in self.summary():
+            logger.info(
+                "%s: %d calls, total %.1f ms, p50 %.2f ms, p95 %.2f ms, max %.2f ms",
+                row["name"],
+                row["count"],
+                row["total"],
+                row["p50"],
+                row["p95"],
+                row["max"],
+            )
+
+    def export(self, path: Path) -> None:
+        path.write_text(json.dumps(self.summary(), indent=4), encoding="utf-8")
+
+
+profiler = Profiler()
+
+
+@dataclasses.dataclass
+class Measurement:
+    elapsed: float = 0.0
+    # Peak traced memory in bytes; only available when tracemalloc is tracing
+    peak_memory: Optional[int] = None
+
+
+@contextlib.contextmanager
+def measure() -> Iterator[Measurement]:
+    """Measure the wall time and peak traced memory of the block.
+
+    The returned measurement is filled in when the block exits.
+    """
+    measurement = Measurement()
+    start = time.perf_counter()
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    try:
+        yield measurement
+    finally:
+        measurement.elapsed = time.perf_counter() - start
+        if tracemalloc.is_tracing():
+            measurement.peak_memory = tracemalloc.get_traced_memory()[1]
@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Callable, Dict, List, Mapping, Optional, Sequence, Set, Tuple
+
+from anki.collection import Collection
+
+from .custom_data import fetch_custom_flags
+
+# A card or note id
+ItemId = int
+
+# A tuple of (light, dark) colors before 2.1.55
+RowColor = Dict[str, str]
+
+
+class RowColorProvider:
+    """Resolves the custom flags and background colors of rows in the browser.
+
+    Custom flags are fetched for a window of the current search with a single query
+    and kept along with their resolved colors in an LRU cache, so painting a row is
+    usually a dict lookup. Rows are cards by default; pass `fetch_flags` to resolve
+    the flags of other items such as notes.
+
+    To keep database reads off the UI thread, callers use `peek()` when painting and
+    fetch the ids returned by `missing_window()` in the background, passing the
+    result to `store()`.
+    """
+
+    WINDOW_SIZE = 500
+    CACHE_SIZE = 20000
+
+    def __init__(
+        self,
+        resolve_color: Callable[[int], Optional[RowColor]],
+        config_version: Callable[[], int],
+        fetch_flags: Callable[
+            [Collection, Sequence[ItemId]], Mapping[ItemId, int]
+        ] = fetch_custom_flags,  # type: ignore[assignment]
+    ) -> None:
+        self._resolve_color = resolve_color
+        self._fetch_flags = fetch_flags
+        self._config_version = config_version
+        self._version = config_version()
+        # Item id -> (custom flag, row color)
+        self._cache: OrderedDict[ItemId, Tuple[int, Optional[RowColor]]] = OrderedDict()
+        self._search_ids: Sequence[ItemId] = []
+        self._positions: Optional[Dict[ItemId, int]] = None
+        # Ids being fetched in the background
+        self._pending: Set[ItemId] = set()
+        # Incremented when cached flags may be outdated, so that fetches started
+        # before that are discarded
+        self.generation = 0
+
+    def set_search_ids(self, ids: Sequence[ItemId]) -> None:
+        """Set the ids of the current browser search, used to decide which rows to prefetch."""
+        self._search_ids = ids
+        self._positions = None
+
+    def clear(self) -> None:
+        self._cache.clear()
+        self._pending.clear()
+        self.generation += 1
+        self._version = self._config_version()
+
+    def peek(self, item_id: ItemId) -> Optional[Tuple[int, Optional[RowColor]]]:
+        """Return the cached (custom flag, row color) of the item without accessing the database."""
+        if self._version != self._config_version():
+            self.clear()
+        entry = self._cache.get(item_id)
+        if entry is not None:
+            self._cache.move_to_end(item_id)
+        return entry
+
+    def missing_window(self, item_id: ItemId) -> List[ItemId]:
+        """Return the ids around the item that are neither cached nor being fetched, marking them as pending."""
+        # Otherwise the fetched flags would be dropped by the next peek()
+        if self._version != self._config_version():
+            self.clear()
+        ids = [
+            window_id
+            for window_id in self._window_for(item_id)
+            if window_id not in self._cache and window_id not in self._pending
+        ]
+        self._pending.update(ids)
+        return ids
+
+    def fetch(self, col: Collection, ids: Sequence[ItemId]) -> Mapping[ItemId, int]:
+        """Fetch the custom flags of the given items. Safe to call from a background thread."""
+        return self._fetch_flags(col, ids)
+
+    def store(
+        self, generation: int, ids: Sequence[ItemId], flags: Mapping[ItemId, int]
+    ) -> bool:
+        """Cache the result of `fetch()`, unless the cache was cleared since `generation`.
+
+        Returns whether the result was stored.
+        """
+        if generation != self.generation:
+            return False
+        self._pending.difference_update(ids)
+        self._store(ids, flags)
+        return True
+
+    def cancel(self, ids: Sequence[ItemId]) -> None:
+        """Stop treating the given ids as pending after their fetch failed."""
+        self._pending.difference_update(ids)
+
+    def position(self, item_id: ItemId) -> Optional[int]:
+        """The position of the item in the current search."""
+        if self._positions is None:
+            self._positions = {
+                search_id: i for i, search_id in enumerate(self._search_ids)
+            }
+        return self._positions.get(item_id)
+
+    def _window_for(self, item_id: ItemId) -> Sequence[ItemId]:
+        pos = self.position(item_id)
+        if pos is None:
+            return [item_id]
+        # Rows are mostly fetched while scrolling down, so prefetch more rows after the item
+        start = max(0, pos - self.WINDOW_SIZE // 4)
+        return self._search_ids[start : start + self.WINDOW_SIZE]
+
+    def _store(self, window: Sequence[ItemId], flags: Mapping[ItemId, int]) -> None:
+        for window_id in window:
+            flag = flags.get(window_id, 0)
+            self._cache[window_id] = (flag, self._resolve_color(flag) if flag else None)
+            self._cache.move_to_end(window_id)
+        while len(self._cache) > self.CACHE_SIZE:
+            self._cache.popitem(last=False)
@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import threading
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from anki.cards import CardId
+from anki.collection import Collection
+from anki.decks import DeckId
+from anki.utils import ids2str
+
+from .custom_data import (
+    CUSTOM_DATA_KEY,
+    CUSTOM_DATA_MASK_KEY,
+    FlagChange,
+    custom_flag_from_card_data,
+    custom_flag_mask_from_card_data,
+    flags_in_mask,
+    supports_custom_data_prop_search,
+)
+
+# (deck id, is custom flag, flag number)
+CountKey = Tuple[DeckId, bool, int]
+
+# (deck id, old built-in flag, new built-in flag)
+UserFlagChange = Tuple[DeckId, int, int]
+
+
+class FlagCounts:
+    """Card counts of built-in and custom flags per deck.
+
+    The counts are computed with a single aggregate query over the cards table, then
+    kept up to date incrementally from the flag write paths, so they only need to be
+    recomputed when the collection changes in ways we can't track (e.g. undo or sync).
+    When cards only move to other decks, just the per-deck counts are recomputed.
+    In multi-flag mode, a card is counted once for each of its custom flags.
+    """
+
+    def __init__(self, is_multi: Callable[[], bool] = lambda: False) -> None:
+        self._counts: Optional[Counter[CountKey]] = None
+        self._is_multi = is_multi
+        # The mode the counts were computed in
+        self._multi = False
+        self._decks_stale = False
+        # Write paths may notify us from a background thread
+        self._lock = threading.Lock()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._counts is not None
+
+    def mark_stale(self) -> None:
+        self._counts = None
+
+    def mark_decks_stale(self) -> None:
+        """Mark the per-deck counts as stale after cards were moved, keeping the totals."""
+        self._decks_stale = True
+
+    def _compute(self, col: Collection, multi: bool) -> Counter[CountKey]:
+        prop_search = supports_custom_data_prop_search()
+        if prop_search:
+            custom_data_expr = f"extract_custom_data(data, '{CUSTOM_DATA_KEY}')"
+            mask_expr = (
+                f"extract_custom_data(data, '{CUSTOM_DATA_MASK_KEY}')"
+                if multi
+                else "null"
+            )
+        else:
+            # Group by the raw data of cards that may have a custom flag and parse it below
+            custom_data_expr = (
+                f"case when data like '%{CUSTOM_DATA_KEY}%' then data else '' end"
+            )
+            mask_expr = "null"
+        counts: Counter[CountKey] = Counter()
+        for did, user_flag, custom_data, mask_data, count in col.db.execute(
+            f"select did, flags & 7, {custom_data_expr}, {mask_expr}, count() "
+            "from cards group by 1, 2, 3, 4"
+        ):
+            if user_flag:
+                counts[(did, False, user_flag)] += count
+            if not custom_data:
+                continue
+            mask: Optional[int] = None
+            if prop_search:
+                custom_flag = int(custom_data)
+                if mask_data is not None:
+                    mask = int(mask_data)
+            else:
+                custom_flag = custom_flag_from_card_data(custom_data)
+                if multi:
+                    mask = custom_flag_mask_from_card_data(custom_data)
+            # Cards flagged before switching to multi-flag mode have no bitmask
+            for flag in flags_in_mask(mask) if mask is not None else [custom_flag]:
+                if flag:
+                    counts[(did, True, flag)] += count
+        return counts
+
+    def _ensure_fresh(
+        self, col: Collection, by_deck: bool = False
+    ) -> Counter[CountKey]:
+        with self._lock:
+            multi = self._is_multi()
+            if (
+                self._counts is None
+                or multi != self._multi
+                or (by_deck and self._decks_stale)
+            ):
+                self._counts = self._compute(col, multi)
+                self._multi = multi
+                self._decks_stale = False
+            return self._counts
+
+    def _changed_flags(self, change: FlagChange) -> Tuple[List[int], List[int]]:
+        if self._multi:
+            return flags_in_mask(change.old_mask), flags_in_mask(change.new_mask)
+        return [change.old], [change.new]
+
+    def apply_custom_flag_changes(self, changes: Sequence[FlagChange]) -> None:
+        with self._lock:
+            if self._counts is None:
+                return
+            for change in changes:
+                old_flags, new_flags = self._changed_flags(change)
+                for flag in old_flags:
+                    if flag:
+                        self._counts[(change.did, True, flag)] -= 1
+                for flag in new_flags:
+                    if flag:
+                        self._counts[(change.did, True, flag)] += 1
+                if change.new and change.old_user_flag:
+                    self._counts[(change.did, False, change.old_user_flag)] -= 1
+
+    def apply_user_flag_changes(self, changes: Iterable[UserFlagChange]) -> None:
+        with self._lock:
+            if self._counts is None:
+                return
+            for did, old, new in changes:
+                if old:
+                    self._counts[(did, False, old)] -= 1
+                if new:
+                    self._counts[(did, False, new)] += 1
+
+    def totals(self, col: Collection) -> Tuple[Dict[int, int], Dict[int, int]]:
+        """Return the total counts of built-in and custom flags."""
+        user_flags: Counter[int] = Counter()
+        custom_flags: Counter[int] = Counter()
+        for (_, is_custom, flag), count in self._ensure_fresh(col).items():
+            (custom_flags if is_custom else user_flags)[flag] += count
+        return user_flags, custom_flags
+
+    def by_deck(
+        self, col: Collection
+    ) -> Dict[DeckId, Tuple[Dict[int, int], Dict[int, int]]]:
+        """Return the counts of built-in and custom flags of each deck that has flagged cards."""
+        decks: Dict[DeckId, Tuple[Dict[int, int], Dict[int, int]]] = {}
+        for (did, is_custom, flag), count in self._ensure_fresh(col, True).items():
+            if count <= 0:
+                continue
+            user_flags, custom_flags = decks.setdefault(did, ({}, {}))
+            (custom_flags if is_custom else user_flags)[flag] = count
+        return decks
+
+
+def user_flag_changes(
+    col: Collection, cids: Sequence[CardId], flag: int
+) -> list[UserFlagChange]:
+    """Describe setting the built-in flag of the given cards. Must be called before the flag is set."""
+    return [
+        (DeckId(did), old, flag)
+        for did, old in col.db.execute(
+            f"select did, flags & 7 from cards where id in {ids2str(cids)}"
+        )
+    ]
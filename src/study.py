@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+from typing import List, Optional, Sequence
+
+from anki.cards import CardId
+from anki.collection import Collection, OpChangesWithId
+from anki.decks import DeckId, FilteredDeckConfig
+from anki.utils import ids2str
+
+# The largest search limit filtered decks accept
+MAX_FILTERED_DECK_CARDS = 99999
+# Collection config mapping the ids of filtered decks built by the add-on to their custom flags
+STUDY_DECKS_CONFIG_KEY = "more_flags_study_decks"
+
+
+def _cards_to_study(
+    col: Collection, cids: Sequence[CardId], did: DeckId
+) -> Sequence[CardId]:
+    """Pick the first due cards that the filtered deck would take if there are too many."""
+    if len(cids) <= MAX_FILTERED_DECK_CARDS:
+        return cids
+    # Suspended and buried cards, and cards in other filtered decks aren't moved
+    return col.db.list(
+        f"select id from cards where id in {ids2str(cids)} and queue >= 0"
+        " and (odid = 0 or did = ?) order by type, due limit ?",
+        did,
+        MAX_FILTERED_DECK_CARDS,
+    )
+
+
+def build_filtered_deck(
+    col: Collection, name: str, cids: Sequence[CardId], flags: Sequence[int]
+) -> OpChangesWithId:
+    """Create (or rebuild if it exists) a filtered deck named `name` with the given cards.
+
+    The cards are passed as a `cid:` search, so the backend doesn't need to parse
+    the custom data of every card to find them. As the search is a fixed list,
+    the deck's custom flags are recorded so that it can be rebuilt from them.
+    """
+    existing_id = col.decks.id_for_name(name)
+    existing = col.decks.get(existing_id) if existing_id else None
+    did = existing_id if existing and existing["dyn"] else DeckId(0)
+    cids = _cards_to_study(col, cids, did)
+    deck = col.sched.get_or_create_filtered_deck(deck_id=did)
+    deck.name = name
+    del deck.config.search_terms[:]
+    deck.config.search_terms.append(
+        FilteredDeckConfig.SearchTerm(
+            search=f"cid:{','.join(str(cid) for cid in cids)}",
+            limit=len(cids),
+            order=FilteredDeckConfig.SearchTerm.Order.DUE,
+        )
+    )
+    out = col.sched.add_or_update_filtered_deck(deck)
+    # Drop decks that were deleted since they were built
+    study_decks = {
+        key: value
+        for key, value in col.get_config(STUDY_DECKS_CONFIG_KEY, {}).items()
+        if col.decks.get(DeckId(int(key)), default=False)
+    }
+    study_decks[str(out.id)] = list(flags)
+    col.set_config(STUDY_DECKS_CONFIG_KEY, study_decks)
+    return out
+
+
+def study_deck_flags(col: Collection, did: DeckId) -> Optional[List[int]]:
+    """Return the custom flags of a filtered deck built by the add-on, or None if it's another deck."""
+    deck = col.decks.get(did, default=False)
+    if not deck or not deck["dyn"]:
+        return None
+    return col.get_config(STUDY_DECKS_CONFIG_KEY, {}).get(str(did))
@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import hashlib
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+
+
+class CachedStylesheet:
+    """A generated stylesheet written to a web exports folder once per config version.
+
+    The file name includes a hash of its content, so webviews can cache it and a
+    changed stylesheet is always fetched under a new URL.
+    """
+
+    PREFIX = "flags-"
+
+    def __init__(
+        self,
+        directory: Path,
+        url_prefix: str,
+        build_css: Callable[[], str],
+        config_version: Callable[[], int],
+    ) -> None:
+        self.directory = directory
+        self.url_prefix = url_prefix
+        self._build_css = build_css
+        self._config_version = config_version
+        # (config version, file name)
+        self._current: Optional[Tuple[int, str]] = None
+
+    def _write(self) -> str:
+        css = self._build_css()
+        digest = hashlib.sha1(css.encode("utf-8")).hexdigest()[:12]
+        name = f"{self.PREFIX}{digest}.css"
+        path = self.directory / name
+        if not path.exists():
+            self.directory.mkdir(parents=True, exist_ok=True)
+            for old_path in self.directory.glob(f"{self.PREFIX}*.css"):
+                old_path.unlink()
+            path.write_text(css, encoding="utf-8")
+        return name
+
+    def url(self) -> str:
+        """Return the URL of the stylesheet, writing it first if the config changed."""
+        version = self._config_version()
+        if self._current is None or self._current[0] != version:
+            self._current = (version, self._write())
+        return f"{self.url_prefix}/{self._current[1]}"
@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import csv
+import json
+from pathlib import Path
+from typing import IO, Any, Dict, Iterator, List, Mapping, Optional, Sequence
+
+from anki.cards import CardId
+from anki.collection import Collection
+from anki.utils import ids2str
+
+from .bulk import (
+    CHUNK_SIZE,
+    BulkFlagResult,
+    ProgressCallback,
+    write_custom_flag_masks,
+    write_custom_flags,
+)
+from .custom_data import (
+    CUSTOM_DATA_KEY,
+    MAX_MULTI_FLAGS,
+    custom_flags_from_card_data,
+    flag_bit,
+)
+from .profiling import measure
+
+IMPORT_CUSTOM_FLAGS_LABEL = "Import Custom Flags"
+FIELDS = ["card_id", "note_guid", "ord", "flag_label", "flag_index"]
+
+
+def _is_csv(path: Path) -> bool:
+    return path.suffix.lower() == ".csv"
+
+
+def _write_records(
+    file: IO[str], path: Path, records: Sequence[Dict[str, Any]], header: bool
+) -> None:
+    if _is_csv(path):
+        writer = csv.DictWriter(file, fieldnames=FIELDS)
+        if header:
+            writer.writeheader()
+        writer.writerows(records)
+    else:
+        file.writelines(json.dumps(record) + "\n" for record in records)
+
+
+def export_custom_flags(
+    col: Collection,
+    path: Path,
+    labels: Sequence[str],
+    on_progress: Optional[ProgressCallback] = None,
+    chunk_size: int = CHUNK_SIZE,
+    multi: bool = False,
+) -> int:
+    """Write the custom flags of all cards to a CSV or JSON Lines file, depending on the extension.
+
+    Cards are read in chunks ordered by id, so memory use doesn't grow with the
+    collection size. `labels` are the labels of the configured custom flags.
+    In multi-flag mode, a record is written for each flag of a card.
+    Returns the number of exported records, or -1 if cancelled.
+    """
+    total = col.db.scalar(
+        "select count() from cards where data like ?", f"%{CUSTOM_DATA_KEY}%"
+    )
+    exported = processed = 0
+    last_id = 0
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        _write_records(file, path, [], header=True)
+        while True:
+            rows = col.db.all(
+                "select c.id, n.guid, c.ord, c.data from cards c, notes n "
+                "where c.nid = n.id and c.id > ? and c.data like ? order by c.id limit ?",
+                last_id,
+                f"%{CUSTOM_DATA_KEY}%",
+                chunk_size,
+            )
+            if not rows:
+                break
+            records = []
+            for cid, guid, ord, data in rows:
+                for flag in custom_flags_from_card_data(data, multi):
+                    records.append(
+                        {
+                            "card_id": cid,
+                            "note_guid": guid,
+                            "ord": ord,
+                            "flag_label": (
+                                labels[flag - 1] if flag <= len(labels) else ""
+                            ),
+                            "flag_index": flag,
+                        }
+                    )
+            _write_records(file, path, records, header=False)
+            exported += len(records)
+            processed += len(rows)
+            last_id = rows[-1][0]
+            if on_progress and not on_progress(processed, total):
+                return -1
+    return exported
+
+
+def _read_records(path: Path) -> Iterator[Dict[str, Any]]:
+    with open(path, encoding="utf-8", newline="") as file:
+        if _is_csv(path):
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def count_records(path: Path) -> int:
+    return sum(1 for _ in _read_records(path))
+
+
+def _chunked_records(
+    records: Iterator[Dict[str, Any]], size: int
+) -> Iterator[List[Dict[str, Any]]]:
+    chunk: List[Dict[str, Any]] = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _resolve_card_ids(
+    col: Collection, records: Sequence[Dict[str, Any]]
+) -> List[Optional[CardId]]:
+    """Find the cards of the given records, by note GUID and template ordinal if available, otherwise by card id."""
+    guids = {record["note_guid"] for record in records if record.get("note_guid")}
+    by_guid: Dict[tuple[str, int], CardId] = {}
+    if guids:
+        placeholders = ",".join("?" * len(guids))
+        for cid, guid, ord in col.db.execute(
+            "select c.id, n.guid, c.ord from cards c, notes n "
+            f"where c.nid = n.id and n.guid in ({placeholders})",
+            *guids,
+        ):
+            by_guid[(guid, ord)] = CardId(cid)
+    fallback_ids = [
+        int(record["card_id"])
+        for record in records
+        if not record.get("note_guid") and record.get("card_id")
+    ]
+    existing_ids = (
+        set(col.db.list(f"select id from cards where id in {ids2str(fallback_ids)}"))
+        if fallback_ids
+        else set()
+    )
+    card_ids: List[Optional[CardId]] = []
+    for record in records:
+        if record.get("note_guid"):
+            card_ids.append(
+                by_guid.get((record["note_guid"], int(record.get("ord") or 0)))
+            )
+        elif record.get("card_id") and int(record["card_id"]) in existing_ids:
+            card_ids.append(CardId(int(record["card_id"])))
+        else:
+            card_ids.append(None)
+    return card_ids
+
+
+def _resolve_flag(record: Dict[str, Any], index_by_label: Mapping[str, int]) -> int:
+    """Prefer the flag with the record's label, so assignments survive reordering flags."""
+    label = record.get("flag_label")
+    if label and label in index_by_label:
+        return index_by_label[label]
+    return int(record.get("flag_index") or 0)
+
+
+def import_custom_flags(
+    col: Collection,
+    path: Path,
+    index_by_label: Mapping[str, int],
+    on_progress: Optional[ProgressCallback] = None,
+    chunk_size: int = CHUNK_SIZE,
+    multi: bool = False,
+) -> BulkFlagResult:
+    """Apply custom flags from a file written by `export_custom_flags()`.
+
+    Records are read and applied in chunks, and all changes are merged into a single
+    undo entry. Records whose cards don't exist in the collection are skipped.
+    In multi-flag mode, the flags of all records of a card replace its flags;
+    otherwise the card gets the lowest of them.
+    """
+    with measure() as measurement:
+        total = count_records(path) if on_progress else 0
+        write = write_custom_flag_masks if multi else write_custom_flags
+        target = col.add_custom_undo_entry(IMPORT_CUSTOM_FLAGS_LABEL)
+        processed = updated = 0
+        cancelled = False
+        # Records of a card are written next to each other, but may be split across chunks
+        pending: Dict[CardId, int] = {}
+        for records in _chunked_records(_read_records(path), chunk_size):
+            flags: Dict[CardId, int] = pending
+            pending = {}
+            cid = None
+            for record, cid in zip(records, _resolve_card_ids(col, records)):
+                if cid is None:
+                    continue
+                flag = _resolve_flag(record, index_by_label)
+                if multi:
+                    if flag > MAX_MULTI_FLAGS:
+                        # Doesn't fit in a bitmask
+                        continue
+                    flags[cid] = flags.get(cid, 0) | (flag_bit(flag) if flag else 0)
+                else:
+                    # Cards exported with several flags get the lowest one
+                    flags[cid] = min(flags[cid], flag) if flags.get(cid) else flag
+            if cid is not None and len(records) == chunk_size:
+                pending[cid] = flags.pop(cid)
+            updated += write(col, flags)
+            processed += len(records)
+            if on_progress and not on_progress(processed, total):
+                cancelled = True
+                break
+        if pending and not cancelled:
+            updated += write(col, pending)
+        changes = col.merge_undo_entries(target)
+        changes.study_queues = False
+        changes.browser_sidebar = True
+
+    return BulkFlagResult(
+        changes=changes,
+        count=updated,
+        processed=processed,
+        elapsed=measurement.elapsed,
+        peak_memory=measurement.peak_memory,
+        cancelled=cancelled,
+    )
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+from typing import Dict, Optional, Tuple
+
+from anki.cards import CardId
+from anki.collection import Collection, OpChanges
+from anki.errors import NotFoundError
+from aqt import mw
+from aqt.operations import CollectionOp
+from aqt.qt import QTimer, qconnect
+
+from .custom_data import (
+    apply_card_custom_flag,
+    apply_card_custom_flag_mask,
+    flag_change,
+    flag_mask_change,
+    notify_custom_flags_changed,
+)
+
+
+class FlagWriteBuffer:
+    """Coalesces custom flag changes made in the reviewer into one write per card.
+
+    Pending changes are flushed after a short quiet period, or earlier when the
+    reviewer moves to another card or closes. Cards are reloaded when flushing, so a
+    change that happened in the meantime (e.g. answering the card) is not overwritten.
+    """
+
+    DELAY_MS = 500
+
+    def __init__(self) -> None:
+        # Card id -> (flag or bitmask, whether it's a bitmask)
+        self._pending: Dict[CardId, Tuple[int, bool]] = {}
+        self._timer: Optional[QTimer] = None
+
+    def add(self, cid: CardId, flag: int) -> None:
+        self._add(cid, (flag, False))
+
+    def add_mask(self, cid: CardId, mask: int) -> None:
+        """Like `add()`, but sets all custom flags of the card from a bitmask."""
+        self._add(cid, (mask, True))
+
+    def _add(self, cid: CardId, value: Tuple[int, bool]) -> None:
+        self._pending[cid] = value
+        if self._timer is None:
+            self._timer = QTimer(mw)
+            self._timer.setSingleShot(True)
+            qconnect(self._timer.timeout, self.flush)
+        self._timer.start(self.DELAY_MS)
+
+    def discard(self, cid: CardId) -> None:
+        """Drop the pending change of the card, e.g. when it's replaced by a built-in flag."""
+        self._pending.pop(cid, None)
+
+    def _take_pending(self) -> Dict[CardId, Tuple[int, bool]]:
+        # Timers can only be stopped from their thread; firing without pending changes is harmless
+        if self._timer and mw.inMainThread():
+            self._timer.stop()
+        pending = self._pending
+        self._pending = {}
+        return pending
+
+    @staticmethod
+    def _write(col: Collection, pending: Dict[CardId, Tuple[int, bool]]) -> OpChanges:
+        # A "Set Flag" entry lets undo be recognized as a flag-only change
+        target = col.add_custom_undo_entry(col.tr.actions_set_flag())
+        cards = []
+        flag_changes = []
+        for cid, (value, is_mask) in pending.items():
+            try:
+                card = col.get_card(cid)
+            except NotFoundError:
+                continue
+            if is_mask:
+                flag_changes.append(flag_mask_change(card, value))
+                apply_card_custom_flag_mask(card, value)
+            else:
+                flag_changes.append(flag_change(card, value))
+                apply_card_custom_flag(card, value)
+            cards.append(card)
+        col.update_cards(cards)
+        notify_custom_flags_changed(flag_changes)
+        changes = col.merge_undo_entries(target)
+        # Avoid resetting reviewer
+        changes.study_queues = False
+        # Refresh flag counts in the sidebar
+        changes.browser_sidebar = True
+        return changes
+
+    def flush(self) -> None:
+        """Write pending changes in the background."""
+        pending = self._take_pending()
+        if pending:
+            CollectionOp(mw, lambda col: self._write(col, pending)).run_in_background()
+
+    def flush_now(self) -> None:
+        """Write pending changes on the current thread, e.g. when the collection is about to close.
+
+        Safe to call from a background thread.
+        """
+        pending = self._take_pending()
+        if pending and mw.col:
+            self._write(mw.col, pending)
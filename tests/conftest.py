@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import importlib
+from pathlib import Path
+from types import ModuleType
+from typing import Iterator, List
+
+import pytest
+from anki.collection import AddNoteRequest, CardId, Collection
+from anki.decks import DeckId
+
+from . import headless
+
+
+@pytest.fixture(scope="session")
+def main() -> ModuleType:
+    """The add-on's main module, imported against the headless aqt stand-in.
+
+    Its patches apply to Anki's Card and Collection classes for the rest of the session.
+    """
+    pytest.importorskip("ankiutils")
+    headless.install()
+    return importlib.import_module("src.main")
+
+
+@pytest.fixture
+def mw(main: ModuleType, tmp_path: Path) -> Iterator[headless.MainWindow]:
+    """The fake main window with an empty collection open."""
+    # The backend has no in-memory collections; ":memory:" would create a file of that name
+    col = Collection(str(tmp_path / "collection.anki2"))
+    with headless.attach(main, col, tmp_path) as window:
+        yield window
+    col.close()
+
+
+@pytest.fixture
+def col(tmp_path: Path) -> Iterator[Collection]:
+    """An empty collection, for tests that don't need the GUI."""
+    col = Collection(str(tmp_path / "collection.anki2"))
+    yield col
+    col.close()
+
+
+@pytest.fixture
+def cids(col: Collection) -> List[CardId]:
+    """Add 6 cards to `col`."""
+    notetype = col.models.by_name("Basic")
+    requests = []
+    for i in range(6):
+        note = col.new_note(notetype)
+        note["Front"] = f"front {i}"
+        requests.append(AddNoteRequest(note=note, deck_id=DeckId(1)))
+    col.add_notes(requests)
+    return sorted(col.find_cards(""))
@@ -0,0 +1,948 @@
+"""A headless stand-in for the parts of aqt that the add-on uses.
+
+`install()` registers fake `aqt` modules in `sys.modules`, so `src.main` can be
+imported and its patches and hooks exercised without a running Anki. The fakes
+drive a real collection and real Qt objects (using the offscreen platform), and
+only mimic the behavior of Anki's GUI classes that the add-on relies on.
+
+Operations are queued like background operations in Anki, and run when
+`mw.taskman.run_pending()` is called.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import dataclasses
+import enum
+import functools
+import json
+import os
+import sys
+from pathlib import Path
+from types import ModuleType
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Sequence,
+    TypeVar,
+    Union,
+)
+
+from anki.cards import Card, CardId
+from anki.collection import Collection, OpChanges, SearchNode
+from anki.notes import NoteId
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+# pylint: disable=wrong-import-position,wrong-import-order
+from PyQt6 import QtCore, QtGui, QtWidgets, sip
+from PyQt6.QtCore import (
+    QAbstractItemModel,
+    QAbstractTableModel,
+    QModelIndex,
+    Qt,
+    QVariant,
+)
+from PyQt6.QtGui import QAction, QCursor
+from PyQt6.QtWidgets import QApplication, QMainWindow, QMenu, QWidget
+
+# Filter hooks pass their first argument through the callbacks and return it
+FILTER_HOOKS = {"reviewer_will_answer_card"}
+
+
+class Hook:
+    """A list of callbacks, like the hooks of `aqt.gui_hooks`."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._hooks: List[Callable] = []
+
+    def append(self, callback: Callable) -> None:
+        self._hooks.append(callback)
+
+    def remove(self, callback: Callable) -> None:
+        if callback in self._hooks:
+            self._hooks.remove(callback)
+
+    def count(self) -> int:
+        return len(self._hooks)
+
+    def __call__(self, *args: Any) -> Any:
+        if self.name in FILTER_HOOKS:
+            value = args[0]
+            for hook in self._hooks:
+                value = hook(value, *args[1:])
+            return value
+        for hook in self._hooks:
+            hook(*args)
+        return None
+
+
+class GuiHooks(ModuleType):
+    """Creates hooks on first access, so any hook of `aqt.gui_hooks` can be used."""
+
+    def __getattr__(self, name: str) -> Hook:
+        if name.startswith("__"):
+            raise AttributeError(name)
+        hook = Hook(name)
+        setattr(self, name, hook)
+        return hook
+
+
+gui_hooks = GuiHooks("aqt.gui_hooks")
+
+
+def qconnect(signal: Any, func: Callable) -> None:
+    signal.connect(func)
+
+
+def tooltip(msg: str, period: int = 3000, parent: Optional[QWidget] = None) -> None:
+    tooltips.append(msg)
+
+
+# Messages passed to tooltip()
+tooltips: List[str] = []
+
+
+def qtMenuShortcutWorkaround(qmenu: QMenu) -> None:
+    pass
+
+
+def getFile(*args: Any, **kwargs: Any) -> None:
+    # File dialogs can't be answered headless
+    return None
+
+
+def getSaveFile(*args: Any, **kwargs: Any) -> None:
+    return None
+
+
+def askUser(*args: Any, **kwargs: Any) -> bool:
+    return True
+
+
+class colors:
+    FG_DISABLED = {"light": "#858585", "dark": "#858585"}
+    FLAG_1 = {"light": "#ff9b77", "dark": "#ff9b77"}
+    FLAG_2 = {"light": "#f5aa41", "dark": "#f5aa41"}
+    FLAG_3 = {"light": "#86ce5d", "dark": "#86ce5d"}
+    FLAG_4 = {"light": "#6f9dfa", "dark": "#6f9dfa"}
+    FLAG_5 = {"light": "#f5b6c1", "dark": "#f5b6c1"}
+    FLAG_6 = {"light": "#5ccfca", "dark": "#5ccfca"}
+    FLAG_7 = {"light": "#9f63d3", "dark": "#9f63d3"}
+
+
+@dataclasses.dataclass(frozen=True)
+class ColoredIcon:
+    path: str
+    color: Any
+
+    def with_color(self, color: Any) -> ColoredIcon:
+        return ColoredIcon(path=self.path, color=color)
+
+
+@dataclasses.dataclass
+class WebContent:
+    body: str = ""
+    head: str = ""
+    css: List[str] = dataclasses.field(default_factory=list)
+    js: List[str] = dataclasses.field(default_factory=list)
+
+
+class WebView:
+    """Records the scripts evaluated in the webview instead of running them."""
+
+    def __init__(self) -> None:
+        self.content: Optional[WebContent] = None
+        self.evals: List[str] = []
+
+    def stdHtml(self, context: Any) -> None:
+        self.content = WebContent()
+        gui_hooks.webview_will_set_content(self.content, context)
+
+    def eval(self, js: str) -> None:
+        self.evals.append(js)
+
+
+class TaskManager:
+    """Runs background operations when asked to, on the calling thread."""
+
+    def __init__(self) -> None:
+        self._pending: List[Callable[[], None]] = []
+
+    def run_in_background(self, task: Callable[[], None]) -> None:
+        self._pending.append(task)
+
+    def run_on_main(self, closure: Callable[[], None]) -> None:
+        closure()
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def clear(self) -> None:
+        self._pending.clear()
+
+    def run_pending(self) -> None:
+        """Run queued operations, including ones queued by operations that finish meanwhile."""
+        while self._pending:
+            self._pending.pop(0)()
+
+
+class ProgressManager:
+    def __init__(self) -> None:
+        self.updates: List[Dict[str, Any]] = []
+
+    def update(self, **kwargs: Any) -> None:
+        self.updates.append(kwargs)
+
+    def want_cancel(self) -> bool:
+        return False
+
+    def finish(self) -> None:
+        pass
+
+
+class CollectionOp:
+    def __init__(self, parent: Optional[QWidget], op: Callable[[Collection], Any]):
+        self._parent = parent
+        self._op = op
+        self._success: Optional[Callable[[Any], Any]] = None
+        self._failure: Optional[Callable[[Exception], Any]] = None
+
+    def success(self, success: Optional[Callable[[Any], Any]]) -> CollectionOp:
+        self._success = success
+        return self
+
+    def failure(self, failure: Optional[Callable[[Exception], Any]]) -> CollectionOp:
+        self._failure = failure
+        return self
+
+    def with_backend_progress(self, progress_update: Any) -> CollectionOp:
+        return self
+
+    def run_in_background(self, *, initiator: Optional[object] = None) -> None:
+        mw.taskman.run_in_background(functools.partial(self._run, initiator))
+
+    def _run(self, initiator: Optional[object]) -> None:
+        try:
+            result = self._op(mw.col)
+        except Exception as exc:
+            if not self._failure:
+                raise
+            self._failure(exc)
+            return
+        if self._success:
+            self._success(result)
+        changes = result if isinstance(result, OpChanges) else result.changes
+        gui_hooks.operation_did_execute(changes, initiator)
+
+
+class QueryOp:
+    def __init__(
+        self,
+        *,
+        parent: Optional[QWidget],
+        op: Callable[[Collection], Any],
+        success: Callable[[Any], Any],
+    ) -> None:
+        self._parent = parent
+        self._op = op
+        self._success = success
+        self._failure: Optional[Callable[[Exception], Any]] = None
+
+    def failure(self, failure: Optional[Callable[[Exception], Any]]) -> QueryOp:
+        self._failure = failure
+        return self
+
+    def with_progress(self, label: Optional[str] = None) -> QueryOp:
+        return self
+
+    def without_collection(self) -> QueryOp:
+        return self
+
+    def run_in_background(self) -> None:
+        mw.taskman.run_in_background(self._run)
+
+    def _run(self) -> None:
+        try:
+            result = self._op(mw.col)
+        except Exception as exc:
+            if not self._failure:
+                raise
+            self._failure(exc)
+            return
+        self._success(result)
+
+
+@dataclasses.dataclass
+class Flag:
+    index: int
+    label: str
+    icon: ColoredIcon
+    search_node: SearchNode
+    action: str
+
+
+BUILTIN_FLAGS = [
+    (SearchNode.FLAG_RED, "actionRed_Flag", "actions_flag_red"),
+    (SearchNode.FLAG_ORANGE, "actionOrange_Flag", "actions_flag_orange"),
+    (SearchNode.FLAG_GREEN, "actionGreen_Flag", "actions_flag_green"),
+    (SearchNode.FLAG_BLUE, "actionBlue_Flag", "actions_flag_blue"),
+    (SearchNode.FLAG_PINK, "actionPink_Flag", "actions_flag_pink"),
+    (SearchNode.FLAG_TURQUOISE, "actionTurquoise_Flag", "actions_flag_turquoise"),
+    (SearchNode.FLAG_PURPLE, "actionPurple_Flag", "actions_flag_purple"),
+]
+
+
+class FlagManager:
+    def __init__(self, mw: MainWindow) -> None:
+        self.mw = mw
+        self._flags: List[Flag] = []
+
+    def all(self) -> List[Flag]:
+        if not self._flags:
+            self._load_flags()
+        return self._flags
+
+    def get_flag(self, flag_index: int) -> Flag:
+        if not 1 <= flag_index <= len(self.all()):
+            raise Exception(f"Flag index out of range (1-{len(self.all())}).")
+        return self.all()[flag_index - 1]
+
+    def rename_flag(self, flag_index: int, new_name: str) -> None:
+        if new_name in ("", self.get_flag(flag_index).label):
+            return
+        labels = self.mw.col.get_config("flagLabels", {})
+        labels[str(flag_index)] = self.get_flag(flag_index).label = new_name
+        self.mw.col.set_config("flagLabels", labels)
+        gui_hooks.flag_label_did_change()
+
+    def require_refresh(self) -> None:
+        self._flags = []
+
+    def _load_flags(self) -> None:
+        labels = self.mw.col.get_config("flagLabels", {})
+        icon = ColoredIcon(path="icons:flag-variant.svg", color=colors.FG_DISABLED)
+        self._flags = [
+            Flag(
+                i,
+                labels.get(str(i)) or getattr(self.mw.col.tr, label_key)(),
+                icon.with_color(getattr(colors, f"FLAG_{i}")),
+                SearchNode(flag=node_flag),
+                action,
+            )
+            for i, (node_flag, action, label_key) in enumerate(BUILTIN_FLAGS, start=1)
+        ]
+
+
+class Reviewer:
+    def __init__(self, mw: MainWindow) -> None:
+        self.mw = mw
+        self.web = WebView()
+        self.card: Optional[Card] = None
+        self._v3 = None
+
+    def show_question(self, card: Card) -> None:
+        """Show the card's question, finishing the previous card like Anki does."""
+        if self.mw.state != "review":
+            self.mw.state = "review"
+            self.web.stdHtml(self)
+        self.card = card
+        card.start_timer()
+        self._update_flag_icon()
+        gui_hooks.reviewer_did_show_question(card)
+
+    def answer_card(self, ease: Literal[1, 2, 3, 4]) -> None:
+        assert self.card
+        proceed, ease = gui_hooks.reviewer_will_answer_card(
+            (True, ease), self, self.card
+        )
+        if not proceed:
+            return
+        card = self.card
+        # Like Anki, answer in the background, so operation hooks see the answer
+        CollectionOp(
+            self.mw, lambda col: col.sched.answerCard(card, ease)
+        ).run_in_background(initiator=self)
+
+    def end(self) -> None:
+        gui_hooks.reviewer_will_end()
+        self.card = None
+        self.mw.state = "overview"
+
+    def set_flag_on_current_card(self, desired_flag: int) -> None:
+        assert self.card
+        card = self.card
+        flag = 0 if card.user_flag() == desired_flag else desired_flag
+
+        def redraw_flag(_: Any) -> None:
+            if self.card is card:
+                card.load()
+                self._update_flag_icon()
+
+        CollectionOp(
+            self.mw, lambda col: col.set_user_flag_for_cards(flag, [card.id])
+        ).success(redraw_flag).run_in_background()
+
+    def set_flag_func(self, desired_flag: int) -> Callable:
+        return lambda: self.set_flag_on_current_card(desired_flag)
+
+    def _update_flag_icon(self) -> None:
+        assert self.card
+        self.web.eval(f"_drawFlag({self.card.user_flag()});")
+
+    def _shortcutKeys(self) -> List[Any]:
+        return [
+            ("Ctrl+Delete", lambda: None),
+            *(
+                (f"Ctrl+{flag.index}", self.set_flag_func(flag.index))
+                for flag in self.mw.flags.all()
+            ),
+        ]
+
+    def _contextMenu(self) -> List[Any]:
+        assert self.card
+        current_flag = self.card.user_flag()
+        return [
+            [
+                self.mw.col.tr.studying_flag_card(),
+                [
+                    [
+                        flag.label,
+                        f"Ctrl+{flag.index}",
+                        self.set_flag_func(flag.index),
+                        dict(checked=current_flag == flag.index),
+                    ]
+                    for flag in self.mw.flags.all()
+                ],
+            ],
+            None,
+            [self.mw.col.tr.studying_bury_card(), "-", lambda: None],
+        ]
+
+    def _addMenuItems(self, m: QMenu, rows: Sequence) -> None:
+        for row in rows:
+            if not row:
+                m.addSeparator()
+                continue
+            if len(row) == 2:
+                subm = m.addMenu(row[0])
+                self._addMenuItems(subm, row[1])
+                continue
+            opts = row[3] if len(row) == 4 else {}
+            a = m.addAction(row[0])
+            a.setShortcut(row[1])
+            if opts.get("checked"):
+                a.setCheckable(True)
+                a.setChecked(True)
+            qconnect(a.triggered, row[2])
+
+    def showContextMenu(self) -> None:
+        opts = self._contextMenu()
+        m = QMenu(self.mw)
+        self._addMenuItems(m, opts)
+        gui_hooks.reviewer_will_show_context_menu(self, m)
+        m.popup(QCursor.pos())
+
+
+ItemId = Union[CardId, NoteId]
+
+
+@dataclasses.dataclass
+class Cell:
+    text: str
+
+
+@dataclasses.dataclass
+class CellRow:
+    cells: List[Cell]
+    color: Any = None
+
+
+@dataclasses.dataclass
+class SearchContext:
+    search: str
+    browser: Browser
+    order: Any = True
+    reverse: bool = False
+    ids: Optional[Sequence[ItemId]] = None
+
+
+class SidebarItemType(enum.Enum):
+    ROOT = 0
+    FLAG_ROOT = 1
+    FLAG = 2
+    FLAG_NONE = 3
+
+
+class SidebarItem:
+    def __init__(
+        self,
+        name: str,
+        icon: Any = None,
+        search_node: Optional[SearchNode] = None,
+        item_type: SidebarItemType = SidebarItemType.ROOT,
+        id: int = 0,
+    ) -> None:
+        self.name = name
+        self.icon = icon
+        self.search_node = search_node
+        self.item_type = item_type
+        self.id = id
+        self.children: List[SidebarItem] = []
+
+    def add_child(self, child: SidebarItem) -> None:
+        self.children.append(child)
+
+
+class SidebarModel(QAbstractItemModel):
+    """Only reads the text of items; the fake tree view has no real Qt view."""
+
+    def __init__(self, sidebar: SidebarTreeView) -> None:
+        super().__init__()
+        self.sidebar = sidebar
+
+    def index_of(self, item: SidebarItem) -> QModelIndex:
+        return self.createIndex(0, 0, item)
+
+    def data(
+        self, index: QModelIndex, role: int = Qt.ItemDataRole.DisplayRole
+    ) -> QVariant:
+        if not index.isValid():
+            return QVariant()
+        item: SidebarItem = index.internalPointer()
+        if role in (Qt.ItemDataRole.DisplayRole, Qt.ItemDataRole.EditRole):
+            return QVariant(item.name)
+        return QVariant()
+
+
+class SidebarTreeView:
+    def __init__(self, browser: Browser) -> None:
+        self.browser = browser
+        self.mw = browser.mw
+        self.root: Optional[SidebarItem] = None
+        self._model = SidebarModel(self)
+
+    def model(self) -> SidebarModel:
+        return self._model
+
+    def _on_rename(self, item: SidebarItem, text: str) -> bool:
+        new_name = text.replace('"', "")
+        if new_name and new_name != item.name:
+            if item.item_type == SidebarItemType.FLAG:
+                self.rename_flag(item, new_name)
+        return False
+
+    def rename_flag(self, item: SidebarItem, new_name: str) -> None:
+        item.name = new_name
+        self.mw.flags.rename_flag(item.id, new_name)
+
+    def refresh(self) -> None:
+        root = SidebarItem("")
+        self._flags_tree(root)
+        self.root = root
+
+    def _flags_tree(self, root: SidebarItem) -> None:
+        flag_root = SidebarItem(
+            self.mw.col.tr.browsing_sidebar_flags(),
+            search_node=SearchNode(flag=SearchNode.FLAG_ANY),
+            item_type=SidebarItemType.FLAG_ROOT,
+        )
+        root.add_child(flag_root)
+        for flag in self.mw.flags.all():
+            flag_root.add_child(
+                SidebarItem(
+                    flag.label,
+                    flag.icon,
+                    search_node=flag.search_node,
+                    item_type=SidebarItemType.FLAG,
+                    id=flag.index,
+                )
+            )
+        flag_root.add_child(
+            SidebarItem(
+                self.mw.col.tr.browsing_no_flag(),
+                search_node=SearchNode(flag=SearchNode.FLAG_NONE),
+                item_type=SidebarItemType.FLAG_NONE,
+            )
+        )
+
+
+class TableState:
+    def __init__(self, notes_mode: bool = False) -> None:
+        self.notes_mode = notes_mode
+        self.active_columns: List[str] = ["sortField", "cardDue"]
+
+    def is_notes_mode(self) -> bool:
+        return self.notes_mode
+
+
+class DataModel(QAbstractTableModel):
+    """The rows of the current search, fetched and cached on first access like in Anki."""
+
+    def __init__(self, col: Collection, state: TableState) -> None:
+        super().__init__()
+        self.col = col
+        self._state = state
+        self._items: List[ItemId] = []
+        self._rows: Dict[ItemId, CellRow] = {}
+
+    def reset(self, items: Sequence[ItemId]) -> None:
+        self.beginResetModel()
+        self._items = list(items)
+        self._rows = {}
+        self.endResetModel()
+
+    def len_columns(self) -> int:
+        return len(self._state.active_columns)
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self._items)
+
+    def columnCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        return 0 if parent.isValid() else self.len_columns()
+
+    def data(self, index: QModelIndex, role: int = 0) -> Any:
+        return None
+
+    def get_row(self, position: int) -> CellRow:
+        item = self._items[position]
+        row = self._rows.get(item)
+        if row is None:
+            row = CellRow([Cell("") for _ in self._state.active_columns])
+            gui_hooks.browser_did_fetch_row(
+                item, self._state.is_notes_mode(), row, self._state.active_columns
+            )
+            self._rows[item] = row
+        return row
+
+
+class Table:
+    def __init__(self, browser: Browser) -> None:
+        self.browser = browser
+        self._state = TableState()
+        self._model = DataModel(browser.mw.col, self._state)
+        self.redraws = 0
+
+    def is_notes_mode(self) -> bool:
+        return self._state.is_notes_mode()
+
+    def search(self, text: str, order: Any = True, reverse: bool = False) -> None:
+        context = SearchContext(text, self.browser, order=order, reverse=reverse)
+        gui_hooks.browser_will_search(context)
+        col = self.browser.mw.col
+        if self.is_notes_mode():
+            ids: Sequence[ItemId] = col.find_notes(
+                context.search, order=context.order, reverse=context.reverse
+            )
+        else:
+            ids = col.find_cards(
+                context.search, order=context.order, reverse=context.reverse
+            )
+        context.ids = ids
+        self._model.reset(ids)
+        gui_hooks.browser_did_search(context)
+
+    def redraw_cells(self) -> None:
+        self.redraws += 1
+
+
+class BrowserForm:
+    def __init__(self, browser: Browser) -> None:
+        self.menuFlag = QMenu("Flag", browser)
+        for _, action, _ in BUILTIN_FLAGS:
+            flag_action = QAction(browser)
+            flag_action.setCheckable(True)
+            self.menuFlag.addAction(flag_action)
+            setattr(self, action, flag_action)
+
+
+class Browser(QMainWindow):
+    def __init__(self, mw: MainWindow) -> None:
+        super().__init__()
+        self.mw = mw
+        self.card: Optional[Card] = None
+        self.current_card: Optional[Card] = None
+        self._selected: List[CardId] = []
+        self.form = BrowserForm(self)
+        self.table = Table(self)
+        self.sidebar = SidebarTreeView(self)
+        self.setupMenus()
+        self.sidebar.refresh()
+        gui_hooks.operation_did_execute.append(self.on_operation_did_execute)
+
+    def setupMenus(self) -> None:
+        for flag in self.mw.flags.all():
+            qconnect(
+                getattr(self.form, flag.action).triggered,
+                lambda _, index=flag.index: self.set_flag_of_selected_cards(index),
+            )
+        self._update_flag_labels()
+
+    def select(self, cids: Sequence[CardId]) -> None:
+        """Select the given cards, making the first one current."""
+        self._selected = list(cids)
+        self.card = self.current_card = self.mw.col.get_card(cids[0]) if cids else None
+        self._update_flags_menu()
+
+    def selected_cards(self) -> Sequence[CardId]:
+        return self._selected
+
+    def set_flag_of_selected_cards(self, flag: int) -> None:
+        if not self.card:
+            return
+        if flag == self.card.user_flag():
+            flag = 0
+        cids = self.selected_cards()
+        CollectionOp(
+            self, lambda col: col.set_user_flag_for_cards(flag, cids)
+        ).run_in_background()
+
+    def _update_flags_menu(self) -> None:
+        flag = self.card.user_flag() if self.card else 0
+        for f in self.mw.flags.all():
+            getattr(self.form, f.action).setChecked(flag == f.index)
+
+    def _update_flag_labels(self) -> None:
+        for flag in self.mw.flags.all():
+            getattr(self.form, flag.action).setText(flag.label)
+
+    def on_operation_did_execute(
+        self, changes: OpChanges, handler: Optional[object]
+    ) -> None:
+        if changes.card and self.card:
+            self.card.load()
+
+    def close_browser(self) -> None:
+        gui_hooks.operation_did_execute.remove(self.on_operation_did_execute)
+        dialogs.markClosed("Browser")
+        self.deleteLater()
+
+
+class DialogManager:
+    def __init__(self) -> None:
+        self._dialogs: Dict[str, List[Any]] = {"Browser": [Browser, None]}
+
+    def open(self, name: str, *args: Any) -> Any:
+        creator, instance = self._dialogs[name]
+        if instance is None:
+            instance = self._dialogs[name][1] = creator(*args)
+        return instance
+
+    def markClosed(self, name: str) -> None:
+        self._dialogs[name] = [self._dialogs[name][0], None]
+
+
+dialogs = DialogManager()
+
+
+class AddonManager:
+    """Reads add-on configs from the add-on folder, keeping changes in memory."""
+
+    def __init__(self) -> None:
+        self._configs: Dict[str, Dict[str, Any]] = {}
+        self.config_actions: Dict[str, Callable] = {}
+        self.web_exports: Dict[str, str] = {}
+
+    def addonFromModule(self, module: str) -> str:
+        return module.split(".")[0]
+
+    def addonsFolder(self, module: Optional[str] = None) -> str:
+        root = Path(__file__).parent.parent
+        return str(root / module) if module else str(root)
+
+    def getConfig(self, module: str) -> Dict[str, Any]:
+        addon = self.addonFromModule(module)
+        if addon not in self._configs:
+            path = Path(self.addonsFolder(addon)) / "config.json"
+            self._configs[addon] = json.loads(path.read_text(encoding="utf-8"))
+        return self._configs[addon]
+
+    def writeConfig(self, module: str, conf: Dict[str, Any]) -> None:
+        self._configs[self.addonFromModule(module)] = conf
+
+    def setConfigAction(self, module: str, fn: Callable) -> None:
+        self.config_actions[self.addonFromModule(module)] = fn
+
+    def setWebExports(self, module: str, pattern: str) -> None:
+        self.web_exports[self.addonFromModule(module)] = pattern
+
+
+class Overview:
+    def __init__(self, mw: MainWindow) -> None:
+        self.mw = mw
+
+    def rebuild_current_filtered_deck(self) -> None:
+        did = self.mw.col.decks.selected()
+        CollectionOp(
+            self.mw, lambda col: col.sched.rebuild_filtered_deck(did)
+        ).run_in_background()
+
+
+class MainWindowForm:
+    def __init__(self, mw: MainWindow) -> None:
+        self.menuTools = QMenu("Tools", mw)
+
+
+class ProfileManager:
+    name = "User 1"
+
+
+class MainWindow(QWidget):
+    def __init__(self) -> None:
+        super().__init__()
+        self.col: Optional[Collection] = None
+        self.state = "deckBrowser"
+        self.form = MainWindowForm(self)
+        self.pm = ProfileManager()
+        self.addonManager = AddonManager()
+        self.taskman = TaskManager()
+        self.progress = ProgressManager()
+        self.flags = FlagManager(self)
+        self.reviewer = Reviewer(self)
+        self.overview = Overview(self)
+        self.state_shortcuts: List[Any] = []
+
+    def inMainThread(self) -> bool:
+        return True
+
+    def moveToState(self, state: str) -> None:
+        self.state = state
+
+    def clearStateShortcuts(self) -> None:
+        self.state_shortcuts = []
+
+    def setStateShortcuts(self, shortcuts: List[Any]) -> None:
+        self.state_shortcuts = shortcuts
+
+    def cleanupAndExit(self) -> None:
+        pass
+
+
+def _module(name: str, **attrs: Any) -> ModuleType:
+    module = ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+
+def _qt_module() -> ModuleType:
+    module = ModuleType("aqt.qt")
+    for qt_module in (QtCore, QtGui, QtWidgets):
+        module.__dict__.update(
+            (name, value)
+            for name, value in vars(qt_module).items()
+            if not name.startswith("_")
+        )
+    # Like aqt.qt, which also exports some of its own imports
+    module.__dict__.update(
+        sip=sip,
+        qconnect=qconnect,
+        Callable=Callable,
+        TypeVar=TypeVar,
+        Union=Union,
+        qtmajor=QtCore.QLibraryInfo.version().majorVersion(),
+        qtminor=QtCore.QLibraryInfo.version().minorVersion(),
+    )
+    return module
+
+
+app: Optional[QtCore.QCoreApplication] = None
+mw: MainWindow
+
+
+def install() -> MainWindow:
+    """Register the fake aqt modules, returning the fake main window.
+
+    Modules imported from `src` before that are dropped, so that they're imported
+    again against the fakes.
+    """
+    global app, mw
+
+    import anki.lang
+
+    anki.lang.set_lang("en")
+    app = QApplication.instance() or QApplication([])
+    mw = MainWindow()
+    for name in list(sys.modules):
+        if name == "aqt" or name.startswith(("aqt.", "src.")):
+            del sys.modules[name]
+    modules = {
+        "aqt": _module(
+            "aqt", mw=mw, dialogs=dialogs, gui_hooks=gui_hooks, colors=colors
+        ),
+        "aqt.qt": _qt_module(),
+        "aqt.gui_hooks": gui_hooks,
+        "aqt.colors": _module("aqt.colors", **vars(colors)),
+        "aqt.browser": _module(
+            "aqt.browser",
+            Browser=Browser,
+            CellRow=CellRow,
+            ItemId=ItemId,
+            SearchContext=SearchContext,
+            SidebarItem=SidebarItem,
+            SidebarItemType=SidebarItemType,
+            SidebarModel=SidebarModel,
+            SidebarTreeView=SidebarTreeView,
+        ),
+        "aqt.flags": _module("aqt.flags", Flag=Flag, FlagManager=FlagManager),
+        "aqt.operations": _module(
+            "aqt.operations", CollectionOp=CollectionOp, QueryOp=QueryOp
+        ),
+        "aqt.overview": _module("aqt.overview", Overview=Overview),
+        "aqt.reviewer": _module("aqt.reviewer", Reviewer=Reviewer),
+        "aqt.theme": _module("aqt.theme", ColoredIcon=ColoredIcon),
+        "aqt.utils": _module(
+            "aqt.utils",
+            tr=anki.lang.tr_legacyglobal,
+            tooltip=tooltip,
+            qtMenuShortcutWorkaround=qtMenuShortcutWorkaround,
+            getFile=getFile,
+            getSaveFile=getSaveFile,
+            askUser=askUser,
+        ),
+        "aqt.webview": _module("aqt.webview", WebContent=WebContent),
+    }
+    sys.modules.update(modules)
+    return mw
+
+
+@contextlib.contextmanager
+def attach(main: ModuleType, col: Collection, user_files: Path) -> Iterator[MainWindow]:
+    """Open `col` in the fake main window, resetting the add-on's state afterwards.
+
+    Files the add-on writes to its user_files folder go to `user_files` instead.
+    """
+    config = main.config
+    saved_config = {
+        key: config[key] for key in ("flags", "multi_flags", "show_flag_labels")
+    }
+    mw.col = col
+    mw.flags = FlagManager(mw)
+    mw.flags.all()
+    main.flag_stylesheet.directory = user_files / "web"
+    main.flag_index.open(user_files / "flag_index.db")
+    try:
+        yield mw
+    finally:
+        # Discard changes of operations that a failing test left unfinished
+        mw.taskman.clear()
+        main.flag_write_buffer._take_pending()
+        browser = dialogs._dialogs["Browser"][1]
+        if browser:
+            browser.close_browser()
+        for key, value in saved_config.items():
+            config[key] = value
+        main.flag_index.close()
+        main.flag_counts.mark_stale()
+        main.row_color_provider.clear()
+        main.note_row_color_provider.clear()
+        main.sidebar_flag_labels.clear()
+        mw.reviewer = Reviewer(mw)
+        mw.state = "deckBrowser"
+        mw.col = None
+        tooltips.clear()
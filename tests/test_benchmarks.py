@@ -0,0 +1,307 @@
+"""Benchmarks of the add-on's hot paths on synthetic collections.
+
+They are skipped unless MORE_FLAGS_BENCHMARK is set. Other environment variables:
+
+- MORE_FLAGS_BENCHMARK_SIZES: comma-separated card counts (default: 10000)
+- MORE_FLAGS_BENCHMARK_ROUNDS: rounds per benchmark (default: 5)
+- MORE_FLAGS_BENCHMARK_OUTPUT: path of the JSON results file (default: benchmark_results.json)
+
+Example: MORE_FLAGS_BENCHMARK=1 MORE_FLAGS_BENCHMARK_SIZES=10000,100000,1000000 make bench
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import platform
+import random
+import statistics
+import time
+import tracemalloc
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import pytest
+
+if not os.environ.get("MORE_FLAGS_BENCHMARK"):
+    pytest.skip("MORE_FLAGS_BENCHMARK is not set", allow_module_level=True)
+
+from anki.buildinfo import version as anki_version
+
+# Importing anki.cards before anki.collection causes a circular import
+from anki.collection import AddNoteRequest, CardId, Collection, SearchNode
+from anki.decks import DeckId
+
+from src.bulk import (
+    cards_with_custom_flag,
+    clear_custom_flags,
+    set_custom_flag_for_cards,
+)
+from src.custom_data import (
+    CUSTOM_DATA_KEY,
+    apply_card_custom_flag,
+    get_card_custom_flag,
+    supports_custom_data_prop_search,
+)
+from src.flag_index import FlagIndex
+from src.row_colors import RowColorProvider
+from src.stats import FlagCounts
+
+from . import headless
+
+SIZES = [
+    int(size)
+    for size in os.environ.get("MORE_FLAGS_BENCHMARK_SIZES", "10000").split(",")
+]
+ROUNDS = int(os.environ.get("MORE_FLAGS_BENCHMARK_ROUNDS", "5"))
+OUTPUT = Path(os.environ.get("MORE_FLAGS_BENCHMARK_OUTPUT", "benchmark_results.json"))
+CUSTOM_FLAGS_COUNT = 10
+# Number of cards touched by benchmarks that don't scale with the collection size
+SAMPLE_SIZE = 1000
+ADD_NOTES_BATCH_SIZE = 5000
+
+results: List[Dict[str, Any]] = []
+
+
+def _write_results() -> None:
+    OUTPUT.write_text(
+        json.dumps(
+            {
+                "anki_version": anki_version,
+                "python_version": platform.python_version(),
+                "platform": platform.platform(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "results": results,
+            },
+            indent=4,
+        ),
+        encoding="utf-8",
+    )
+
+
+@pytest.fixture(scope="module", autouse=True)
+def results_file() -> Iterator[None]:
+    yield
+    _write_results()
+
+
+def populate_collection(col: Collection, size: int) -> None:
+    """Add `size` cards, 10% of which have a built-in flag and 10% a custom flag."""
+    notetype = col.models.by_name("Basic")
+    for start in range(0, size, ADD_NOTES_BATCH_SIZE):
+        requests = []
+        for i in range(start, min(start + ADD_NOTES_BATCH_SIZE, size)):
+            note = col.new_note(notetype)
+            note["Front"] = f"front {i}"
+            note["Back"] = f"back {i}"
+            requests.append(AddNoteRequest(note=note, deck_id=DeckId(1)))
+        col.add_notes(requests)
+    rng = random.Random(size)
+    cids = col.find_cards("")
+    for cid in rng.sample(cids, size // 10):
+        col.db.execute(
+            "update cards set flags = ? where id = ?", rng.randint(1, 7), cid
+        )
+    for cid in rng.sample(cids, size // 10):
+        custom_data = json.dumps({CUSTOM_DATA_KEY: rng.randint(1, CUSTOM_FLAGS_COUNT)})
+        col.db.execute(
+            "update cards set flags = 0, data = ? where id = ?",
+            json.dumps({"cd": custom_data}),
+            cid,
+        )
+
+
+@pytest.fixture(scope="module", params=SIZES, ids=lambda size: f"{size}_cards")
+def col(
+    request: pytest.FixtureRequest, tmp_path_factory: pytest.TempPathFactory
+) -> Iterator[Collection]:
+    path = tmp_path_factory.mktemp("benchmark") / "collection.anki2"
+    col = Collection(str(path))
+    populate_collection(col, request.param)
+    yield col
+    col.close()
+
+
+@pytest.fixture
+def benchmark(request: pytest.FixtureRequest, col: Collection) -> Callable[..., Any]:
+    """Time `func` over several rounds and record the stats in the results file."""
+
+    def run(
+        func: Callable[[], Any],
+        setup: Optional[Callable[[], Any]] = None,
+        rounds: int = ROUNDS,
+    ) -> Any:
+        timings = []
+        result = None
+        for _ in range(rounds):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            result = func()
+            timings.append(time.perf_counter() - start)
+        if setup:
+            setup()
+        tracemalloc.start()
+        try:
+            func()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        results.append(
+            {
+                "name": request.node.originalname,
+                "cards": col.card_count(),
+                "rounds": rounds,
+                "min": min(timings),
+                "median": statistics.median(timings),
+                "mean": statistics.mean(timings),
+                "max": max(timings),
+                "peak_memory": peak_memory,
+            }
+        )
+        return result
+
+    return run
+
+
+def sample_card_ids(col: Collection) -> List[CardId]:
+    return random.Random(0).sample(col.find_cards(""), SAMPLE_SIZE)
+
+
+def test_get_card_custom_flag(col: Collection, benchmark: Callable[..., Any]) -> None:
+    cards = [col.get_card(cid) for cid in sample_card_ids(col)]
+    benchmark(lambda: [get_card_custom_flag(card) for card in cards])
+
+
+def test_set_card_custom_flag(col: Collection, benchmark: Callable[..., Any]) -> None:
+    cards = [col.get_card(cid) for cid in sample_card_ids(col)]
+
+    def set_flags() -> None:
+        for card in cards:
+            apply_card_custom_flag(card, 1)
+        for card in cards:
+            apply_card_custom_flag(card, 0)
+
+    benchmark(set_flags)
+
+
+def test_browser_row_colors(col: Collection, benchmark: Callable[..., Any]) -> None:
+    search_ids = col.find_cards("")
+
+    def scroll() -> None:
+        provider = RowColorProvider(
+            lambda flag: {"light": "#fff", "dark": "#000"}, lambda: 0
+        )
+        provider.set_search_ids(search_ids)
+        # Like the browser, paint from the cache and fetch missing windows as needed
+        for cid in search_ids:
+            if provider.peek(cid) is None:
+                ids = provider.missing_window(cid)
+                provider.store(provider.generation, ids, provider.fetch(col, ids))
+                assert provider.peek(cid) is not None
+
+    benchmark(scroll)
+
+
+def test_sidebar_flag_counts(col: Collection, benchmark: Callable[..., Any]) -> None:
+    benchmark(lambda: FlagCounts().totals(col))
+
+
+def test_custom_flag_search(col: Collection, benchmark: Callable[..., Any]) -> None:
+    if not supports_custom_data_prop_search():
+        pytest.skip("custom data search is not supported")
+
+    def search() -> None:
+        for flag in range(1, CUSTOM_FLAGS_COUNT + 1):
+            node = SearchNode(parsable_text=f"prop:cdn:{CUSTOM_DATA_KEY}={flag}")
+            col.find_cards(col.build_search_string(node))
+
+    benchmark(search)
+
+
+def test_flag_index_search(
+    col: Collection, benchmark: Callable[..., Any], tmp_path: Path
+) -> None:
+    index = FlagIndex(lambda: False)
+    index.open(tmp_path / "index.db")
+
+    def rebuild_and_search() -> None:
+        index.mark_stale()
+        for flag in range(1, CUSTOM_FLAGS_COUNT + 1):
+            index.card_ids(col, [flag])
+
+    benchmark(rebuild_and_search)
+    index.close()
+
+
+@pytest.fixture
+def mw(
+    main: ModuleType, col: Collection, tmp_path: Path
+) -> Iterator[headless.MainWindow]:
+    """The headless main window with the benchmark collection open and its custom flags configured."""
+    with headless.attach(main, col, tmp_path) as window:
+        main.config["flags"] = [
+            {"label": f"Flag {i}", "color_light": "#ffd800", "color_dark": "#ffee75"}
+            for i in range(1, CUSTOM_FLAGS_COUNT + 1)
+        ]
+        main.reload_custom_flags()
+        yield window
+
+
+def test_reviewer_flags_end_to_end(
+    col: Collection,
+    main: ModuleType,
+    mw: headless.MainWindow,
+    benchmark: Callable[..., Any],
+) -> None:
+    cards = [col.get_card(cid) for cid in sample_card_ids(col)]
+    reviewer = mw.reviewer
+    flag = main.original_flags_count + 1
+
+    def review() -> None:
+        # Each card is flagged, then unflagged when it's shown again
+        for _ in range(2):
+            for card in cards:
+                reviewer.show_question(card)
+                reviewer.set_flag_on_current_card(flag)
+            reviewer.end()
+            mw.taskman.run_pending()
+
+    benchmark(review)
+
+
+def test_browser_search_end_to_end(
+    col: Collection, mw: headless.MainWindow, benchmark: Callable[..., Any]
+) -> None:
+    browser = headless.dialogs.open("Browser", mw)
+    model = browser.table._model
+
+    def search_and_paint() -> None:
+        browser.table.search("custom-flag:1")
+        mw.taskman.run_pending()
+        for position in range(min(len(model._items), SAMPLE_SIZE)):
+            model.get_row(position)
+        mw.taskman.run_pending()
+
+    benchmark(search_and_paint)
+
+
+def test_bulk_set(col: Collection, benchmark: Callable[..., Any]) -> None:
+    cids = col.find_cards("")
+    # Start each round without custom flags, so that every card is written
+    result = benchmark(
+        lambda: set_custom_flag_for_cards(col, cids, 1),
+        setup=lambda: clear_custom_flags(col, cards_with_custom_flag(col, cids)),
+    )
+    assert result.count == len(cids)
+
+
+def test_bulk_clear(col: Collection, benchmark: Callable[..., Any]) -> None:
+    cids = col.find_cards("")
+
+    benchmark(
+        lambda: clear_custom_flags(col, cards_with_custom_flag(col, cids)),
+        setup=lambda: set_custom_flag_for_cards(col, cids[::10], 1),
+    )
+    assert not cards_with_custom_flag(col, cids)
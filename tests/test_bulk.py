@@ -0,0 +1,102 @@
+"""Tests of the bulk flag operations against a real collection, without the GUI."""
+
+from __future__ import annotations
+
+from typing import List
+
+from anki.collection import CardId, Collection
+
+from src.bulk import (
+    cards_to_remap,
+    migrate_to_flag_masks,
+    remap_custom_flags,
+    remap_flag_mask,
+    toggle_custom_flag_bit_for_cards,
+    write_custom_flag_masks,
+    write_custom_flags,
+)
+from src.custom_data import (
+    card_has_flag_mask,
+    flag_bit,
+    get_card_custom_flag,
+    get_card_custom_flag_mask,
+)
+
+
+def mask(*flags: int) -> int:
+    return sum(flag_bit(flag) for flag in flags)
+
+
+def test_remap_flag_mask() -> None:
+    # Flag 1 deleted, flags 2 and 3 swapped, flag 4 kept
+    mapping = {1: 0, 2: 3, 3: 2}
+    assert remap_flag_mask(mask(1, 2, 4), mapping) == mask(3, 4)
+    assert remap_flag_mask(mask(2, 3), mapping) == mask(2, 3)
+    assert remap_flag_mask(mask(1), mapping) == 0
+    assert remap_flag_mask(0, mapping) == 0
+
+
+def test_cards_to_remap(col: Collection, cids: List[CardId]) -> None:
+    write_custom_flags(col, {cids[0]: 1, cids[1]: 2, cids[2]: 4})
+    write_custom_flag_masks(col, {cids[3]: mask(1, 4), cids[4]: mask(2, 3)})
+
+    remapped, remapped_masks = cards_to_remap(col, {1: 0, 2: 3, 3: 2, 4: 4})
+
+    # Cards whose flags are unchanged by the mapping are left out
+    assert remapped == {cids[0]: 0, cids[1]: 3}
+    assert remapped_masks == {cids[3]: mask(4)}
+    assert cards_to_remap(col, {4: 4}) == ({}, {})
+
+
+def test_remap_custom_flags_clears_undo(col: Collection, cids: List[CardId]) -> None:
+    write_custom_flags(col, {cids[0]: 1, cids[1]: 2})
+    write_custom_flag_masks(col, {cids[2]: mask(1, 2)})
+    assert col.undo_status().undo
+
+    result = remap_custom_flags(col, {1: 0, 2: 1}, chunk_size=1)
+
+    assert result.count == 3
+    assert result.changes.card and result.changes.browser_sidebar
+    assert [get_card_custom_flag(col.get_card(cid)) for cid in cids[:3]] == [0, 1, 1]
+    assert get_card_custom_flag_mask(col.get_card(cids[2])) == mask(1)
+    # Undo would revert the cards but not the config they were remapped for
+    assert not col.undo_status().undo
+
+
+def test_toggle_custom_flag_bit(col: Collection, cids: List[CardId]) -> None:
+    write_custom_flag_masks(col, {cids[0]: mask(1), cids[1]: mask(2, 3)})
+    card = col.get_card(cids[2])
+    card.set_user_flag(4)
+    col.update_card(card)
+
+    result = toggle_custom_flag_bit_for_cards(col, cids[:3], 3, True, chunk_size=2)
+
+    # The second card already had the flag
+    assert result.count == 2
+    masks = [get_card_custom_flag_mask(col.get_card(cid)) for cid in cids[:3]]
+    assert masks == [mask(1, 3), mask(2, 3), mask(3)]
+    # Unlike setting a single custom flag, built-in flags are kept
+    assert col.get_card(cids[2]).user_flag() == 4
+
+    result = toggle_custom_flag_bit_for_cards(col, cids[:4], 1, False)
+
+    assert result.count == 1
+    masks = [get_card_custom_flag_mask(col.get_card(cid)) for cid in cids[:4]]
+    assert masks == [mask(3), mask(2, 3), mask(3), 0]
+    # Both toggles are a single undo step each
+    col.undo()
+    assert get_card_custom_flag_mask(col.get_card(cids[0])) == mask(1, 3)
+
+
+def test_migrate_to_flag_masks(col: Collection, cids: List[CardId]) -> None:
+    write_custom_flags(col, {cids[0]: 1, cids[1]: 3})
+    write_custom_flag_masks(col, {cids[2]: mask(2, 4)})
+
+    result = migrate_to_flag_masks(col, chunk_size=1)
+
+    assert result.count == 2
+    assert all(card_has_flag_mask(col.get_card(cid)) for cid in cids[:3])
+    masks = [get_card_custom_flag_mask(col.get_card(cid)) for cid in cids[:4]]
+    assert masks == [mask(1), mask(3), mask(2, 4), 0]
+    assert not card_has_flag_mask(col.get_card(cids[3]))
+    assert not col.undo_status().undo
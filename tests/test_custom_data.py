@@ -0,0 +1,80 @@
+"""Tests of the custom data helpers against a real collection, without the GUI."""
+
+from __future__ import annotations
+
+from typing import List
+
+import pytest
+from anki.collection import CardId, Collection
+
+from src.bulk import write_custom_flag_masks
+from src.custom_data import (
+    MAX_FLAG_BIT_SEARCH_BITS,
+    MAX_FLAG_BIT_SEARCH_RANGES,
+    MAX_MULTI_FLAGS,
+    apply_card_custom_flag_mask,
+    cards_with_flag_bit,
+    flag_bit,
+    flag_bit_search,
+    supports_custom_data_prop_search,
+)
+
+FLAGS_COUNT = 3
+
+
+@pytest.fixture
+def mask_cids(col: Collection, cids: List[CardId]) -> List[CardId]:
+    """Give the 6 cards the bitmasks 1 to 6 of 3 flags."""
+    masks = range(1, 1 << FLAGS_COUNT)
+    write_custom_flag_masks(col, dict(zip(cids, masks)))
+    return cids
+
+
+@pytest.mark.parametrize("flag", range(1, FLAGS_COUNT + 1))
+def test_flag_bit_search(col: Collection, mask_cids: List[CardId], flag: int) -> None:
+    if not supports_custom_data_prop_search():
+        pytest.skip("needs custom data searches")
+    search = flag_bit_search(flag, FLAGS_COUNT)
+    assert search
+
+    assert sorted(col.find_cards(search)) == sorted(cards_with_flag_bit(col, flag))
+    expected = [mask_cids[m - 1] for m in range(1, 7) if m & flag_bit(flag)]
+    assert sorted(col.find_cards(search)) == expected
+
+
+def test_flag_bit_search_range_count() -> None:
+    # The highest flag only needs a single range
+    assert flag_bit_search(5, 5) == "((prop:cdn:cfm>=16 prop:cdn:cfm<=31))"
+    search = flag_bit_search(1, 1 + MAX_FLAG_BIT_SEARCH_RANGES.bit_length() - 1)
+    assert search and search.count(" OR ") == MAX_FLAG_BIT_SEARCH_RANGES - 1
+    # Low flags of many flags would need too many ranges
+    assert flag_bit_search(1, 2 + MAX_FLAG_BIT_SEARCH_RANGES.bit_length() - 1) is None
+
+
+def test_flag_bit_search_of_highest_flags(col: Collection, cids: List[CardId]) -> None:
+    if not supports_custom_data_prop_search():
+        pytest.skip("needs custom data searches")
+    top = MAX_FLAG_BIT_SEARCH_BITS
+    write_custom_flag_masks(
+        col,
+        {
+            cids[0]: flag_bit(top) - 1,
+            cids[1]: flag_bit(top),
+            cids[2]: flag_bit(top + 1) - 1,
+        },
+    )
+    search = flag_bit_search(top, top)
+    assert search
+
+    assert sorted(col.find_cards(search)) == cids[1:3]
+    # Bounds past 24 bits would be compared inexactly
+    assert flag_bit_search(top + 1, top + 1) is None
+    assert flag_bit_search(top, top + 1) is None
+
+
+def test_masks_over_the_flag_limit_are_rejected(
+    col: Collection, cids: List[CardId]
+) -> None:
+    card = col.get_card(cids[0])
+    with pytest.raises(ValueError):
+        apply_card_custom_flag_mask(card, flag_bit(MAX_MULTI_FLAGS + 1))
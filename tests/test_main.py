@@ -0,0 +1,544 @@
+"""End-to-end tests of the add-on's patches and hooks, run against the headless aqt stand-in."""
+
+from __future__ import annotations
+
+from types import ModuleType
+from typing import Any, List
+
+import pytest
+from anki.collection import (
+    AddNoteRequest,
+    BrowserColumns,
+    CardId,
+    Collection,
+    OpChanges,
+)
+from anki.decks import DeckId
+from PyQt6.QtCore import Qt
+
+from src.custom_data import get_card_custom_flag, get_card_custom_flag_mask
+
+from . import headless
+
+CUSTOM_FLAGS = [
+    {"label": "Later", "color_light": "#ffd800", "color_dark": "#ffee75"},
+    {
+        "label": "Hard",
+        "color_light": "#ff0000",
+        "color_dark": "#aa0000",
+        "shortcut": "Alt+2",
+    },
+    {
+        "label": "Typo",
+        "color_light": "#00ff00",
+        "color_dark": "#00aa00",
+        "group": "Edit",
+    },
+]
+# Custom flags come after Anki's 7 built-in flags
+FIRST_CUSTOM_FLAG = 8
+
+
+@pytest.fixture
+def cids(mw: headless.MainWindow, main: ModuleType) -> List[CardId]:
+    """Set up the custom flags and add 10 cards."""
+    main.config["flags"] = CUSTOM_FLAGS
+    main.reload_custom_flags()
+    col = mw.col
+    assert col
+    notetype = col.models.by_name("Basic")
+    requests = []
+    for i in range(10):
+        note = col.new_note(notetype)
+        note["Front"] = f"front {i}"
+        requests.append(AddNoteRequest(note=note, deck_id=DeckId(1)))
+    col.add_notes(requests)
+    return sorted(col.find_cards(""))
+
+
+def card_flags(col: Collection, cids: List[CardId]) -> List[int]:
+    return [get_card_custom_flag(col.get_card(cid)) for cid in cids]
+
+
+def test_custom_flags_are_added_to_flag_manager(
+    mw: headless.MainWindow, cids: List[CardId]
+) -> None:
+    flags = mw.flags.all()
+    assert [flag.label for flag in flags[FIRST_CUSTOM_FLAG - 1 :]] == [
+        "Later",
+        "Hard",
+        "Typo",
+    ]
+    assert flags[FIRST_CUSTOM_FLAG - 1].index == FIRST_CUSTOM_FLAG
+
+
+def test_reviewer_flag_is_written_when_card_changes(
+    mw: headless.MainWindow, cids: List[CardId]
+) -> None:
+    assert mw.col
+    reviewer = mw.reviewer
+    reviewer.show_question(mw.col.get_card(cids[0]))
+    reviewer.set_flag_on_current_card(FIRST_CUSTOM_FLAG)
+
+    assert reviewer.web.evals[-1] == f"_moreFlagsDraw({FIRST_CUSTOM_FLAG});"
+    # Writes are deferred until the reviewer moves on
+    assert card_flags(mw.col, cids[:1]) == [0]
+    reviewer.show_question(mw.col.get_card(cids[1]))
+    mw.taskman.run_pending()
+    assert card_flags(mw.col, cids[:2]) == [1, 0]
+
+    reviewer.show_question(mw.col.get_card(cids[0]))
+    reviewer.set_flag_on_current_card(FIRST_CUSTOM_FLAG)
+    reviewer.end()
+    mw.taskman.run_pending()
+    assert card_flags(mw.col, cids[:1]) == [0]
+
+
+def test_answering_keeps_pending_flag(
+    mw: headless.MainWindow, cids: List[CardId]
+) -> None:
+    assert mw.col
+    reviewer = mw.reviewer
+    reviewer.show_question(mw.col.get_card(cids[0]))
+    reviewer.set_flag_on_current_card(FIRST_CUSTOM_FLAG + 1)
+    reviewer.answer_card(3)
+    mw.taskman.run_pending()
+
+    card = mw.col.get_card(cids[0])
+    assert card.reps == 1
+    assert get_card_custom_flag(card) == 2
+
+
+def test_answering_keeps_flag_counts(
+    mw: headless.MainWindow, main: ModuleType, cids: List[CardId]
+) -> None:
+    assert mw.col
+    assert main.flag_counts.totals(mw.col)[1] == {}
+    reviewer = mw.reviewer
+    reviewer.show_question(mw.col.get_card(cids[0]))
+    reviewer.answer_card(3)
+    mw.taskman.run_pending()
+
+    assert mw.col.get_card(cids[0]).reps == 1
+    assert main.flag_counts.is_loaded
+
+
+def test_undo_reverts_pending_flag(mw: headless.MainWindow, cids: List[CardId]) -> None:
+    assert mw.col
+    reviewer = mw.reviewer
+    reviewer.show_question(mw.col.get_card(cids[0]))
+    reviewer.answer_card(3)
+    mw.taskman.run_pending()
+    reviewer.show_question(mw.col.get_card(cids[1]))
+    reviewer.set_flag_on_current_card(FIRST_CUSTOM_FLAG)
+
+    mw.col.undo()
+    assert card_flags(mw.col, cids[:2]) == [0, 0]
+    assert mw.col.get_card(cids[0]).reps == 1
+    mw.col.redo()
+    assert card_flags(mw.col, cids[:2]) == [0, 1]
+
+
+def test_builtin_flag_replaces_custom_flag(
+    mw: headless.MainWindow, cids: List[CardId]
+) -> None:
+    assert mw.col
+    reviewer = mw.reviewer
+    reviewer.show_question(mw.col.get_card(cids[0]))
+    reviewer.set_flag_on_current_card(FIRST_CUSTOM_FLAG)
+    reviewer.set_flag_on_current_card(1)
+    mw.taskman.run_pending()
+    assert reviewer.web.evals[-1] == "_moreFlagsDraw(1);"
+    reviewer.end()
+    mw.taskman.run_pending()
+
+    card = mw.col.get_card(cids[0])
+    assert card.user_flag() == 1
+    assert get_card_custom_flag(card) == 0
+
+
+def test_multi_flags_are_toggled_independently(
+    mw: headless.MainWindow, main: ModuleType, cids: List[CardId]
+) -> None:
+    assert mw.col
+    main.config["multi_flags"] = True
+    reviewer = mw.reviewer
+    reviewer.show_question(mw.col.get_card(cids[0]))
+    reviewer.set_flag_on_current_card(FIRST_CUSTOM_FLAG)
+    reviewer.set_flag_on_current_card(FIRST_CUSTOM_FLAG + 2)
+    reviewer.set_flag_on_current_card(1)
+    reviewer.end()
+    mw.taskman.run_pending()
+
+    card = mw.col.get_card(cids[0])
+    assert card.user_flag() == 1
+    assert get_card_custom_flag_mask(card) == 0b101
+
+
+def test_browser_sets_custom_flag_and_undo_keeps_queues(
+    mw: headless.MainWindow, cids: List[CardId]
+) -> None:
+    assert mw.col
+    browser = headless.dialogs.open("Browser", mw)
+    browser.select(cids[:4])
+    browser.set_flag_of_selected_cards(FIRST_CUSTOM_FLAG + 1)
+    mw.taskman.run_pending()
+    assert card_flags(mw.col, cids[:5]) == [2, 2, 2, 2, 0]
+    assert headless.tooltips
+
+    # Setting the current flag again removes it
+    browser.select(cids[:2])
+    browser.set_flag_of_selected_cards(FIRST_CUSTOM_FLAG + 1)
+    mw.taskman.run_pending()
+    assert card_flags(mw.col, cids[:4]) == [0, 0, 2, 2]
+
+    out = mw.col.undo()
+    assert not out.changes.study_queues
+    assert card_flags(mw.col, cids[:4]) == [2, 2, 2, 2]
+
+
+def test_browser_builtin_flag_clears_custom_flags(
+    mw: headless.MainWindow, cids: List[CardId]
+) -> None:
+    assert mw.col
+    browser = headless.dialogs.open("Browser", mw)
+    browser.select(cids[:3])
+    browser.set_flag_of_selected_cards(FIRST_CUSTOM_FLAG)
+    mw.taskman.run_pending()
+    browser.select(cids[1:3])
+    browser.set_flag_of_selected_cards(2)
+    mw.taskman.run_pending()
+
+    assert card_flags(mw.col, cids[:3]) == [1, 0, 0]
+    assert [mw.col.get_card(cid).user_flag() for cid in cids[:3]] == [0, 2, 2]
+
+
+def test_browser_custom_flag_menu_actions(
+    mw: headless.MainWindow, cids: List[CardId]
+) -> None:
+    browser = headless.dialogs.open("Browser", mw)
+    actions = [action.text() for action in browser.form.menuFlag.actions()]
+    assert "Flag Statistics..." in actions
+    # Grouped flags are in a submenu, and their shortcuts work before it's opened
+    assert "Edit" in actions
+    assert browser.form.custom_flag_action_3 in browser.actions()
+
+    browser.select(cids[:1])
+    browser.form.custom_flag_action_1.trigger()
+    mw.taskman.run_pending()
+    browser.form.menuFlag.aboutToShow.emit()
+    assert browser.form.custom_flag_action_1.isChecked()
+    assert not browser.form.custom_flag_action_2.isChecked()
+
+
+def test_browser_search_resolves_custom_flags(
+    mw: headless.MainWindow, cids: List[CardId]
+) -> None:
+    browser = headless.dialogs.open("Browser", mw)
+    browser.select(cids[2:5])
+    browser.set_flag_of_selected_cards(FIRST_CUSTOM_FLAG + 2)
+    mw.taskman.run_pending()
+
+    browser.table.search("custom-flag:3")
+    assert sorted(browser.table._model._items) == cids[2:5]
+    browser.table.search("custom-flag:1")
+    assert browser.table._model._items == []
+
+
+def test_browser_sorts_by_custom_flag_column(
+    mw: headless.MainWindow, main: ModuleType, cids: List[CardId]
+) -> None:
+    browser = headless.dialogs.open("Browser", mw)
+    for flag, cid in enumerate(reversed(cids[:3]), start=1):
+        browser.select([cid])
+        browser.set_flag_of_selected_cards(original_flag(main, flag))
+        mw.taskman.run_pending()
+    columns: dict = {}
+    headless.gui_hooks.browser_did_fetch_columns(columns)
+
+    browser.table.search("", order=columns[main.CUSTOM_FLAG_COLUMN])
+    # Flagged cards come first, in order of their flags
+    assert browser.table._model._items[:3] == list(reversed(cids[:3]))
+
+
+def original_flag(main: ModuleType, flag: int) -> int:
+    return main.original_flags_count + flag
+
+
+def test_browser_rows_are_painted_after_fetching_flags(
+    mw: headless.MainWindow, main: ModuleType, cids: List[CardId]
+) -> None:
+    browser = headless.dialogs.open("Browser", mw)
+    browser.select(cids[1:2])
+    browser.set_flag_of_selected_cards(FIRST_CUSTOM_FLAG)
+    mw.taskman.run_pending()
+    browser.table._state.active_columns.append(main.CUSTOM_FLAG_COLUMN)
+    browser.table.search("", order="c.id asc")
+    mw.taskman.run_pending()
+    model = browser.table._model
+
+    repainted = []
+    model.dataChanged.connect(lambda top, bottom: repainted.append(top.row()))
+    row = model.get_row(1)
+    assert row.color == {"light": "#ffd800", "dark": "#ffee75"}
+    assert row.cells[-1].text == "Later"
+    assert model.get_row(0).color is None
+    assert not repainted
+
+
+def test_sidebar_shows_flag_counts(mw: headless.MainWindow, cids: List[CardId]) -> None:
+    browser = headless.dialogs.open("Browser", mw)
+    browser.select(cids[:2])
+    browser.set_flag_of_selected_cards(FIRST_CUSTOM_FLAG + 1)
+    mw.taskman.run_pending()
+    browser.sidebar.refresh()
+
+    assert browser.sidebar.root
+    flag_root = browser.sidebar.root.children[0]
+    names = {item.id: item.name for item in flag_root.children}
+    assert names[FIRST_CUSTOM_FLAG + 1] == "Hard (2)"
+    assert names[1].endswith(" (0)")
+
+
+def test_rename_custom_flag(
+    mw: headless.MainWindow, main: ModuleType, cids: List[CardId]
+) -> None:
+    mw.flags.rename_flag(FIRST_CUSTOM_FLAG, "Much later (0)")
+    assert main.config["flags"][0]["label"] == "Much later (0)"
+    assert mw.flags.get_flag(FIRST_CUSTOM_FLAG).label == "Much later (0)"
+
+
+def test_sidebar_renames_flag_from_label(
+    mw: headless.MainWindow, main: ModuleType, cids: List[CardId]
+) -> None:
+    browser = headless.dialogs.open("Browser", mw)
+    browser.sidebar.refresh()
+    assert browser.sidebar.root
+    item = browser.sidebar.root.children[0].children[FIRST_CUSTOM_FLAG]
+    model = browser.sidebar.model()
+    index = model.index_of(item)
+
+    assert model.data(index).value() == "Hard (0)"
+    assert model.data(index, Qt.ItemDataRole.EditRole).value() == "Hard"
+    browser.sidebar._on_rename(item, "Hard (0) to do")
+    assert main.config["flags"][1]["label"] == "Hard (0) to do"
+
+
+def test_flag_counts_follow_card_changes(
+    mw: headless.MainWindow,
+    main: ModuleType,
+    cids: List[CardId],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    col = mw.col
+    assert col
+    computed: List[bool] = []
+    compute = main.flag_counts._compute
+
+    def counting_compute(*args: Any) -> Any:
+        computed.append(True)
+        return compute(*args)
+
+    monkeypatch.setattr(main.flag_counts, "_compute", counting_compute)
+    browser = headless.dialogs.open("Browser", mw)
+    browser.select(cids[:2])
+    browser.set_flag_of_selected_cards(FIRST_CUSTOM_FLAG + 1)
+    mw.taskman.run_pending()
+    assert main.flag_counts.by_deck(col) == {DeckId(1): ({}, {2: 2})}
+
+    # Flag changes and note edits don't need a rescan
+    browser.select(cids[2:3])
+    browser.set_flag_of_selected_cards(FIRST_CUSTOM_FLAG + 1)
+    note = col.get_card(cids[0]).note()
+    note["Front"] = "edited"
+    headless.CollectionOp(mw, lambda col: col.update_note(note)).run_in_background()
+    mw.taskman.run_pending()
+    col.undo()
+    assert main.flag_counts.totals(col)[1] == {2: 3}
+    assert len(computed) == 1
+
+    # Moving cards only needs the per-deck counts to be recomputed
+    did = col.decks.id("Other")
+    assert did
+    headless.CollectionOp(
+        mw, lambda col: col.set_deck(cids[:1], did)
+    ).run_in_background()
+    mw.taskman.run_pending()
+    assert main.flag_counts.totals(col)[1] == {2: 3}
+    assert len(computed) == 1
+    assert main.flag_counts.by_deck(col) == {
+        DeckId(1): ({}, {2: 2}),
+        did: ({}, {2: 1}),
+    }
+    assert len(computed) == 2
+
+    headless.CollectionOp(
+        mw, lambda col: col.remove_notes([col.get_card(cids[0]).nid])
+    ).run_in_background()
+    mw.taskman.run_pending()
+    assert not main.flag_counts.is_loaded
+    assert main.flag_counts.totals(col)[1] == {2: 2}
+
+
+def test_reviewer_content_includes_flag_stylesheet(
+    mw: headless.MainWindow, main: ModuleType, cids: List[CardId]
+) -> None:
+    assert mw.col
+    mw.reviewer.show_question(mw.col.get_card(cids[0]))
+    content = mw.reviewer.web.content
+    assert content
+    url = main.flag_stylesheet.url()
+    assert url in content.css
+    css = (main.flag_stylesheet.directory / url.rsplit("/", 1)[1]).read_text()
+    assert f"--flag-{FIRST_CUSTOM_FLAG}: #ffd800" in css
+    assert "_moreFlagsDraw" in content.body
+
+
+def test_flag_labels_are_escaped_in_reviewer_script(
+    mw: headless.MainWindow, main: ModuleType, cids: List[CardId]
+) -> None:
+    assert mw.col
+    main.config["show_flag_labels"] = True
+    mw.flags.rename_flag(FIRST_CUSTOM_FLAG, "</script><b>Later")
+    mw.reviewer.show_question(mw.col.get_card(cids[0]))
+    content = mw.reviewer.web.content
+    assert content
+    assert content.body.count("</script>") == 1
+    assert "<\\/script><b>Later" in content.body
+
+
+def test_reviewer_shortcuts_and_context_menu(
+    mw: headless.MainWindow, cids: List[CardId]
+) -> None:
+    assert mw.col
+    reviewer = mw.reviewer
+    reviewer.show_question(mw.col.get_card(cids[0]))
+    shortcuts = [key for key, _ in reviewer._shortcutKeys()]
+    assert "Alt+2" in shortcuts
+    assert f"Ctrl+{FIRST_CUSTOM_FLAG + 1}" not in shortcuts
+
+    reviewer.set_flag_on_current_card(FIRST_CUSTOM_FLAG)
+    menus = []
+    headless.gui_hooks.reviewer_will_show_context_menu.append(
+        lambda reviewer, menu: menus.append(menu)
+    )
+    try:
+        reviewer.showContextMenu()
+    finally:
+        headless.gui_hooks.reviewer_will_show_context_menu._hooks.clear()
+    flag_menu = menus[0].actions()[0].menu()
+    actions = {action.text(): action for action in flag_menu.actions()}
+    assert actions["Later"].isChecked()
+    assert not actions["Hard"].isChecked()
+    assert "Edit" in actions
+
+
+def test_reload_updates_open_browser(
+    mw: headless.MainWindow, main: ModuleType, cids: List[CardId]
+) -> None:
+    browser = headless.dialogs.open("Browser", mw)
+    grouped_action = browser.form.custom_flag_action_3
+    main.config["flags"] = CUSTOM_FLAGS[:1]
+    main.reload_custom_flags()
+    assert grouped_action not in browser.actions()
+
+    assert len(mw.flags.all()) == FIRST_CUSTOM_FLAG
+    assert hasattr(browser.form, "custom_flag_action_1")
+    assert not hasattr(browser.form, "custom_flag_action_2")
+
+
+def test_study_custom_flags_builds_filtered_deck(
+    mw: headless.MainWindow, main: ModuleType, cids: List[CardId]
+) -> None:
+    assert mw.col
+    browser = headless.dialogs.open("Browser", mw)
+    browser.select(cids[:3])
+    browser.set_flag_of_selected_cards(FIRST_CUSTOM_FLAG)
+    mw.taskman.run_pending()
+
+    main.study_custom_flags([1])
+    mw.taskman.run_pending()
+
+    assert mw.state == "overview"
+    deck_id = mw.col.decks.get_current_id()
+    assert mw.col.decks.name(deck_id) == "Custom Flag: Later"
+    assert sorted(mw.col.find_cards(f"did:{deck_id}")) == cids[:3]
+
+    # Rebuilding picks up flags changed since the deck was built
+    browser.select(cids[3:5])
+    browser.set_flag_of_selected_cards(FIRST_CUSTOM_FLAG)
+    mw.taskman.run_pending()
+    mw.col.decks.rename(deck_id, "Flagged")
+    mw.overview.rebuild_current_filtered_deck()
+    mw.taskman.run_pending()
+
+    assert mw.col.decks.get_current_id() == deck_id
+    assert sorted(mw.col.find_cards(f"did:{deck_id}")) == cids[:5]
+
+
+def test_flag_index_is_rebuilt_after_imports(
+    mw: headless.MainWindow, main: ModuleType, cids: List[CardId]
+) -> None:
+    assert mw.col
+    assert main.custom_flag_card_ids(mw.col, [1]) == []
+
+    def import_custom_data(col: Collection) -> OpChanges:
+        # Like an .apkg import bringing in cards with custom flags
+        target = col.add_custom_undo_entry(col.tr.actions_import())
+        card = col.get_card(cids[0])
+        card.custom_data = '{"cf": 1}'
+        col.update_card(card)
+        return col.merge_undo_entries(target)
+
+    headless.CollectionOp(mw, import_custom_data).run_in_background()
+    mw.taskman.run_pending()
+
+    assert main.custom_flag_card_ids(mw.col, [1]) == cids[:1]
+
+
+def test_flag_index_tracks_all_flags_in_multi_flag_mode(
+    mw: headless.MainWindow, main: ModuleType, cids: List[CardId]
+) -> None:
+    assert mw.col
+    browser = headless.dialogs.open("Browser", mw)
+    browser.select(cids[:2])
+    browser.set_flag_of_selected_cards(FIRST_CUSTOM_FLAG)
+    mw.taskman.run_pending()
+
+    # Switching modes rebuilds the index
+    main.config["multi_flags"] = True
+    assert main.custom_flag_card_ids(mw.col, [1]) == cids[:2]
+
+    # Toggled flags are added to the index without rebuilding it
+    browser.select(cids[1:4])
+    browser.set_flag_of_selected_cards(FIRST_CUSTOM_FLAG + 2)
+    mw.taskman.run_pending()
+    assert main.custom_flag_card_ids(mw.col, [1]) == cids[:2]
+    assert main.custom_flag_card_ids(mw.col, [3]) == cids[1:4]
+    assert main.custom_flag_card_ids(mw.col, [1, 3]) == cids[:4]
+
+    browser.select(cids[1:2])
+    browser.set_flag_of_selected_cards(FIRST_CUSTOM_FLAG)
+    mw.taskman.run_pending()
+    assert main.custom_flag_card_ids(mw.col, [1]) == cids[:1]
+    assert main.custom_flag_card_ids(mw.col, [3]) == cids[1:4]
+
+
+def test_operations_clear_cached_row_flags(
+    mw: headless.MainWindow, main: ModuleType, cids: List[CardId]
+) -> None:
+    browser = headless.dialogs.open("Browser", mw)
+    browser.table.search("")
+    mw.taskman.run_pending()
+    assert main.row_color_provider.peek(cids[0]) == (0, None)
+
+    browser.select(cids[:1])
+    browser.set_flag_of_selected_cards(FIRST_CUSTOM_FLAG)
+    mw.taskman.run_pending()
+    assert main.row_color_provider.peek(cids[0]) is None
+
+
+def test_column_is_registered(main: ModuleType) -> None:
+    columns: dict = {}
+    headless.gui_hooks.browser_did_fetch_columns(columns)
+    assert isinstance(columns[main.CUSTOM_FLAG_COLUMN], BrowserColumns.Column)
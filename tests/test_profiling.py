@@ -0,0 +1,24 @@
+"""Tests of the helpers used to profile the add-on."""
+
+from __future__ import annotations
+
+import tracemalloc
+
+from src.profiling import measure
+
+
+def test_measure_records_peak_memory_only_when_tracing() -> None:
+    with measure() as measurement:
+        pass
+    assert measurement.elapsed > 0
+    assert measurement.peak_memory is None
+
+    tracemalloc.start()
+    try:
+        with measure() as measurement:
+            data = bytearray(1 << 20)
+        del data
+    finally:
+        tracemalloc.stop()
+    assert measurement.peak_memory is not None
+    assert measurement.peak_memory >= 1 << 20
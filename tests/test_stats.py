@@ -0,0 +1,88 @@
+"""Tests of the flag counts against a real collection, without the GUI."""
+
+from __future__ import annotations
+
+from typing import Iterator, List
+
+import pytest
+from anki.collection import CardId, Collection
+
+from src import stats
+from src.bulk import write_custom_flag_masks, write_custom_flags
+from src.custom_data import custom_flags_did_change, flag_bit
+from src.stats import FlagCounts
+
+
+@pytest.fixture(params=[True, False], ids=["prop-search", "raw-data"])
+def prop_search(
+    request: pytest.FixtureRequest, monkeypatch: pytest.MonkeyPatch
+) -> bool:
+    """Count from extracted custom data values, and from raw data like before 2.1.64."""
+    monkeypatch.setattr(
+        stats, "supports_custom_data_prop_search", lambda: request.param
+    )
+    return request.param
+
+
+@pytest.fixture
+def tracked_counts() -> Iterator[FlagCounts]:
+    """Multi-flag counts that are kept up to date from the flag write paths."""
+    counts = FlagCounts(lambda: True)
+    custom_flags_did_change.append(counts.apply_custom_flag_changes)
+    yield counts
+    custom_flags_did_change.remove(counts.apply_custom_flag_changes)
+
+
+def test_single_flag_counts(
+    col: Collection, cids: List[CardId], prop_search: bool
+) -> None:
+    write_custom_flag_masks(col, {cids[0]: flag_bit(1) | flag_bit(2)})
+    write_custom_flags(col, {cids[1]: 2, cids[2]: 2})
+
+    # Only the lowest flag of cards with several is counted in single-flag mode
+    assert FlagCounts().totals(col)[1] == {1: 1, 2: 2}
+
+
+def test_multi_flag_counts(
+    col: Collection, cids: List[CardId], prop_search: bool
+) -> None:
+    write_custom_flag_masks(
+        col, {cids[0]: flag_bit(1) | flag_bit(3), cids[1]: flag_bit(3)}
+    )
+    # Flagged before switching to multi-flag mode
+    write_custom_flags(col, {cids[2]: 2})
+
+    assert FlagCounts(lambda: True).totals(col)[1] == {1: 1, 2: 1, 3: 2}
+
+
+def test_multi_flag_counts_are_updated_incrementally(
+    col: Collection, cids: List[CardId], tracked_counts: FlagCounts
+) -> None:
+    write_custom_flag_masks(col, {cids[0]: flag_bit(1) | flag_bit(3)})
+    tracked_counts.totals(col)
+
+    write_custom_flag_masks(
+        col, {cids[0]: flag_bit(2) | flag_bit(3), cids[1]: flag_bit(1)}
+    )
+    write_custom_flags(col, {cids[2]: 3})
+
+    totals = tracked_counts.totals(col)
+    assert {flag: count for flag, count in totals[1].items() if count} == {
+        1: 1,
+        2: 1,
+        3: 2,
+    }
+    assert totals == FlagCounts(lambda: True).totals(col)
+
+
+def test_counts_are_recomputed_when_mode_changes(
+    col: Collection, cids: List[CardId]
+) -> None:
+    multi = False
+    counts = FlagCounts(lambda: multi)
+    write_custom_flag_masks(col, {cids[0]: flag_bit(1) | flag_bit(2)})
+    assert counts.totals(col)[1] == {1: 1}
+
+    multi = True
+
+    assert counts.totals(col)[1] == {1: 1, 2: 1}
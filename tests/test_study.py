@@ -0,0 +1,50 @@
+"""Tests of building filtered decks from custom flags, without the GUI."""
+
+from __future__ import annotations
+
+from typing import List
+
+import pytest
+from anki.collection import CardId, Collection
+from anki.decks import DeckId
+
+from src import study
+from src.study import STUDY_DECKS_CONFIG_KEY, build_filtered_deck, study_deck_flags
+
+
+def deck_cards(col: Collection, did: int) -> List[CardId]:
+    return sorted(col.find_cards(f"did:{did}"))
+
+
+def test_build_filtered_deck_takes_first_due_cards(
+    col: Collection, cids: List[CardId], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(study, "MAX_FILTERED_DECK_CARDS", 3)
+    col.sched.suspend_cards(cids[:1])
+
+    out = build_filtered_deck(col, "Flagged", list(reversed(cids)), [1])
+
+    # Suspended cards are skipped, and only as many ids as the limit are passed
+    assert deck_cards(col, out.id) == cids[1:4]
+    deck = col.decks.get(DeckId(out.id))
+    assert deck
+    assert deck["terms"][0][1] == 3
+
+    # Rebuilding keeps the cards already in the deck eligible
+    out = build_filtered_deck(col, "Flagged", cids, [1])
+    assert deck_cards(col, out.id) == cids[1:4]
+
+
+def test_study_deck_flags(col: Collection, cids: List[CardId]) -> None:
+    first = build_filtered_deck(col, "First", cids[:2], [1, 3])
+    second = build_filtered_deck(col, "Second", cids[2:4], [2])
+
+    assert study_deck_flags(col, DeckId(first.id)) == [1, 3]
+    assert study_deck_flags(col, DeckId(second.id)) == [2]
+    assert study_deck_flags(col, DeckId(1)) is None
+
+    # Decks deleted since they were built are forgotten on the next build
+    col.decks.remove([DeckId(first.id)])
+    assert study_deck_flags(col, DeckId(first.id)) is None
+    build_filtered_deck(col, "Second", cids[2:3], [2])
+    assert set(col.get_config(STUDY_DECKS_CONFIG_KEY)) == {str(second.id)}
@@ -0,0 +1,78 @@
+"""Round trips of custom flags through export files, without the GUI."""
+
+from __future__ import annotations
+
+from pathlib import Path
+from typing import List
+
+import pytest
+from anki.collection import CardId, Collection
+
+from src.bulk import write_custom_flag_masks, write_custom_flags
+from src.custom_data import flag_bit, get_card_custom_flag, get_card_custom_flag_mask
+from src.transfer import export_custom_flags, import_custom_flags
+
+LABELS = ["Later", "Hard", "Typo"]
+INDEX_BY_LABEL = {label: i for i, label in enumerate(LABELS, start=1)}
+
+
+@pytest.mark.parametrize("name", ["flags.csv", "flags.jsonl"])
+def test_round_trip(
+    col: Collection, cids: List[CardId], tmp_path: Path, name: str
+) -> None:
+    write_custom_flags(col, {cids[0]: 1, cids[1]: 3})
+    path = tmp_path / name
+
+    assert export_custom_flags(col, path, LABELS) == 2
+    write_custom_flags(col, {cids[0]: 0, cids[1]: 0, cids[2]: 2})
+    result = import_custom_flags(col, path, INDEX_BY_LABEL)
+
+    assert result.count == 2
+    assert [get_card_custom_flag(col.get_card(cid)) for cid in cids[:3]] == [1, 3, 2]
+
+
+def test_import_matches_flags_by_label(
+    col: Collection, cids: List[CardId], tmp_path: Path
+) -> None:
+    write_custom_flags(col, {cids[0]: 1})
+    path = tmp_path / "flags.csv"
+    export_custom_flags(col, path, LABELS)
+    write_custom_flags(col, {cids[0]: 0})
+
+    # "Later" was moved to the third place after exporting
+    import_custom_flags(col, path, {"Hard": 1, "Typo": 2, "Later": 3})
+
+    assert get_card_custom_flag(col.get_card(cids[0])) == 3
+
+
+# A chunk size of 1 splits the records of each card across chunks
+@pytest.mark.parametrize("chunk_size", [1, 2, 1000])
+def test_multi_flags_round_trip(
+    col: Collection, cids: List[CardId], tmp_path: Path, chunk_size: int
+) -> None:
+    write_custom_flag_masks(
+        col, {cids[0]: flag_bit(1) | flag_bit(3), cids[1]: flag_bit(2)}
+    )
+    # Flagged before switching to multi-flag mode
+    write_custom_flags(col, {cids[2]: 3})
+    path = tmp_path / "flags.jsonl"
+
+    assert export_custom_flags(col, path, LABELS, multi=True) == 4
+    write_custom_flag_masks(col, {cid: 0 for cid in cids[:3]})
+    import_custom_flags(col, path, INDEX_BY_LABEL, chunk_size=chunk_size, multi=True)
+
+    masks = [get_card_custom_flag_mask(col.get_card(cid)) for cid in cids[:3]]
+    assert masks == [flag_bit(1) | flag_bit(3), flag_bit(2), flag_bit(3)]
+
+
+def test_multi_flags_import_in_single_flag_mode(
+    col: Collection, cids: List[CardId], tmp_path: Path
+) -> None:
+    write_custom_flag_masks(col, {cids[0]: flag_bit(2) | flag_bit(3)})
+    path = tmp_path / "flags.csv"
+    export_custom_flags(col, path, LABELS, multi=True)
+    write_custom_flag_masks(col, {cids[0]: 0})
+
+    import_custom_flags(col, path, INDEX_BY_LABEL, chunk_size=1)
+
+    assert get_card_custom_flag(col.get_card(cids[0])) == 2